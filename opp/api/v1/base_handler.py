@@ -1,10 +1,29 @@
-from opp.db import api
+from sqlalchemy import exc
+
+from opp.common import aescipher, blindindex, kdf, keycache, opp_config
+from opp.db import api, models
+
+
+# Unwrapped data keys, so the passphrase is only needed to look them up
+DATA_KEYS = keycache.KeyCache()
+
+
+class OldPassphraseRequired(Exception):
+    pass
+
+
+class InvalidPassphrase(Exception):
+    pass
 
 
 class BaseResponseHandler(object):
 
-    def __init__(self, request):
+    def __init__(self, request, user=None, conf=None, limiter=None):
         self.request = request
+        self.user = user
+        self.conf = conf
+        self.limiter = limiter
+        self._shared_ciphers = False
 
     def error(self, msg=None):
         return {'result': "error", 'message': msg}
@@ -29,6 +48,196 @@ class BaseResponseHandler(object):
 
         return payload, None
 
+    def _init_ciphers(self, phrase):
+        """Set up the ciphers for rows of the current and previous key.
+
+        Rows written during an unfinished re-key operation use the new
+        passphrase, while the remaining rows still require the old one,
+        which may be supplied in the 'x-opp-old-phrase' header.
+        """
+        if self._shared_ciphers:
+            return
+        self.key_version = api.key_version_get(session=self.session)
+        key = self._data_key(phrase)
+        if key is None:
+            self.cipher = aescipher.AEADCipher(phrase)
+        else:
+            self.cipher = aescipher.AEADCipher(key, raw=True)
+        old_phrase = self.request.headers.get('x-opp-old-phrase')
+        self.old_cipher = None
+        if old_phrase:
+            self.old_cipher = aescipher.AEADCipher(old_phrase)
+
+    def share_ciphers(self, handler):
+        """Use the ciphers of another handler instead of setting up own."""
+        self.key_version = handler.key_version
+        self.cipher = handler.cipher
+        self.old_cipher = handler.old_cipher
+        self._shared_ciphers = True
+
+    def _data_key(self, phrase):
+        """Return the vault's data key unwrapped with the user's passphrase.
+
+        Users without a wrapped copy of the data key yet get one, see
+        :meth:`_enrol`, within the login rate limits. Unwrapping requires
+        the deliberately slow passphrase KDF, so the unwrapped key is cached
+        for subsequent requests as long as the user's wrapped key does not
+        change.
+
+        Returns None if there is no user or an unfinished passphrase-keyed
+        re-key is in progress, in which case the key is derived from the
+        passphrase directly.
+        """
+        if not self.user:
+            return None
+        data_key = api.data_key_get_by_user_id(self.user.id,
+                                               session=self.session)
+        if data_key is not None:
+            key = DATA_KEYS.get(self.user.id, phrase, data_key.wrapped_key)
+            if key is not None:
+                return key
+            key = self._unwrap(data_key, phrase)
+            if (data_key.kdf != kdf.default_params(self.conf) or
+                    not aescipher.is_aead(data_key.wrapped_key) or
+                    data_key.key_id is None):
+                # Upgrade to the current KDF, cost parameters and cipher
+                self._wrap_data_key(data_key, phrase, key)
+                api.data_key_update(data_key, session=self.session)
+        else:
+            job = api.rekey_job_get_latest(session=self.session)
+            if job and job.status == "running":
+                return None
+            # Enrolment may try every wrapped copy, so it is throttled
+            # like a login
+            self._throttle_login(self.user.username)
+            try:
+                data_key, key = self._enrol(phrase)
+            except InvalidPassphrase:
+                self._login_failed(self.user.username)
+                raise
+
+        DATA_KEYS.set(self.user.id, phrase, key, data_key.wrapped_key)
+        return key
+
+    def _enrol(self, phrase):
+        """Wrap the vault's data key with the passphrase of a new user.
+
+        The data key is the one any existing wrapped copy unwraps to with
+        the passphrase. The first user of an empty vault generates it, and
+        for a vault written before data keys existed, it is the
+        passphrase-derived key the rows are already encrypted with.
+
+        :returns: tuple of the user's wrapped data key and the data key
+        :raises InvalidPassphrase: if the passphrase unwraps no copy
+        """
+        data_keys = api.data_key_getall(session=self.session)
+        new_key = not data_keys
+        if data_keys:
+            key = None
+            for data_key in data_keys:
+                try:
+                    key = self._unwrap(data_key, phrase)
+                    break
+                except InvalidPassphrase:
+                    pass
+            if key is None:
+                raise InvalidPassphrase()
+        elif api.vault_is_empty(session=self.session):
+            key = aescipher.generate_key()
+        else:
+            key = aescipher.AEADCipher(phrase).key
+            self._check_vault_key(key)
+
+        data_key = models.DataKey(user_id=self.user.id)
+        self._wrap_data_key(data_key, phrase, key)
+        try:
+            api.data_key_create(data_key, session=self.session)
+        except exc.IntegrityError:
+            # Created by a concurrent request of the user in the meantime
+            self.session.rollback()
+            data_key = api.data_key_get_by_user_id(self.user.id,
+                                                   session=self.session)
+            return data_key, self._unwrap(data_key, phrase)
+
+        first = api.data_key_getall(session=self.session)[0]
+        if new_key and first.key_id != data_key.key_id:
+            # Another user was the first to enrol concurrently, with a
+            # different key. The earlier one wins.
+            api.data_key_delete(data_key, session=self.session)
+            return self._enrol(phrase)
+        return data_key, key
+
+    def _check_vault_key(self, key):
+        """Check a key against the rows of a vault without data keys.
+
+        Adopting a mistyped passphrase's key as the data key would lock
+        everyone else out of the vault, so it must decrypt existing rows.
+
+        :raises InvalidPassphrase: if the key does not decrypt them
+        """
+        cipher = aescipher.AEADCipher(key, raw=True)
+        category, item = api.vault_sample(session=self.session)
+        try:
+            if category is not None:
+                models.decrypt_category(cipher, category.name, category.id)
+            if item is not None:
+                models.decrypt_item(
+                    cipher, [getattr(item, column)
+                             for column in models.ENCRYPTED_COLUMNS],
+                    item.id)
+        except (TypeError, ValueError):
+            raise InvalidPassphrase()
+
+    def _unwrap(self, data_key, phrase):
+        try:
+            return data_key.unwrap(self._kek(data_key, phrase))
+        except (TypeError, ValueError):
+            raise InvalidPassphrase()
+
+    def _kek(self, data_key, phrase):
+        if data_key.kdf is None:
+            return aescipher.AEADCipher(phrase)
+        return aescipher.AEADCipher(
+            kdf.derive_key(phrase, data_key.salt, data_key.kdf), raw=True)
+
+    def _wrap_data_key(self, data_key, phrase, key):
+        data_key.salt = kdf.generate_salt()
+        data_key.kdf = kdf.default_params(self.conf)
+        data_key.wrap(self._kek(data_key, phrase), key)
+
+    def _throttle_login(self, username):
+        """Count a password check against the login rate limits.
+
+        :raises ratelimit.RateLimited: if there were too many attempts
+        """
+        if self.limiter is not None:
+            self.limiter.check(username=username,
+                               ip=getattr(self.request, 'remote_addr', None))
+
+    def _login_failed(self, username):
+        """Count a failed password check against the username's limit."""
+        if self.limiter is not None:
+            self.limiter.failed(username=username)
+
+    def _index_key(self):
+        """Return the blind index key, or None if the index is disabled."""
+        conf = self.conf or opp_config.OppConfig()
+        if not conf.getboolean('search_index'):
+            return None
+        return blindindex.index_key(self.cipher.key)
+
+    def _suffixes(self):
+        """Return the public suffix list, or None if it is unavailable."""
+        conf = self.conf or opp_config.OppConfig()
+        return blindindex.public_suffixes(conf['public_suffix_list'])
+
+    def _row_cipher(self, row):
+        if row is None or row.key_version == self.key_version:
+            return self.cipher
+        if self.old_cipher is None:
+            raise OldPassphraseRequired()
+        return self.old_cipher
+
     def _do_get(self, phrase):
         return self.error("Action not implemented")
 
@@ -50,22 +259,33 @@ class BaseResponseHandler(object):
         else:
             phrase = None
 
-        # Obtain DB session for making transactions
-        self.session = api.get_session()
-
-        if self.request.method == "GET":
-            response = self._do_get(phrase)
-        elif self.request.method == "PUT":
-            response = self._do_put(phrase)
-        elif self.request.method == "POST":
-            response = self._do_post(phrase)
-        elif self.request.method == "DELETE":
-            response = self._do_delete()
-        else:
-            response = self.error("Method not supported!")
+        # Obtain DB session for making transactions, reads of GET requests
+        # may be served by a replica
+        self.session = api.get_session(
+            self.conf, read_only=self.request.method == "GET",
+            user_id=self.user.id if self.user else None)
+        try:
+            return self.dispatch(phrase)
+        finally:
+            self.session.close()
 
-        self.session.close()
-        return response
+    def dispatch(self, phrase):
+        """Run the handler method of the request within self.session."""
+        try:
+            if self.request.method == "GET":
+                return self._do_get(phrase)
+            elif self.request.method == "PUT":
+                return self._do_put(phrase)
+            elif self.request.method == "POST":
+                return self._do_post(phrase)
+            elif self.request.method == "DELETE":
+                return self._do_delete()
+            else:
+                return self.error("Method not supported!")
+        except OldPassphraseRequired:
+            return self.error("Re-key in progress, old passphrase missing!")
+        except InvalidPassphrase:
+            return self.error("Invalid passphrase!")
 
 
 class ErrorResponseHandler(BaseResponseHandler):
@@ -0,0 +1,104 @@
+from werkzeug.datastructures import MultiDict
+
+from opp.api.v1 import base_handler, categories, items, users
+from opp.common import ratelimit
+
+
+HANDLERS = {'categories': categories,
+            'items': items,
+            'users': users}
+METHODS = ('GET', 'PUT', 'POST', 'DELETE')
+MAX_OPERATIONS = 100
+
+
+class _BatchSession(object):
+    """Session proxy which defers all commits to the end of the batch."""
+
+    def __init__(self, session):
+        self._session = session
+
+    def commit(self):
+        # Still send the changes, so generated ids are available
+        self._session.flush()
+
+    def close(self):
+        pass
+
+    def __getattr__(self, name):
+        return getattr(self._session, name)
+
+
+class _Request(object):
+    """Stand-in for the request of a single batched operation."""
+
+    def __init__(self, method, body, args, headers, remote_addr=None):
+        self.method = method
+        self.args = MultiDict(args)
+        self.headers = headers
+        self.remote_addr = remote_addr
+        self._body = body
+
+    def get_json(self):
+        return self._body
+
+
+class ResponseHandler(base_handler.BaseResponseHandler):
+
+    def _parse_operation(self, op):
+        if not isinstance(op, dict):
+            return None
+        endpoint = op.get('endpoint')
+        method = op.get('method')
+        body = op.get('body', {})
+        args = op.get('args', {})
+        if (endpoint not in HANDLERS or method not in METHODS or
+                not isinstance(body, dict) or not isinstance(args, dict)):
+            return None
+        request = _Request(method, body, args, self.request.headers,
+                           getattr(self.request, 'remote_addr', None))
+        return HANDLERS[endpoint].ResponseHandler(request, self.user,
+                                                  self.conf, self.limiter)
+
+    def _do_post(self, phrase):
+        ops, error = self._check_payload(expect_list=True)
+        if error:
+            return error
+        if len(ops) > MAX_OPERATIONS:
+            return self.error("Too many operations, the maximum is %d!" %
+                              MAX_OPERATIONS)
+
+        handlers = []
+        for index, op in enumerate(ops):
+            handler = self._parse_operation(op)
+            if handler is None:
+                return self.error("Invalid operation %d!" % index)
+            handlers.append(handler)
+
+        # All operations share one cipher and one transaction
+        self._init_ciphers(phrase)
+        session = _BatchSession(self.session)
+        results = []
+        for index, handler in enumerate(handlers):
+            handler.session = session
+            handler.share_ciphers(self)
+            try:
+                result = handler.dispatch(phrase)
+            except ratelimit.RateLimited:
+                self.session.rollback()
+                raise
+            except Exception:
+                result = self.error("Unable to perform operation!")
+            results.append(result)
+            if result.get('result') == "error":
+                self.session.rollback()
+                return {'result': "error",
+                        'message': "Operation %d failed, no changes were "
+                                   "made!" % index,
+                        'results': results}
+
+        try:
+            self.session.commit()
+        except Exception:
+            self.session.rollback()
+            return self.error("Unable to commit the batch to the database!")
+        return {'result': "success", 'results': results}
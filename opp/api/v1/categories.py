@@ -1,16 +1,17 @@
+import six
+
 from opp.api.v1 import base_handler
 from opp.db import api, models
-from opp.common import aescipher
 
 
 class ResponseHandler(base_handler.BaseResponseHandler):
 
     def _do_get(self, phrase):
         response = []
-        cipher = aescipher.AESCipher(phrase)
+        self._init_ciphers(phrase)
         categories = api.category_getall(session=self.session)
         for category in categories:
-            response.append(category.extract(cipher))
+            response.append(category.extract(self._row_cipher(category)))
 
         return {'result': "success", 'categories': response}
 
@@ -19,20 +20,24 @@ class ResponseHandler(base_handler.BaseResponseHandler):
         if error:
             return error
 
-        cipher = aescipher.AESCipher(phrase)
-        categories = []
+        self._init_ciphers(phrase)
         for cat in cat_list:
             # Check for empty category name
             if not cat:
                 return self.error("Empty category name in list!")
-            try:
-                blob = cipher.encrypt(cat)
-                categories.append(models.Category(name=blob))
-            except TypeError:
+            if not isinstance(cat, six.string_types):
                 return self.error("Invalid category name in list!")
+        # Encrypted once the categories have ids to bind them to
+        categories = [models.Category(name="", key_version=self.key_version)
+                      for _ in cat_list]
+
+        def encrypt():
+            for category, name in zip(categories, cat_list):
+                category.encrypt(self.cipher, name)
 
         try:
-            api.category_create(categories, session=self.session)
+            api.category_create(categories, session=self.session,
+                                on_ids=encrypt)
             return {'result': "success"}
         except Exception:
             return self.error("Unable to add new categories to the database!")
@@ -42,7 +47,7 @@ class ResponseHandler(base_handler.BaseResponseHandler):
         if error:
             return error
 
-        cipher = aescipher.AESCipher(phrase)
+        self._init_ciphers(phrase)
         categories = []
         for cat in cat_list:
             # Make sure category id is parsed from request
@@ -62,9 +67,11 @@ class ResponseHandler(base_handler.BaseResponseHandler):
                 return self.error("Empty category name in list!")
 
             try:
-                blob = cipher.encrypt(category)
-                categories.append(models.Category(id=cat_id, name=blob))
-            except TypeError:
+                row = models.Category(id=int(cat_id),
+                                      key_version=self.key_version)
+                row.encrypt(self.cipher, category)
+                categories.append(row)
+            except (TypeError, ValueError):
                 return self.error("Invalid category name in list!")
 
         try:
@@ -1,7 +1,5 @@
-import base64
-
 from opp.api.v1 import base_handler
-from opp.common import aescipher
+from opp.common import blindindex
 from opp.db import api, models
 
 
@@ -16,30 +14,69 @@ class ResponseHandler(base_handler.BaseResponseHandler):
             return ""
         return value
 
-    def _chunk6(self, string):
-        chunk = int(len(string) / 6)
-        chunks = []
-        for i in range(0, 5):
-            chunks.append(string[chunk * i: chunk * (i + 1)])
-        chunks.append(string[chunk * 5:])
-        return chunks
+    def _parse_filters(self):
+        """Parse the category filter and pagination query arguments.
+
+        'category_id' may be repeated or comma separated and accepts
+        'uncategorized' for items without a category.
+        """
+        category_ids = []
+        for value in self.request.args.getlist('category_id'):
+            for category_id in value.split(','):
+                category_id = category_id.strip()
+                if category_id == "uncategorized":
+                    category_ids.append(None)
+                    continue
+                try:
+                    category_ids.append(int(category_id))
+                except ValueError:
+                    return None, self.error("Invalid category id!")
+
+        filters = {'category_ids': category_ids}
+        for arg in ('marker', 'limit'):
+            value = self.request.args.get(arg)
+            if value is None:
+                continue
+            try:
+                value = int(value)
+            except ValueError:
+                value = -1
+            if value < 0 or (arg == 'limit' and value == 0):
+                return None, self.error("Invalid %s!" % arg)
+            filters[arg] = value
+        return filters, None
 
     def _do_get(self, phrase):
+        filters, error = self._parse_filters()
+        if error:
+            return error
+
+        # Fetch one extra item to find out whether there is another page
+        limit = filters.get('limit')
+        if limit:
+            filters['limit'] = limit + 1
+
         response = []
-        cipher = aescipher.AESCipher(phrase)
-        items = api.item_getall(session=self.session)
-        for item in items:
-            response.append(item.extract(cipher))
+        self._init_ciphers(phrase)
+        items = api.item_getall(session=self.session, **filters)
+        for item in items[:limit]:
+            response.append(item.extract(
+                self._row_cipher(item), self._row_cipher(item.category)))
 
-        return {'result': 'success', 'items': response}
+        response = {'result': 'success', 'items': response}
+        if limit and len(items) > limit:
+            response['next_marker'] = items[limit - 1].id
+        return response
 
     def _do_put(self, phrase):
         item_list, error = self._check_payload(expect_list=True)
         if error:
             return error
 
-        cipher = aescipher.AESCipher(phrase)
+        self._init_ciphers(phrase)
+        index_key = self._index_key()
         items = []
+        encoded_rows = []
         for row in item_list:
             # Extract various item data into a list
             name = self._parse_or_set_empty(row, 'name')
@@ -48,24 +85,31 @@ class ResponseHandler(base_handler.BaseResponseHandler):
             username = self._parse_or_set_empty(row, 'username')
             password = self._parse_or_set_empty(row, 'password')
             blob = self._parse_or_set_empty(row, 'blob')
-            category_id = self._parse_or_set_empty(row, 'category_id')
+            category_id = row.get('category_id') or None
             full_row = [name, url, account, username, password, blob]
 
             try:
                 # TODO: (alex) deteremine if ok to insert completely empty item
-                encoded_row = [base64.b64encode(x.encode()).decode() for
-                               x in full_row]
-                encrypted_blob = cipher.encrypt("~".join(encoded_row))
-                [name, url, account, username, password, blob] = self._chunk6(
-                    encrypted_blob.decode())
-                items.append(models.Item(name=name, url=url, account=account,
-                                         username=username, password=password,
-                                         blob=blob, category_id=category_id))
+                encoded_rows.append(models.encode_item(full_row))
+                # Encrypted once the item has an id to bind it to
+                item = models.Item(category_id=category_id,
+                                   key_version=self.key_version, blob="")
+                if index_key:
+                    item.tokens = [models.ItemToken(token=token) for token in
+                                   blindindex.item_tokens(index_key, name, url,
+                                                          self._suffixes())]
+                items.append(item)
             except (AttributeError, TypeError):
                 return self.error("Invalid item data in list!")
 
+        def encrypt():
+            for item, encoded in zip(items, encoded_rows):
+                for column, value in models.seal_item(
+                        self.cipher, encoded, item.id).items():
+                    setattr(item, column, value)
+
         try:
-            api.item_create(items, session=self.session)
+            api.item_create(items, session=self.session, on_ids=encrypt)
             return {'result': "success"}
         except Exception:
             return self.error("Unable to add new items to the database!")
@@ -75,8 +119,10 @@ class ResponseHandler(base_handler.BaseResponseHandler):
         if error:
             return error
 
-        cipher = aescipher.AESCipher(phrase)
+        self._init_ciphers(phrase)
+        index_key = self._index_key()
         items = []
+        tokens = {}
         for row in item_list:
             # Make sure item id is parsed from request
             try:
@@ -93,25 +139,26 @@ class ResponseHandler(base_handler.BaseResponseHandler):
             username = self._parse_or_set_empty(row, 'username')
             password = self._parse_or_set_empty(row, 'password')
             blob = self._parse_or_set_empty(row, 'blob')
-            category_id = self._parse_or_set_empty(row, 'category_id')
+            category_id = row.get('category_id') or None
             full_row = [name, url, account, username, password, blob]
 
             try:
                 # TODO: (alex) deteremine if ok to insert completely empty item
-                encoded_row = [base64.b64encode(x.encode()).decode() for
-                               x in full_row]
-                encrypted_blob = cipher.encrypt("~".join(encoded_row))
-                [name, url, account, username, password, blob] = self._chunk6(
-                    encrypted_blob.decode())
-                items.append(models.Item(id=item_id, name=name, url=url,
-                                         account=account, username=username,
-                                         password=password, blob=blob,
-                                         category_id=category_id))
-            except (AttributeError, TypeError):
+                item_id = int(item_id)
+                columns = models.encrypt_item(self.cipher, full_row, item_id)
+                items.append(models.Item(id=item_id, category_id=category_id,
+                                         key_version=self.key_version,
+                                         **columns))
+                # Drop stale tokens even when the index is disabled, the
+                # item is then re-indexed once it is enabled again
+                tokens[item_id] = (blindindex.item_tokens(
+                    index_key, name, url, self._suffixes())
+                    if index_key else ())
+            except (AttributeError, TypeError, ValueError):
                 return self.error("Invalid item data in list!")
 
         try:
-            api.item_update(items, session=self.session)
+            api.item_update(items, session=self.session, tokens=tokens)
             return {'result': "success"}
         except Exception:
             return self.error("Unable to update items in the database!")
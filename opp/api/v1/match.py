@@ -0,0 +1,36 @@
+from opp.api.v1 import search
+from opp.common import blindindex
+from opp.db import api
+
+
+class ResponseHandler(search.ResponseHandler):
+
+    def _do_get(self, phrase):
+        origin = self.request.args.get('origin')
+        if not origin or not blindindex.host(origin):
+            return self.error("Missing or invalid origin!")
+
+        self._init_ciphers(phrase)
+        index_key = self._index_key()
+        suffixes = self._suffixes()
+        if index_key:
+            self._index_missing(index_key)
+            ids = api.item_search(
+                blindindex.origin_tokens(index_key, origin, suffixes),
+                None, session=self.session)
+            items = api.item_getall(ids, session=self.session) if ids else []
+        else:
+            items = api.item_getall(session=self.session)
+
+        matches = []
+        for item in items:
+            extracted = item.extract(self._row_cipher(item),
+                                     self._row_cipher(item.category))
+            rank = blindindex.origin_rank(origin, extracted['url'],
+                                          suffixes)
+            if rank is not None:
+                matches.append((rank, extracted['id'], extracted))
+        # Items for the exact host come first
+        matches.sort(key=lambda match: match[:2])
+        return {'result': "success",
+                'items': [match[2] for match in matches]}
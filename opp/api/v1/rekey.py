@@ -0,0 +1,33 @@
+from opp.api.v1 import base_handler
+from opp.db import api
+
+
+class ResponseHandler(base_handler.BaseResponseHandler):
+
+    def _do_post(self, phrase):
+        payload, error = self._check_payload(expect_list=False)
+        if error:
+            return error
+
+        # Extract required new passphrase field
+        try:
+            new_phrase = payload['new_phrase']
+        except KeyError:
+            return self.error("Missing new passphrase!")
+        if not new_phrase:
+            return self.error("Empty new passphrase!")
+
+        # Only the data key is re-wrapped, the vault itself is untouched
+        key = self._data_key(phrase)
+        if key is None:
+            return self.error("Re-key in progress, finish it with "
+                              "opp-db rekey!")
+        data_key = api.data_key_get_by_user_id(self.user.id,
+                                               session=self.session)
+        self._wrap_data_key(data_key, new_phrase, key)
+        try:
+            api.data_key_update(data_key, session=self.session)
+        except Exception:
+            return self.error("Unable to re-key the database!")
+        base_handler.DATA_KEYS.invalidate(self.user.id)
+        return {'result': "success"}
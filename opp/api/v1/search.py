@@ -0,0 +1,66 @@
+import time
+
+from opp.api.v1 import base_handler
+from opp.common import blindindex
+from opp.db import api
+
+
+# Blind index markers mapped to when this process next looks for items
+# missing their tokens
+BACKFILLS = {}
+BACKFILL_INTERVAL = 60
+
+
+class ResponseHandler(base_handler.BaseResponseHandler):
+
+    def _index_missing(self, index_key):
+        """Index items written without their tokens.
+
+        The API indexes items as it writes them, but items may also be
+        written while the index was disabled, or by ``opp-db seed`` and
+        ``opp-db restore``, or be unreadable with the passphrase of a
+        request during a re-key. This looks for them at most every
+        BACKFILL_INTERVAL seconds.
+        """
+        marker = blindindex.marker(index_key)
+        if BACKFILLS.get(marker, 0) > time.time():
+            return
+        tokens = {}
+        for item in api.item_get_unindexed(marker, session=self.session):
+            try:
+                extracted = item.extract(self._row_cipher(item))
+            except (base_handler.OldPassphraseRequired,
+                    TypeError, ValueError):
+                # Not readable with the passphrase(s) of this request
+                continue
+            tokens[item.id] = blindindex.item_tokens(
+                index_key, extracted['name'], extracted['url'],
+                self._suffixes())
+        api.item_token_replace(tokens, session=self.session)
+        BACKFILLS[marker] = time.time() + BACKFILL_INTERVAL
+
+    def _do_get(self, phrase):
+        query = self.request.args.get('q')
+        if not query or not blindindex.query_value(query):
+            return self.error("Missing search query!")
+
+        self._init_ciphers(phrase)
+        index_key = self._index_key()
+        # Queries shorter than a trigram have no tokens to look up
+        if (index_key and
+                len(blindindex.query_value(query)) >= blindindex.NGRAM):
+            self._index_missing(index_key)
+            exact, grams = blindindex.query_tokens(index_key, query)
+            ids = api.item_search(exact, grams, session=self.session)
+            items = api.item_getall(ids, session=self.session) if ids else []
+        else:
+            # Without the index, at least spare clients the full download
+            items = api.item_getall(session=self.session)
+
+        response = []
+        for item in items:
+            extracted = item.extract(self._row_cipher(item),
+                                     self._row_cipher(item.category))
+            if blindindex.matches(query, extracted['name'], extracted['url']):
+                response.append(extracted)
+        return {'result': "success", 'items': response}
@@ -28,7 +28,7 @@ class ResponseHandler(base_handler.BaseResponseHandler):
             user = api.user_get_by_username(username, session=self.session)
             if user:
                 return self.error("User already exists!")
-            hashed = utils.hashpw(password)
+            hashed = utils.hashpw(password, utils.bcrypt_rounds(self.conf))
             user = models.User(username=username, password=hashed)
             api.user_create(user, session=self.session)
             return {'result': "success"}
@@ -62,14 +62,20 @@ class ResponseHandler(base_handler.BaseResponseHandler):
         if not new_password:
             return self.error("Empty new password!")
 
+        self._throttle_login(username)
         try:
             user = api.user_get_by_username(username, session=self.session)
             if not user:
+                self._login_failed(username)
                 return self.error("User doesn't exist!")
             if not utils.checkpw(old_password, user.password):
+                self._login_failed(username)
                 return self.error("Invalid password!")
-            user.password = utils.hashpw(new_password)
+            user.password = utils.hashpw(new_password,
+                                         utils.bcrypt_rounds(self.conf))
             api.user_update(user, session=self.session)
+            # Sessions must log in again with the new password
+            api.refresh_token_revoke_user(user.id, session=self.session)
             return {'result': "success"}
         except Exception:
             return self.error("Unable to update user in the database!")
@@ -93,11 +99,14 @@ class ResponseHandler(base_handler.BaseResponseHandler):
         if not password:
             return self.error("Empty password!")
 
+        self._throttle_login(username)
         try:
             user = api.user_get_by_username(username, session=self.session)
             if not user:
+                self._login_failed(username)
                 return self.error("User doesn't exist!")
             if not utils.checkpw(password, user.password):
+                self._login_failed(username)
                 return self.error("Invalid password!")
             api.user_delete_by_username(username, session=self.session)
             return {'result': "success"}
@@ -1,8 +1,11 @@
 import base64
 import hashlib
+import os
 
-from Crypto.Cipher import AES
-from Crypto import Random
+import six
+
+# PyCrypto and cryptography are imported on first use, they are a
+# significant part of the application's import time
 
 
 BS = 16
@@ -13,7 +16,13 @@ def pad(s):
 
 
 def unpad(s):
-    return s[0:-ord(s.decode()[-1])]
+    return s[0:-ord(s[-1:])]
+
+
+def generate_key():
+    """Generate a random key suitable for AEADCipher(key, raw=True)."""
+    from Crypto import Random
+    return Random.new().read(32)
 
 
 # Usage:
@@ -21,19 +30,128 @@ def unpad(s):
 #   encrypted = cipher.encrypt('My Secret Message')
 #   decrypted = cipher.decrypt(encrypted)
 class AESCipher(object):
-    """AES cipher utility class for encrypting/decrypting data."""
+    """AES cipher utility class for encrypting/decrypting data.
 
-    def __init__(self, key):
-        self.key = hashlib.sha256(key.encode('utf-8')).digest()
+    The key is derived from a passphrase, unless raw is set, in which case
+    it must be a 32 byte key, e.g. one returned by generate_key().
+    """
+
+    def __init__(self, key, raw=False):
+        if raw:
+            self.key = key
+        else:
+            self.key = hashlib.sha256(key.encode('utf-8')).digest()
 
     def encrypt(self, raw):
+        from Crypto.Cipher import AES
+        from Crypto import Random
         raw = pad(raw)
         iv = Random.new().read(AES.block_size)
         cipher = AES.new(self.key, AES.MODE_CBC, iv)
         return base64.b64encode(iv + cipher.encrypt(raw))
 
-    def decrypt(self, enc):
+    def decrypt(self, enc, aad=None):
+        # CBC ciphertexts are not bound to associated data
+        from Crypto.Cipher import AES
         enc = base64.b64decode(enc)
         iv = enc[:16]
         cipher = AES.new(self.key, AES.MODE_CBC, iv)
         return unpad(cipher.decrypt(enc[16:])).decode()
+
+
+# Ciphertext prefixes of the AEAD algorithms. They are not part of the
+# base64 alphabet, which tells them apart from legacy AESCipher output.
+AEAD_ALGORITHMS = {b"g1:": "AESGCM",
+                   b"c1:": "ChaCha20Poly1305"}
+# Prefixes of ciphertexts bound to associated data, mapped to the prefix
+# of their algorithm
+BOUND_PREFIXES = {b"g2:": b"g1:",
+                  b"c2:": b"c1:"}
+_BOUND_PREFIX_OF = dict((unbound, bound) for bound, unbound in
+                        BOUND_PREFIXES.items())
+NONCE_SIZE = 12
+
+
+def _aead_context(prefix, key):
+    from cryptography.hazmat.primitives.ciphers import aead
+    return getattr(aead, AEAD_ALGORITHMS[prefix])(key)
+
+
+def is_aead(enc):
+    """Return whether a ciphertext was produced by AEADCipher."""
+    if not isinstance(enc, bytes):
+        enc = enc.encode()
+    return enc[:3] in AEAD_ALGORITHMS or enc[:3] in BOUND_PREFIXES
+
+
+# Usage:
+#   cipher = aescipher.AEADCipher('secret passphrase')
+#   encrypted = cipher.encrypt('My Secret Message', b'items/1')
+#   decrypted = cipher.decrypt(encrypted, b'items/1')
+class AEADCipher(object):
+    """Authenticated cipher utility class for encrypting/decrypting data.
+
+    Uses AES-GCM (or ChaCha20-Poly1305), so no padding is needed and
+    tampered ciphertexts are rejected with a ValueError. Ciphertexts carry
+    a version prefix; ones without it were produced by AESCipher and are
+    decrypted with CBC for backwards compatibility. The key is handled as
+    for AESCipher.
+
+    Ciphertexts may be bound to associated data, e.g. the table, row and
+    column they are stored in, so they can not be moved elsewhere. Such
+    ciphertexts have a prefix of their own, and only decrypt with the same
+    associated data. Ones without are decrypted regardless of it.
+    """
+
+    def __init__(self, key, raw=False, prefix=b"g1:"):
+        if raw:
+            self.key = key
+        else:
+            self.key = hashlib.sha256(key.encode('utf-8')).digest()
+        self.prefix = prefix
+        self.bound_prefix = _BOUND_PREFIX_OF[prefix]
+        self._aead = _aead_context(prefix, self.key)
+        self._contexts = {prefix: self._aead}
+        self._legacy = None
+
+    def _context(self, prefix):
+        try:
+            return self._contexts[prefix]
+        except KeyError:
+            context = _aead_context(prefix, self.key)
+            self._contexts[prefix] = context
+            return context
+
+    def encrypt(self, raw, aad=None):
+        """Encrypt a string, bound to the associated data if given."""
+        if not isinstance(raw, six.string_types):
+            raise TypeError("Only strings can be encrypted")
+        nonce = os.urandom(NONCE_SIZE)
+        prefix = self.prefix if aad is None else self.bound_prefix
+        return prefix + base64.b64encode(
+            nonce + self._aead.encrypt(nonce, raw.encode('utf-8'), aad))
+
+    def decrypt(self, enc, aad=None):
+        from cryptography.exceptions import InvalidTag
+        if not isinstance(enc, bytes):
+            enc = enc.encode()
+        prefix = enc[:3]
+        if prefix in BOUND_PREFIXES:
+            prefix = BOUND_PREFIXES[prefix]
+            if aad is None:
+                raise ValueError("Unable to decrypt, associated data "
+                                 "missing")
+        elif prefix in AEAD_ALGORITHMS:
+            # Written before rows were bound to their location
+            aad = None
+        else:
+            if self._legacy is None:
+                self._legacy = AESCipher(self.key, raw=True)
+            return self._legacy.decrypt(enc)
+        enc = base64.b64decode(enc[3:])
+        try:
+            raw = self._context(prefix).decrypt(enc[:NONCE_SIZE],
+                                                enc[NONCE_SIZE:], aad)
+        except InvalidTag:
+            raise ValueError("Unable to decrypt, wrong key or tampered data")
+        return raw.decode('utf-8')
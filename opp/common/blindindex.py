@@ -0,0 +1,219 @@
+"""Blind index of item names and hosts for server-side search.
+
+Tokens are keyed HMACs of normalized values and their trigrams, so the
+database can match search queries without learning the values themselves.
+It does learn which items share tokens, hence the index is optional.
+"""
+import hashlib
+import hmac
+import io
+import logging
+
+from six.moves.urllib.parse import urlsplit
+
+
+NGRAM = 3
+TOKEN_SIZE = 32
+# Bumped whenever item_tokens() changes, so items get re-indexed
+INDEX_VERSION = "3"
+
+
+class PublicSuffixList(object):
+    """Rules of the Public Suffix List, see https://publicsuffix.org/.
+
+    The private section of the list must be included, so that e.g. each
+    site under github.io or herokuapp.com is a registrable domain of its
+    own rather than sharing one with all other tenants.
+
+    :param lines: lines of the list
+    """
+
+    def __init__(self, lines):
+        self.rules = set()
+        self.wildcards = set()
+        self.exceptions = set()
+        for line in lines:
+            fields = line.split()
+            if not fields or fields[0].startswith("//"):
+                continue
+            rule = fields[0].lower()
+            for form in self._forms(rule.lstrip("!")):
+                if rule.startswith("!"):
+                    self.exceptions.add(form)
+                elif form.startswith("*."):
+                    self.wildcards.add(form[2:])
+                else:
+                    self.rules.add(form)
+
+    @staticmethod
+    def _forms(rule):
+        # Host names of URLs may be in either form of internationalized
+        # domain names
+        forms = [rule]
+        try:
+            labels = [label if label == "*" else label.encode(
+                'idna').decode('ascii') for label in rule.split(".")]
+            forms.append(".".join(labels))
+        except UnicodeError:
+            pass
+        return forms
+
+    @classmethod
+    def load(cls, filepath):
+        with io.open(filepath, encoding='utf-8') as f:
+            return cls(f)
+
+    def suffix_labels(self, labels):
+        """Return the number of labels of the public suffix of a host."""
+        # The longest matching rule prevails. Exception rules are always
+        # longer than the wildcard rules they are an exception to.
+        for i in range(len(labels)):
+            candidate = ".".join(labels[i:])
+            if candidate in self.exceptions:
+                return len(labels) - i - 1
+            if (candidate in self.rules or
+                    ".".join(labels[i + 1:]) in self.wildcards):
+                return len(labels) - i
+        return 1
+
+    def registrable_domain(self, hostname):
+        labels = hostname.split(".")
+        count = self.suffix_labels(labels) + 1
+        if count > len(labels):
+            return None
+        return ".".join(labels[-count:])
+
+
+_SUFFIX_LISTS = {}
+
+
+def public_suffixes(filepath):
+    """Return the cached PublicSuffixList of a file, None if unreadable."""
+    try:
+        return _SUFFIX_LISTS[filepath]
+    except KeyError:
+        pass
+    suffixes = None
+    if filepath:
+        try:
+            suffixes = PublicSuffixList.load(filepath)
+        except (IOError, OSError, UnicodeError) as e:
+            logging.warning("Unable to load the public suffix list: %s. "
+                            "Items only match origins of their exact "
+                            "host.", str(e))
+    _SUFFIX_LISTS[filepath] = suffixes
+    return suffixes
+
+
+def index_key(key):
+    """Derive the index key from a data key, keeping the two independent."""
+    return hmac.new(key, b"opp-blind-index", hashlib.sha256).digest()
+
+
+def normalize(value):
+    return " ".join(value.lower().split())
+
+
+def host(url):
+    """Return the lower case host name of a URL, without a 'www.' prefix."""
+    url = url.strip().lower()
+    if not url:
+        return ""
+    if "//" not in url:
+        url = "//" + url
+    try:
+        hostname = urlsplit(url).hostname or ""
+    except ValueError:
+        return ""
+    if hostname.startswith("www."):
+        hostname = hostname[4:]
+    return hostname
+
+
+def registrable_domain(hostname, suffixes):
+    """Return the domain a host name is registered under, e.g. example.co.uk
+    for mail.example.co.uk.
+
+    Returns None for IP addresses, public suffixes themselves and if there
+    is no public suffix list, i.e. ``suffixes`` is None.
+    """
+    if (suffixes is None or not hostname or ":" in hostname or
+            hostname.split(".")[-1].isdigit()):
+        return None
+    return suffixes.registrable_domain(hostname)
+
+
+def ngrams(value):
+    return set(value[i:i + NGRAM] for i in range(len(value) - NGRAM + 1))
+
+
+def _token(key, kind, value):
+    return hmac.new(key, (kind + ":" + value).encode('utf-8'),
+                    hashlib.sha256).hexdigest()[:TOKEN_SIZE]
+
+
+def marker(key):
+    """Token present for every item indexed under the given key."""
+    return _token(key, "i", INDEX_VERSION)
+
+
+def item_tokens(key, name, url, suffixes=None):
+    tokens = set([marker(key)])
+    hostname = host(url)
+    for value in (normalize(name), hostname):
+        if value:
+            tokens.add(_token(key, "w", value))
+            tokens.update(_token(key, "t", gram) for gram in ngrams(value))
+    if hostname:
+        tokens.add(_token(key, "h", hostname))
+        domain = registrable_domain(hostname, suffixes)
+        if domain:
+            tokens.add(_token(key, "d", domain))
+    return tokens
+
+
+def query_value(query):
+    """Normalize a search query, reducing URLs to their host."""
+    query = normalize(query)
+    if "://" in query or query.startswith("www."):
+        return host(query)
+    return query
+
+
+def query_tokens(key, query):
+    """Return (exact tokens, tokens all of which a match must have)."""
+    value = query_value(query)
+    return ([_token(key, "w", value)],
+            [_token(key, "t", gram) for gram in ngrams(value)])
+
+
+def matches(query, name, url):
+    """Check a decrypted item against a query, weeding out false hits."""
+    value = query_value(query)
+    return bool(value) and (value in normalize(name) or value in host(url))
+
+
+def origin_tokens(key, origin, suffixes=None):
+    """Return the tokens of items matching an origin, by host or domain."""
+    hostname = host(origin)
+    if not hostname:
+        return []
+    tokens = [_token(key, "h", hostname)]
+    domain = registrable_domain(hostname, suffixes)
+    if domain:
+        tokens.append(_token(key, "d", domain))
+    return tokens
+
+
+def origin_rank(origin, url, suffixes=None):
+    """Rank an item URL against an origin: 0 for the same host, 1 for the
+    same registrable domain, None if it does not match."""
+    hostname, item_host = host(origin), host(url)
+    if not hostname or not item_host:
+        return None
+    if hostname == item_host:
+        return 0
+    domain = registrable_domain(hostname, suffixes)
+    if domain and domain == registrable_domain(item_host, suffixes):
+        return 1
+    return None
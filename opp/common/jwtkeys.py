@@ -0,0 +1,216 @@
+"""Asymmetric JWT signing keys with rotation, see the jwt_key_dir option.
+
+Keys are PEM files in a directory, named after their key id (kid):
+``<kid>.pem`` holds a private key, which signs and verifies tokens, while
+``<kid>.pub.pem`` holds the public key of a retired signing key, which
+only verifies them. Tokens carry the kid of their signing key in their
+header, so keys can be added and retired without invalidating the tokens
+of other keys.
+"""
+import base64
+import binascii
+import logging
+import os
+import threading
+import time
+
+
+# Key types per JWT algorithm family
+KEY_TYPES = {'RS': 'RSA', 'PS': 'RSA', 'ES': 'EC'}
+
+# JWK names of the supported elliptic curves
+CURVES = {'secp256r1': "P-256", 'secp384r1': "P-384", 'secp521r1': "P-521"}
+
+PUBLIC_SUFFIX = ".pub.pem"
+PRIVATE_SUFFIX = ".pem"
+
+
+class KeyRingError(Exception):
+    pass
+
+
+def key_type(algorithm):
+    """Return the key type of an asymmetric algorithm, None for HMAC."""
+    return KEY_TYPES.get(algorithm[:2])
+
+
+def _b64(number, length=None):
+    value = "%x" % number
+    if length:
+        value = value.zfill(length * 2)
+    elif len(value) % 2:
+        value = "0" + value
+    raw = binascii.unhexlify(value.encode())
+    return base64.urlsafe_b64encode(raw).rstrip(b"=").decode()
+
+
+def _load(path, private):
+    from cryptography.hazmat.backends import default_backend
+    from cryptography.hazmat.primitives import serialization
+
+    with open(path, 'rb') as f:
+        data = f.read()
+    try:
+        if private:
+            return serialization.load_pem_private_key(
+                data, password=None, backend=default_backend())
+        return serialization.load_pem_public_key(
+            data, backend=default_backend())
+    except (TypeError, ValueError) as e:
+        raise KeyRingError("Unable to load key %s: %s" % (path, str(e)))
+
+
+def _key_type(key):
+    from cryptography.hazmat.primitives.asymmetric import ec, rsa
+
+    if isinstance(key, (rsa.RSAPrivateKey, rsa.RSAPublicKey)):
+        return 'RSA'
+    if isinstance(key, (ec.EllipticCurvePrivateKey,
+                        ec.EllipticCurvePublicKey)):
+        return 'EC'
+    return None
+
+
+class KeyRing(object):
+    """Signing and verification keys of a key directory.
+
+    Parsed keys are kept in memory. The directory is checked for added,
+    changed or removed files at most every ``refresh_interval`` seconds,
+    and only those files are parsed again. A token with an unknown kid
+    may have been signed by another process which already picked up a new
+    key, so it triggers a check too, at most every ``miss_interval``
+    seconds.
+
+    :param signing_kid: kid of the signing key, by default the most
+                        recently modified private key signs
+    """
+
+    def __init__(self, key_dir, algorithm, signing_kid=None,
+                 refresh_interval=60, miss_interval=1):
+        if not key_type(algorithm):
+            raise KeyRingError("Algorithm %s does not use a key pair" %
+                               algorithm)
+        if not key_dir or not os.path.isdir(key_dir):
+            raise KeyRingError("JWT key directory %s not found" % key_dir)
+        self.key_dir = key_dir
+        self.algorithm = algorithm
+        self.signing_kid = signing_kid
+        self.refresh_interval = refresh_interval
+        self.miss_interval = miss_interval
+        self._files = {}
+        self._keys = {}
+        self._signing = None
+        self._refreshed = None
+        self._lock = threading.Lock()
+        self.refresh(force=True)
+
+    def _scan(self):
+        files = {}
+        for name in os.listdir(self.key_dir):
+            if name.endswith(PUBLIC_SUFFIX):
+                kid, private = name[:-len(PUBLIC_SUFFIX)], False
+            elif name.endswith(PRIVATE_SUFFIX):
+                kid, private = name[:-len(PRIVATE_SUFFIX)], True
+            else:
+                continue
+            path = os.path.join(self.key_dir, name)
+            mtime = os.stat(path).st_mtime
+            cached = self._files.get(path)
+            if cached and cached[0] == mtime:
+                key = cached[3]
+            else:
+                key = _load(path, private)
+                if _key_type(key) != key_type(self.algorithm):
+                    raise KeyRingError("Key %s can not be used with %s" %
+                                       (path, self.algorithm))
+            files[path] = (mtime, kid, private, key)
+        return files
+
+    def refresh(self, force=False, interval=None):
+        """Pick up key files changed since the last refresh.
+
+        Errors are raised when forced, otherwise they are logged and the
+        previously loaded keys stay in use.
+
+        :param interval: seconds since the last refresh after which to
+                         refresh, ``refresh_interval`` by default
+        """
+        now = time.time()
+        if interval is None:
+            interval = self.refresh_interval
+        if (not force and self._refreshed is not None and
+                now - self._refreshed < interval):
+            return
+        try:
+            self._refresh(now)
+        except (KeyRingError, OSError) as e:
+            if force:
+                raise
+            logging.error("Unable to refresh JWT keys: %s", str(e))
+            self._refreshed = now
+
+    def _refresh(self, now):
+        with self._lock:
+            files = self._scan()
+            keys = {}
+            newest = None
+            for mtime, kid, private, key in files.values():
+                if private:
+                    keys[kid] = key.public_key()
+                    if newest is None or (mtime, kid) > newest[:2]:
+                        newest = (mtime, kid, key)
+                else:
+                    keys.setdefault(kid, key)
+
+            if self.signing_kid:
+                signing = [(kid, key) for _, kid, private, key in
+                           files.values() if private and
+                           kid == self.signing_kid]
+                if not signing:
+                    raise KeyRingError("Signing key %s not found in %s" %
+                                       (self.signing_kid, self.key_dir))
+                signing = signing[0]
+            elif newest:
+                signing = newest[1:]
+            else:
+                raise KeyRingError("No private key found in %s" %
+                                   self.key_dir)
+
+            self._files = files
+            self._keys = keys
+            self._signing = signing
+            self._refreshed = now
+
+    def signing_key(self):
+        """Return the kid and private key new tokens are signed with."""
+        self.refresh()
+        return self._signing
+
+    def public_key(self, kid):
+        """Return the public key with the given kid, or None."""
+        self.refresh()
+        key = self._keys.get(kid)
+        if key is None and kid is not None:
+            self.refresh(interval=self.miss_interval)
+            key = self._keys.get(kid)
+        return key
+
+    def jwks(self):
+        """Return the public keys as a JSON Web Key Set."""
+        self.refresh()
+        keys = []
+        for kid, key in sorted(self._keys.items()):
+            jwk = {'kid': kid, 'use': "sig", 'alg': self.algorithm}
+            numbers = key.public_numbers()
+            if _key_type(key) == 'RSA':
+                jwk.update({'kty': "RSA", 'n': _b64(numbers.n),
+                            'e': _b64(numbers.e)})
+            else:
+                length = (key.curve.key_size + 7) // 8
+                jwk.update({'kty': "EC",
+                            'crv': CURVES.get(key.curve.name,
+                                              key.curve.name),
+                            'x': _b64(numbers.x, length),
+                            'y': _b64(numbers.y, length)})
+            keys.append(jwk)
+        return {'keys': keys}
@@ -0,0 +1,47 @@
+import base64
+import hashlib
+import os
+
+from opp.common import opp_config
+
+
+SALT_SIZE = 16
+KEY_SIZE = 32
+
+
+def default_params(conf=None):
+    """Return the KDF parameter string new keys should be derived with.
+
+    scrypt is used where the Python build provides it, PBKDF2 otherwise.
+    Costs are tunable via the 'kdf_scrypt_n' and 'kdf_pbkdf2_iterations'
+    config options.
+    """
+    conf = conf or opp_config.OppConfig()
+    if hasattr(hashlib, 'scrypt'):
+        return "scrypt$%d$8$1" % int(conf['kdf_scrypt_n'])
+    return "pbkdf2$%d" % int(conf['kdf_pbkdf2_iterations'])
+
+
+def generate_salt():
+    return base64.b64encode(os.urandom(SALT_SIZE)).decode()
+
+
+def derive_key(phrase, salt, params):
+    """Derive a 32 byte key from a passphrase.
+
+    :param salt: base64 encoded salt, see generate_salt()
+    :param params: parameter string, see default_params()
+    """
+    phrase = phrase.encode('utf-8')
+    salt = base64.b64decode(salt.encode())
+    name, _, args = params.partition('$')
+    args = [int(arg) for arg in args.split('$')]
+    if name == "scrypt":
+        n, r, p = args
+        # hashlib needs headroom above the 128 * r * n bytes actually used
+        return hashlib.scrypt(phrase, salt=salt, n=n, r=r, p=p,
+                              maxmem=256 * r * n, dklen=KEY_SIZE)
+    if name == "pbkdf2":
+        return hashlib.pbkdf2_hmac('sha256', phrase, salt, args[0],
+                                   KEY_SIZE)
+    raise ValueError("Unknown key derivation function: %s" % name)
@@ -0,0 +1,55 @@
+import hashlib
+import hmac
+import os
+import time
+
+from opp.common import storage
+
+
+class KeyCache(object):
+    """Bounded, expiring LRU cache of unwrapped data keys.
+
+    Entries are looked up by user id and passphrase. The passphrase itself
+    is never stored, only its HMAC under a random per-process secret. An
+    entry may also be tagged, e.g. with the wrapped key it was unwrapped
+    from, and is then only returned for lookups with the same tag, so
+    changes made by other processes take effect immediately.
+
+    Note that keys are not wiped from memory when dropped: every request
+    hands its key to a cipher object, which keeps its own immutable copy
+    until garbage collected.
+    """
+
+    def __init__(self, max_size=1024, ttl=300):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._secret = os.urandom(32)
+        self._entries = storage.LRUCache(max_size)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _mac(self, user_id, phrase):
+        digest = hmac.new(self._secret, phrase.encode('utf-8'),
+                          hashlib.sha256).digest()
+        return (user_id, digest)
+
+    def get(self, user_id, phrase, tag=None):
+        now = time.time()
+        entry = self._entries.get(
+            self._mac(user_id, phrase),
+            valid=lambda entry: entry[1] >= now and entry[2] == tag)
+        return entry[0] if entry else None
+
+    def set(self, user_id, phrase, key, tag=None):
+        now = time.time()
+        with self._entries.lock:
+            self._entries.discard(lambda mac, entry: entry[1] < now)
+            self._entries.set(self._mac(user_id, phrase),
+                              (key, now + self.ttl, tag))
+
+    def clear(self):
+        self._entries.clear()
+
+    def invalidate(self, user_id):
+        self._entries.discard(lambda mac, entry: mac[0] == user_id)
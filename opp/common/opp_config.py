@@ -33,7 +33,29 @@ class OppConfig(object):
         self.def_sec = "DEFAULT"
         cfg_defaults = [
             ['secret_key', "default-insecure"],
-            ['exp_delta', "300"]]
+            ['db_connect_replicas', ""],
+            ['db_replica_write_window', "10"],
+            ['db_replica_write_store', "memory"],
+            ['exp_delta', "300"],
+            ['refresh_exp_delta', "2592000"],
+            ['revocation_refresh_interval', "5"],
+            ['login_rate_limit_username', "20/60"],
+            ['login_rate_limit_ip', "100/60"],
+            ['login_rate_limit_store', "memory"],
+            ['trusted_proxies', "0"],
+            ['frontend_session_store', ""],
+            ['frontend_session_lifetime', "1800"],
+            ['jwt_algorithm', "HS256"],
+            ['bcrypt_rounds', "12"],
+            ['bcrypt_target_ms', "250"],
+            ['kdf_scrypt_n', "16384"],
+            ['kdf_pbkdf2_iterations', "200000"],
+            ['search_index', "false"],
+            ['public_suffix_list',
+             "/usr/share/publicsuffix/public_suffix_list.dat"],
+            ['items_cache_size', "0"],
+            ['items_cache_ttl', "10"],
+            ['asgi_threads', "32"]]
         for opt in cfg_defaults:
             if not self.cfg.has_option(self.def_sec, opt[0]):
                 self.cfg.set(self.def_sec, opt[0], opt[1])
@@ -43,3 +65,9 @@ class OppConfig(object):
             return self.cfg.get(self.def_sec, item)
         except configparser.Error:
             return None
+
+    def getboolean(self, item):
+        try:
+            return self.cfg.getboolean(self.def_sec, item)
+        except (configparser.Error, ValueError):
+            return False
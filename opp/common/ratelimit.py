@@ -0,0 +1,185 @@
+"""Token-bucket rate limiting of login attempts.
+
+Every attempt takes a token from a bucket per client IP, while only failed
+attempts take one from the bucket of their username, so that a user is not
+locked out by their own logins. Buckets hold up to ``capacity`` tokens and
+are refilled at ``capacity`` tokens per ``period`` seconds, so bursts of
+attempts are allowed while the sustained rate is bounded. The check is done
+before the password hash is computed, so a credential-stuffing burst can not
+exhaust the CPU.
+"""
+import logging
+import math
+import sqlite3
+import time
+
+from opp.common import storage
+
+
+class RateLimited(Exception):
+
+    def __init__(self, retry_after):
+        super(RateLimited, self).__init__(
+            "Too many attempts, retry in %d seconds" % retry_after)
+        self.retry_after = retry_after
+
+
+def parse_rule(rule):
+    """Parse a rule such as '10/60' into (capacity, period), None if 0."""
+    capacity, _, period = str(rule).partition('/')
+    capacity = int(capacity)
+    period = float(period or 60)
+    if capacity < 0 or period <= 0:
+        raise ValueError("Invalid rate limit rule: %s" % rule)
+    return (capacity, period) if capacity else None
+
+
+def _take(tokens, updated, capacity, rate, now, cost=1):
+    """Refill a bucket and take ``cost`` tokens from it.
+
+    A cost of 0 only checks whether a token is available.
+
+    :returns: tuple of (remaining tokens, seconds until a token is
+              available, 0 if one was)
+    """
+    tokens = min(capacity, tokens + max(0, now - updated) * rate)
+    if tokens >= 1:
+        return tokens - cost, 0
+    return tokens, (1 - tokens) / rate
+
+
+class MemoryStore(object):
+    """Buckets of the current process, the least recently used of which
+    are dropped beyond ``max_keys``."""
+
+    def __init__(self, max_keys=100000):
+        self.max_keys = max_keys
+        self._buckets = storage.LRUCache(max_keys)
+
+    def take(self, key, capacity, rate, now, cost=1):
+        with self._buckets.lock:
+            tokens, updated = self._buckets.get(key) or (capacity, now)
+            tokens, wait = _take(tokens, updated, capacity, rate, now, cost)
+            self._buckets.set(key, (tokens, now))
+        return wait
+
+
+class SqliteStore(storage.SqliteFile):
+    """Buckets in a SQLite file, see :class:`storage.SqliteFile`.
+
+    Each take is one short write transaction. Buckets not used for a day
+    are purged every ``purge_every`` takes.
+    """
+
+    SCHEMA = ("CREATE TABLE IF NOT EXISTS buckets (key TEXT PRIMARY KEY, "
+              "tokens REAL NOT NULL, updated REAL NOT NULL)")
+
+    def __init__(self, path, timeout=5, purge_every=1000):
+        self.purge_every = purge_every
+        self._takes = 0
+        # Transactions are managed explicitly
+        super(SqliteStore, self).__init__(path, [self.SCHEMA], timeout,
+                                          isolation_level=None)
+
+    def take(self, key, capacity, rate, now, cost=1):
+        conn = self.connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT tokens, updated FROM buckets "
+                               "WHERE key = ?", (key,)).fetchone()
+            tokens, updated = row or (capacity, now)
+            tokens, wait = _take(tokens, updated, capacity, rate, now, cost)
+            conn.execute("INSERT OR REPLACE INTO buckets (key, tokens, "
+                         "updated) VALUES (?, ?, ?)", (key, tokens, now))
+            self._takes += 1
+            if self._takes % self.purge_every == 0:
+                conn.execute("DELETE FROM buckets WHERE updated < ?",
+                             (now - 86400,))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return wait
+
+
+def create_store(url):
+    """Create a store from a URL: 'memory' or 'sqlite:///<path>'."""
+    if url == "memory":
+        return MemoryStore()
+    if url.startswith("sqlite:///"):
+        return SqliteStore(url[len("sqlite:///"):])
+    raise ValueError("Unsupported rate limit store: %s" % url)
+
+
+class RateLimiter(object):
+    """Limit attempts per key type, e.g. per username and per IP.
+
+    :param rules: dict of key type to (capacity, period), or None to not
+                  limit that key type
+    """
+
+    ORDER = ('ip', 'username')
+
+    # Key types charged by failed attempts only
+    FAILURES = ('username',)
+
+    def __init__(self, store, rules):
+        self.store = store
+        self.rules = dict((kind, rule) for kind, rule in rules.items()
+                          if rule)
+
+    def check(self, **keys):
+        """Take a token from the bucket of each given key.
+
+        Buckets of ``FAILURES`` key types are only checked for a token, see
+        :meth:`failed`. Buckets are checked in the order of ``ORDER``, and
+        the first empty one stops the check.
+
+        :raises RateLimited: if any of the buckets is empty
+        """
+        now = time.time()
+        for kind in sorted(keys, key=self._order):
+            cost = 0 if kind in self.FAILURES else 1
+            wait = self._take(kind, keys[kind], now, cost)
+            if wait:
+                raise RateLimited(int(math.ceil(wait)))
+
+    def failed(self, **keys):
+        """Take a token from the bucket of each given ``FAILURES`` key."""
+        now = time.time()
+        for kind in keys:
+            if kind in self.FAILURES:
+                self._take(kind, keys[kind], now, 1)
+
+    def _take(self, kind, value, now, cost):
+        rule = self.rules.get(kind)
+        if rule is None or value is None:
+            return 0
+        capacity, period = rule
+        return self.store.take("%s:%s" % (kind, value), capacity,
+                               capacity / period, now, cost)
+
+    def _order(self, kind):
+        try:
+            return (self.ORDER.index(kind), kind)
+        except ValueError:
+            return (len(self.ORDER), kind)
+
+
+def login_limiter(conf):
+    """Create the login rate limiter configured in an OppConfig."""
+    rules = {}
+    for kind in ('username', 'ip'):
+        option = 'login_rate_limit_%s' % kind
+        try:
+            rules[kind] = parse_rule(conf[option])
+        except (TypeError, ValueError):
+            logging.warning("Invalid value specified for '%s' config "
+                            "option. Login attempts are not limited by %s.",
+                            option, kind)
+    try:
+        store = create_store(conf['login_rate_limit_store'])
+    except (ValueError, sqlite3.Error) as e:
+        logging.warning("%s. Using the in-memory store.", str(e))
+        store = MemoryStore()
+    return RateLimiter(store, rules)
@@ -0,0 +1,79 @@
+"""Bounded LRU cache of serialized API responses, encrypted in memory.
+
+Each entry is encrypted under a key derived from the credentials of the
+request it was cached for, i.e. its JWT and passphrase, and a random
+per-process secret. The credentials themselves are not stored, so the
+cached plaintext can not be recovered from a memory dump, and entries are
+only usable by requests presenting the same credentials. Since access
+tokens are short-lived, so are the keys.
+
+Entries are tagged with a generation, see :func:`opp.db.api.vault_generation`,
+and are discarded once it changes or after ``ttl`` seconds, which bounds
+how long writes through other processes may go unnoticed.
+"""
+import hashlib
+import hmac
+import os
+import time
+
+from opp.common import storage
+
+
+class ResponseCache(object):
+
+    # Estimated memory used by an entry besides its ciphertext
+    ENTRY_OVERHEAD = 200
+
+    def __init__(self, max_bytes, ttl=10):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._secret = os.urandom(32)
+        self._entries = storage.LRUCache(
+            max_bytes, size_of=lambda entry: len(entry[0]) +
+            self.ENTRY_OVERHEAD)
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def size(self):
+        return self._entries.size
+
+    def _keys(self, credentials, variant):
+        """Derive the lookup id and encryption key of an entry."""
+        material = hmac.new(self._secret, b"\0".join(
+            c.encode('utf-8') for c in credentials), hashlib.sha256).digest()
+        entry_id = hmac.new(material, b"id\0" + variant,
+                            hashlib.sha256).digest()
+        key = hmac.new(material, b"key", hashlib.sha256).digest()
+        return entry_id, key
+
+    def get(self, credentials, variant, generation):
+        """Return a cached response, or None.
+
+        :param credentials: tuple of strings identifying the requester
+        :param variant: bytes distinguishing responses to the same
+                        requester, e.g. the query string
+        """
+        from opp.common import aescipher
+
+        entry_id, key = self._keys(credentials, variant)
+        now = time.time()
+        entry = self._entries.get(
+            entry_id,
+            valid=lambda entry: entry[1] == generation and entry[2] >= now)
+        if entry is None:
+            return None
+        return aescipher.AEADCipher(key, raw=True).decrypt(entry[0])
+
+    def set(self, credentials, variant, generation, response):
+        from opp.common import aescipher
+
+        entry_id, key = self._keys(credentials, variant)
+        enc = aescipher.AEADCipher(key, raw=True).encrypt(response)
+        if len(enc) + self.ENTRY_OVERHEAD > self.max_bytes:
+            return
+        self._entries.set(entry_id, (enc, generation, time.time() + self.ttl))
+
+    def clear(self):
+        self._entries.clear()
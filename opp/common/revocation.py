@@ -0,0 +1,53 @@
+import logging
+import threading
+import time
+
+
+class RevocationList(object):
+    """In-memory mirror of the revoked, not yet expired token ids.
+
+    Checking a token is a set lookup. The set is reloaded from the
+    database at most every ``refresh_interval`` seconds, which bounds how
+    long a token revoked by another process remains usable. Tokens revoked
+    by this process are added immediately. Since tokens are short-lived,
+    the set stays small.
+
+    :param loader: callable returning (jti, expiry datetime) pairs of all
+                   unexpired revoked tokens
+    """
+
+    def __init__(self, loader, refresh_interval=5):
+        self.loader = loader
+        self.refresh_interval = refresh_interval
+        self._revoked = frozenset()
+        self._refreshed = None
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._revoked)
+
+    def refresh(self, force=False):
+        if not force and not self._due():
+            return
+        with self._lock:
+            if not force and not self._due():
+                # Refreshed by another thread in the meantime
+                return
+            try:
+                self._revoked = frozenset(jti for jti, _ in self.loader())
+            except Exception as e:
+                # Keep using the previous list rather than failing requests
+                logging.error("Unable to load revoked tokens: %s", str(e))
+            self._refreshed = time.time()
+
+    def _due(self):
+        return (self._refreshed is None or
+                time.time() - self._refreshed >= self.refresh_interval)
+
+    def add(self, jti):
+        with self._lock:
+            self._revoked = self._revoked | frozenset([jti])
+
+    def is_revoked(self, jti):
+        self.refresh()
+        return jti in self._revoked
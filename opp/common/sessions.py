@@ -0,0 +1,230 @@
+"""Server-side storage of login page sessions.
+
+The session cookie only holds a random session id. The session data is
+kept in a store, keyed by the SHA-256 digest of the id, so that reading
+the store does not reveal ids usable to hijack sessions. Sessions expire
+after ``lifetime`` seconds without a request.
+
+Recently used sessions are kept in an in-memory LRU cache, so pages of a
+logged-in browser are served without querying the store. Cached entries
+are trusted for ``cache_ttl`` seconds, which bounds how long a session
+ended through another process remains usable in this one.
+"""
+import base64
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+
+from opp.common import storage
+
+
+def _digest(sid):
+    return hashlib.sha256(sid.encode('utf-8')).hexdigest()
+
+
+class MemoryStore(object):
+    """Sessions of the current process."""
+
+    def __init__(self):
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        return self._sessions.get(key)
+
+    def set(self, key, data, expires):
+        with self._lock:
+            self._sessions[key] = (data, expires)
+
+    def delete(self, key):
+        with self._lock:
+            self._sessions.pop(key, None)
+
+    def purge(self, now):
+        with self._lock:
+            for key, (_, expires) in list(self._sessions.items()):
+                if expires <= now:
+                    del self._sessions[key]
+
+
+class SqliteStore(storage.SqliteFile):
+    """Sessions in a SQLite file, see :class:`storage.SqliteFile`."""
+
+    SCHEMA = ("CREATE TABLE IF NOT EXISTS sessions (key TEXT PRIMARY KEY, "
+              "data TEXT NOT NULL, expires REAL NOT NULL)")
+
+    def __init__(self, path, timeout=5):
+        if not os.path.exists(path):
+            # Sessions hold access tokens, so only the owner may read them
+            os.close(os.open(path, os.O_CREAT | os.O_WRONLY, 0o600))
+        super(SqliteStore, self).__init__(path, [self.SCHEMA], timeout)
+
+    def get(self, key):
+        return self.connection().execute(
+            "SELECT data, expires FROM sessions WHERE key = ?",
+            (key,)).fetchone()
+
+    def set(self, key, data, expires):
+        with self.connection() as conn:
+            conn.execute("INSERT OR REPLACE INTO sessions (key, data, "
+                         "expires) VALUES (?, ?, ?)", (key, data, expires))
+
+    def delete(self, key):
+        with self.connection() as conn:
+            conn.execute("DELETE FROM sessions WHERE key = ?", (key,))
+
+    def purge(self, now):
+        with self.connection() as conn:
+            conn.execute("DELETE FROM sessions WHERE expires <= ?", (now,))
+
+
+class FileStore(object):
+    """Sessions as files of a directory, e.g. on storage shared by several
+    hosts."""
+
+    def __init__(self, directory):
+        if not os.path.isdir(directory):
+            os.makedirs(directory, 0o700)
+        self.directory = directory
+
+    def _path(self, key):
+        return os.path.join(self.directory, key)
+
+    def get(self, key):
+        try:
+            with open(self._path(key)) as f:
+                return tuple(json.load(f))
+        except (IOError, OSError, ValueError):
+            return None
+
+    def set(self, key, data, expires):
+        # Write to a temporary file and rename it, so that readers never
+        # see a partially written session
+        fd, path = tempfile.mkstemp(dir=self.directory, prefix='.')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump([data, expires], f)
+            os.rename(path, self._path(key))
+        except Exception:
+            os.remove(path)
+            raise
+
+    def delete(self, key):
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+    def purge(self, now):
+        for name in os.listdir(self.directory):
+            if name.startswith('.'):
+                continue
+            entry = self.get(name)
+            if entry is None or entry[1] <= now:
+                self.delete(name)
+
+
+def store_url(conf):
+    """Return the session store URL configured in an OppConfig.
+
+    Without one, sessions are kept in a SQLite file next to a SQLite
+    database, so that all worker processes share them, and in memory
+    otherwise.
+    """
+    url = conf['frontend_session_store']
+    if url:
+        return url
+    db_connect = conf['db_connect'] or ""
+    if db_connect.startswith("sqlite:///"):
+        path = db_connect[len("sqlite:///"):].partition('?')[0]
+        if path and path != ":memory:":
+            return "sqlite:///%s" % os.path.join(
+                os.path.dirname(os.path.abspath(path)), "opp_sessions.sqlite")
+    return "memory"
+
+
+def create_store(url):
+    """Create a store from a URL: 'memory', 'sqlite:///<path>' or
+    'file:///<directory>'."""
+    if url == "memory":
+        return MemoryStore()
+    if url.startswith("sqlite:///"):
+        return SqliteStore(url[len("sqlite:///"):])
+    if url.startswith("file:///"):
+        return FileStore(url[len("file://"):])
+    raise ValueError("Unsupported session store: %s" % url)
+
+
+class SessionManager(object):
+    """Load and save sessions with sliding expiry.
+
+    A session's expiry is only written back to the store when it moves by
+    at least ``touch_interval`` seconds, so that reading pages does not
+    write to the store on every request. Expired sessions are purged from
+    the store every ``purge_interval`` seconds.
+    """
+
+    def __init__(self, store, lifetime=1800, cache_size=10000, cache_ttl=5,
+                 touch_interval=60, purge_interval=300):
+        self.store = store
+        self.lifetime = lifetime
+        self.cache_size = cache_size
+        self.cache_ttl = cache_ttl
+        self.touch_interval = min(touch_interval, lifetime / 2.0)
+        self.purge_interval = purge_interval
+        self._cache = storage.LRUCache(cache_size)
+        self._purged = 0
+
+    @staticmethod
+    def new_id():
+        return base64.urlsafe_b64encode(os.urandom(32)).rstrip(b"=").decode()
+
+    def _cached(self, key, now):
+        return self._cache.get(
+            key, valid=lambda entry: now - entry[2] < self.cache_ttl)
+
+    def _cache_set(self, key, data, expires, now):
+        self._cache.set(key, (data, expires, now))
+
+    def load(self, sid):
+        """Return the data and expiry of a session, None if unknown or
+        expired."""
+        now = time.time()
+        key = _digest(sid)
+        entry = self._cached(key, now)
+        if entry is None:
+            stored = self.store.get(key)
+            if stored is None:
+                return None
+            entry = (json.loads(stored[0]), stored[1], now)
+            self._cache_set(key, entry[0], entry[1], now)
+        data, expires, _ = entry
+        if expires <= now:
+            self.delete(sid)
+            return None
+        return dict(data), expires
+
+    def save(self, sid, data, expires=None, modified=True):
+        """Store a session and extend its expiry.
+
+        :param expires: current expiry of the session, None if new
+        """
+        now = time.time()
+        new_expires = now + self.lifetime
+        if (not modified and expires is not None and
+                new_expires - expires < self.touch_interval):
+            return
+        key = _digest(sid)
+        self.store.set(key, json.dumps(data), new_expires)
+        self._cache_set(key, dict(data), new_expires, now)
+        if now - self._purged >= self.purge_interval:
+            self._purged = now
+            self.store.purge(now)
+
+    def delete(self, sid):
+        key = _digest(sid)
+        self._cache.pop(key)
+        self.store.delete(key)
@@ -0,0 +1,123 @@
+"""Building blocks of the caches and stores kept by each process."""
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """Mapping which drops its least recently used entries beyond a size.
+
+    :param max_size: maximum total size of the entries
+    :param size_of: callable returning the size of a value, each entry
+                    counts as 1 if not given
+
+    All methods are thread-safe. Hold ``lock`` to combine several calls
+    into one atomic update.
+    """
+
+    def __init__(self, max_size, size_of=None):
+        self.max_size = max_size
+        self.size_of = size_of or (lambda value: 1)
+        self.size = 0
+        self.lock = threading.RLock()
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def keys(self):
+        with self.lock:
+            return list(self._entries)
+
+    def values(self):
+        with self.lock:
+            return list(self._entries.values())
+
+    def get(self, key, valid=None):
+        """Return the value of a key and mark it as most recently used.
+
+        :param valid: callable telling whether a value may still be used,
+                      entries failing it are dropped
+        """
+        with self.lock:
+            try:
+                value = self._entries.pop(key)
+            except KeyError:
+                return None
+            if valid is not None and not valid(value):
+                self.size -= self.size_of(value)
+                return None
+            self._entries[key] = value
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.pop(key)
+            self._entries[key] = value
+            self.size += self.size_of(value)
+            while self.size > self.max_size:
+                self.pop(next(iter(self._entries)))
+
+    def pop(self, key):
+        with self.lock:
+            try:
+                value = self._entries.pop(key)
+            except KeyError:
+                return None
+            self.size -= self.size_of(value)
+            return value
+
+    def discard(self, matches):
+        """Drop the entries for which ``matches(key, value)`` is true."""
+        with self.lock:
+            for key, value in list(self._entries.items()):
+                if matches(key, value):
+                    self.pop(key)
+
+    def clear(self):
+        with self.lock:
+            self._entries.clear()
+            self.size = 0
+
+
+class SqliteFile(object):
+    """A SQLite file shared by all worker processes of a host.
+
+    Each thread uses its own connection, opened on first use. Connections
+    must not be carried across a fork, e.g. from the ``opp-server`` master
+    to its workers, so a forked process opens its own. The schema is
+    created up front through a connection closed right away, so that an
+    unusable file is reported when the store is set up.
+
+    :param schema: statements creating the tables, if they do not exist
+    :param isolation_level: see :class:`sqlite3.Connection`, None to
+                            manage transactions explicitly
+    """
+
+    def __init__(self, path, schema, timeout=5, isolation_level=""):
+        self.path = path
+        self.timeout = timeout
+        self.isolation_level = isolation_level
+        self._local = threading.local()
+        conn = self._connect()
+        try:
+            for statement in schema:
+                conn.execute(statement)
+            conn.commit()
+        finally:
+            conn.close()
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=self.timeout,
+                               isolation_level=self.isolation_level)
+
+    def connection(self):
+        pid = os.getpid()
+        if getattr(self._local, 'pid', None) != pid:
+            self._local.conn = self._connect()
+            self._local.pid = pid
+        return self._local.conn
@@ -1,9 +1,18 @@
 import base64
-import bcrypt
 import hashlib
+import logging
 import shlex
 import subprocess
 import sys
+import time
+
+from opp.common import opp_config
+
+
+# Range of bcrypt cost factors, each doubles the hashing time
+MIN_ROUNDS = 4
+MAX_ROUNDS = 31
+DEFAULT_ROUNDS = 12
 
 
 def execute(cmd):
@@ -27,6 +36,7 @@ def execute(cmd):
 
 
 def checkpw(password, hashed):
+    import bcrypt
     digest = hashlib.sha256(password.encode()).digest()
     encoded = base64.b64encode(digest)
     if sys.version_info >= (3, 0):
@@ -35,7 +45,58 @@ def checkpw(password, hashed):
         return bcrypt.checkpw(encoded, hashed.encode())
 
 
-def hashpw(password):
+def hashpw(password, rounds=None):
+    import bcrypt
     digest = hashlib.sha256(password.encode()).digest()
     encoded = base64.b64encode(digest)
-    return bcrypt.hashpw(encoded, bcrypt.gensalt())
+    return bcrypt.hashpw(encoded, bcrypt.gensalt(rounds or DEFAULT_ROUNDS))
+
+
+def bcrypt_rounds(conf=None):
+    """Return the cost factor new password hashes should be computed with,
+    tunable via the 'bcrypt_rounds' config option."""
+    conf = conf or opp_config.OppConfig()
+    try:
+        rounds = int(conf['bcrypt_rounds'])
+        if MIN_ROUNDS <= rounds <= MAX_ROUNDS:
+            return rounds
+    except (TypeError, ValueError):
+        pass
+    logging.warning("Invalid value specified for 'bcrypt_rounds' config "
+                    "option. Defaulting to %d.", DEFAULT_ROUNDS)
+    return DEFAULT_ROUNDS
+
+
+def hash_rounds(hashed):
+    """Return the cost factor of a bcrypt hash, None if malformed."""
+    sep = b'$' if isinstance(hashed, bytes) else '$'
+    try:
+        return int(hashed.split(sep)[2])
+    except (IndexError, ValueError):
+        return None
+
+
+def needs_rehash(hashed, rounds):
+    return hash_rounds(hashed) != rounds
+
+
+def calibrate_rounds(target_ms, password="calibration"):
+    """Find the highest cost factor verifying within target_ms.
+
+    Costs are measured in increasing order until the next one is expected
+    to exceed the target, since each doubles the time.
+
+    :returns: tuple of (cost factor, list of (cost, milliseconds) measured)
+    """
+    timings = []
+    rounds = MIN_ROUNDS
+    while True:
+        hashed = hashpw(password, rounds)
+        start = time.time()
+        checkpw(password, hashed)
+        timings.append((rounds, (time.time() - start) * 1000))
+        if timings[-1][1] * 2 > target_ms or rounds == MAX_ROUNDS:
+            break
+        rounds += 1
+    fitting = [cost for cost, elapsed in timings if elapsed <= target_ms]
+    return (fitting[-1] if fitting else MIN_ROUNDS), timings
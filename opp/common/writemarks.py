@@ -0,0 +1,67 @@
+"""Time of each user's last write, so that their reads are served by the
+primary database until read replicas have caught up.
+
+A mark only matters for ``window`` seconds after the write, so older marks
+are purged at most once per window.
+"""
+import threading
+
+from opp.common import storage
+
+
+class MemoryStore(object):
+    """Marks of the current process."""
+
+    def __init__(self, window):
+        self.window = window
+        self._marks = {}
+        self._purged = 0
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        return self._marks.get(user_id, 0)
+
+    def set(self, user_id, now):
+        with self._lock:
+            self._marks[user_id] = now
+            if now - self._purged >= self.window:
+                for key, written in list(self._marks.items()):
+                    if now - written >= self.window:
+                        del self._marks[key]
+                self._purged = now
+
+
+class SqliteStore(storage.SqliteFile):
+    """Marks in a SQLite file, see :class:`storage.SqliteFile`."""
+
+    SCHEMA = ("CREATE TABLE IF NOT EXISTS marks (user_id INTEGER PRIMARY "
+              "KEY, written REAL NOT NULL)")
+
+    def __init__(self, path, window, timeout=5):
+        self.window = window
+        self._purged = 0
+        super(SqliteStore, self).__init__(path, [self.SCHEMA], timeout)
+
+    def get(self, user_id):
+        row = self.connection().execute(
+            "SELECT written FROM marks WHERE user_id = ?",
+            (user_id,)).fetchone()
+        return row[0] if row else 0
+
+    def set(self, user_id, now):
+        with self.connection() as conn:
+            conn.execute("INSERT OR REPLACE INTO marks (user_id, written) "
+                         "VALUES (?, ?)", (user_id, now))
+            if now - self._purged >= self.window:
+                conn.execute("DELETE FROM marks WHERE written <= ?",
+                             (now - self.window,))
+                self._purged = now
+
+
+def create_store(url, window):
+    """Create a store from a URL: 'memory' or 'sqlite:///<path>'."""
+    if url == "memory":
+        return MemoryStore(window)
+    if url.startswith("sqlite:///"):
+        return SqliteStore(url[len("sqlite:///"):], window)
+    raise ValueError("Unsupported write mark store: %s" % url)
@@ -1,23 +1,269 @@
+from datetime import datetime
+import itertools
+import logging
+import sqlite3
 import sys
-from sqlalchemy import create_engine, exc
-from sqlalchemy.orm import scoped_session, sessionmaker
+import threading
+import time
 
-from opp.common import opp_config
+from sqlalchemy import bindparam, create_engine, event, exc, func, or_, text
+from sqlalchemy.ext import baked
+from sqlalchemy.orm import Session, sessionmaker
+from sqlalchemy.sql.expression import Select
+
+from opp.common import opp_config, writemarks
 from opp.db import models
 
 
-def get_session(conf=None):
+# Engines and their session factories by connection string, so that
+# connection pools are shared by all sessions of the process
+_ENGINES = {}
+_ENGINES_LOCK = threading.Lock()
+
+# Hot queries are baked: their ORM constructs and compiled SQL are cached
+# on first use, keyed by the code of the lambdas building them, so values
+# must only be passed in as bind parameters
+_BAKERY = baked.bakery()
+
+
+# Read replica sets by their connection strings, see get_session
+_REPLICAS = {}
+
+# Stores of the time of each user's last write, by URL and window, so that
+# their reads are served by the primary until replicas have caught up
+_WRITE_MARKS = {}
+
+
+def _create_engine(db_connect):
+    try:
+        return create_engine(db_connect)
+    except exc.NoSuchModuleError as e:
+        sys.exit("Error: %s" % str(e))
+
+
+class RoutingSession(Session):
+    """Session reading from a replica until it writes.
+
+    SELECT statements are sent to the replica, if any. Everything else is
+    sent to the primary, as are all statements after the first write, so
+    that the session reads its own writes.
+
+    :param user_id: user whose writes are recorded, see get_session
+    :param marks: store of the users' last writes, None if not recorded
+    """
+
+    def __init__(self, replica=None, user_id=None, marks=None, **kwargs):
+        super(RoutingSession, self).__init__(**kwargs)
+        self.replica = replica
+        self.user_id = user_id
+        self.marks = marks
+        self.wrote = False
+
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        if (self.replica is not None and not self.wrote and
+                not self._flushing and isinstance(clause, Select)):
+            return self.replica
+        if not self.wrote and self.user_id is not None:
+            self.mark_write(self.user_id)
+        self.wrote = True
+        return super(RoutingSession, self).get_bind(mapper, clause, **kwargs)
+
+    def mark_write(self, user_id):
+        """Serve the user's reads from the primary for a while."""
+        if self.marks is not None:
+            self.marks.set(user_id, time.time())
+
+
+class ReplicaSet(object):
+    """Read replica engines, picked round-robin.
+
+    A replica is checked with a trivial query at most every
+    ``check_interval`` seconds when picked, and skipped until its next
+    check if that fails or one of its connections is lost.
+    """
+
+    def __init__(self, urls, check_interval=30):
+        self.engines = [_create_engine(url) for url in urls]
+        self.check_interval = check_interval
+        self._next_check = [0] * len(self.engines)
+        self._healthy = [True] * len(self.engines)
+        self._counter = itertools.count()
+        for index, engine in enumerate(self.engines):
+            event.listen(engine, 'handle_error',
+                         self._disconnect_listener(index))
+
+    def _disconnect_listener(self, index):
+        def handle_error(context):
+            if context.is_disconnect:
+                self._mark_down(index)
+        return handle_error
+
+    def _mark_down(self, index):
+        logging.warning("Read replica %s is unavailable",
+                        self.engines[index].url)
+        self._healthy[index] = False
+        self._next_check[index] = time.time() + self.check_interval
+
+    def _check(self, index, now):
+        if now < self._next_check[index]:
+            return self._healthy[index]
+        # Set first, so that concurrent picks do not check as well
+        self._next_check[index] = now + self.check_interval
+        try:
+            with self.engines[index].connect() as conn:
+                conn.execute(text("SELECT 1"))
+        except exc.DBAPIError:
+            self._mark_down(index)
+            return False
+        self._healthy[index] = True
+        return True
+
+    def pick(self):
+        """Return the engine of the next healthy replica, or None."""
+        now = time.time()
+        start = next(self._counter)
+        for offset in range(len(self.engines)):
+            index = (start + offset) % len(self.engines)
+            if self._check(index, now):
+                return self.engines[index]
+        return None
+
+    def dispose(self):
+        for engine in self.engines:
+            engine.dispose()
+
+
+def _get_session_factory(conf=None):
     conf = conf or opp_config.OppConfig()
     db_connect = conf['db_connect']
-    if db_connect:
-        try:
-            engine = create_engine(db_connect)
-            session_factory = sessionmaker(engine)
-            Session = scoped_session(session_factory)
-            return Session()
-        except exc.NoSuchModuleError as e:
-            sys.exit("Error: %s" % str(e))
-    sys.exit("Error: database connection string not configured.")
+    if not db_connect:
+        sys.exit("Error: database connection string not configured.")
+    try:
+        return _ENGINES[db_connect]
+    except KeyError:
+        pass
+    with _ENGINES_LOCK:
+        if db_connect not in _ENGINES:
+            _ENGINES[db_connect] = sessionmaker(_create_engine(db_connect),
+                                                class_=RoutingSession)
+        return _ENGINES[db_connect]
+
+
+def _get_replicas(conf):
+    urls = tuple(url.strip() for url in
+                 (conf['db_connect_replicas'] or "").split(',')
+                 if url.strip())
+    if not urls:
+        return None
+    try:
+        return _REPLICAS[urls]
+    except KeyError:
+        pass
+    with _ENGINES_LOCK:
+        if urls not in _REPLICAS:
+            _REPLICAS[urls] = ReplicaSet(urls)
+        return _REPLICAS[urls]
+
+
+def _write_window(conf):
+    try:
+        return max(0, int(conf['db_replica_write_window']))
+    except (TypeError, ValueError):
+        logging.warning("Invalid value specified for "
+                        "'db_replica_write_window' config option. "
+                        "Defaulting to 10 seconds.")
+        return 10
+
+
+def _get_write_marks(conf):
+    url = conf['db_replica_write_store'] or "memory"
+    window = _write_window(conf)
+    try:
+        return _WRITE_MARKS[url, window]
+    except KeyError:
+        pass
+    with _ENGINES_LOCK:
+        if (url, window) not in _WRITE_MARKS:
+            try:
+                marks = writemarks.create_store(url, window)
+            except (ValueError, sqlite3.Error) as e:
+                logging.warning("%s. Using the in-memory write mark store.",
+                                str(e))
+                marks = writemarks.MemoryStore(window)
+            _WRITE_MARKS[url, window] = marks
+        return _WRITE_MARKS[url, window]
+
+
+def get_engine(conf=None):
+    return _get_session_factory(conf).kw['bind']
+
+
+def dispose_engines():
+    """Drop pooled connections, e.g. ones inherited from a parent process.
+
+    Must be called in forked children before they use the database.
+    """
+    with _ENGINES_LOCK:
+        for session_factory in _ENGINES.values():
+            session_factory.kw['bind'].dispose()
+        for replicas in _REPLICAS.values():
+            replicas.dispose()
+
+
+def get_session(conf=None, read_only=False, user_id=None):
+    """Return a new session of the primary database.
+
+    :param read_only: let a read replica, if configured in
+                      'db_connect_replicas', serve the session's reads
+    :param user_id: user the session acts for. Sessions of a user who
+                    wrote within 'db_replica_write_window' seconds read
+                    from the primary, so the user sees their own writes.
+                    Writes are recorded in 'db_replica_write_store'.
+    """
+    conf = conf or opp_config.OppConfig()
+    session_factory = _get_session_factory(conf)
+    replica = None
+    marks = None
+    replicas = _get_replicas(conf)
+    if replicas is not None:
+        marks = _get_write_marks(conf)
+        if (read_only and
+                time.time() - marks.get(user_id) >= _write_window(conf)):
+            replica = replicas.pick()
+    return session_factory(replica=replica, user_id=user_id, marks=marks)
+
+
+# Incremented after every committed write to items, categories or data
+# keys, so that responses cached by this process can be invalidated
+_vault_generation = 0
+_VAULT_LOCK = threading.Lock()
+
+
+def _vault_changed(session):
+    """Mark the vault as changed once the session's transaction commits.
+
+    A commit of a batch only flushes, see :mod:`opp.api.v1.batch`, so the
+    generation is changed when the outer transaction actually commits.
+    """
+    session.info['vault_changed'] = True
+
+
+@event.listens_for(RoutingSession, 'after_commit')
+def _after_commit(session):
+    global _vault_generation
+    if session.info.pop('vault_changed', False):
+        with _VAULT_LOCK:
+            _vault_generation += 1
+
+
+@event.listens_for(RoutingSession, 'after_soft_rollback')
+def _after_rollback(session, previous_transaction):
+    session.info.pop('vault_changed', None)
+
+
+def vault_generation():
+    """Return a counter changed by writes to the vault in this process."""
+    return _vault_generation
 
 
 def user_create(user, session=None, conf=None):
@@ -25,6 +271,15 @@ def user_create(user, session=None, conf=None):
         session = session or get_session(conf)
         session.add(user)
         session.commit()
+        # The new user's first requests must not miss them on a replica
+        session.mark_write(user.id)
+
+
+def user_bulk_create(mappings, session=None, conf=None):
+    if mappings:
+        session = session or get_session(conf)
+        session.bulk_insert_mappings(models.User, mappings)
+        session.commit()
 
 
 def user_update(user, session=None, conf=None):
@@ -34,21 +289,33 @@ def user_update(user, session=None, conf=None):
         session.commit()
 
 
+def user_update_password(user, hashed, session=None, conf=None):
+    """Replace a user's password hash, returning False if it has been
+    changed since the user was loaded."""
+    session = session or get_session(conf)
+    count = session.query(models.User).filter(
+        models.User.id == user.id,
+        models.User.password == user.password).update(
+            {'password': hashed}, synchronize_session=False)
+    session.commit()
+    return count == 1
+
+
 def user_get_by_id(id, session=None, conf=None):
     if id:
         session = session or get_session(conf)
-        query = session.query(models.User).filter(
-            models.User.id == id)
-        return query.one_or_none()
+        query = _BAKERY(lambda s: s.query(models.User).filter(
+            models.User.id == bindparam('id')))
+        return query(session).params(id=id).one_or_none()
     return None
 
 
 def user_get_by_username(username, session=None, conf=None):
     if username:
         session = session or get_session(conf)
-        query = session.query(models.User).filter(
-            models.User.username == username)
-        return query.one_or_none()
+        query = _BAKERY(lambda s: s.query(models.User).filter(
+            models.User.username == bindparam('username')))
+        return query(session).params(username=username).one_or_none()
     return None
 
 
@@ -66,10 +333,30 @@ def user_delete_by_username(username, session=None, conf=None):
         user_delete(user, session, conf)
 
 
-def category_create(categories, session=None, conf=None):
+def category_create(categories, session=None, conf=None, on_ids=None):
+    """Insert categories.
+
+    :param on_ids: optional callable run once the categories have their
+                   ids, before the transaction is committed, e.g. to
+                   encrypt them bound to their rows
+    """
     if categories:
         session = session or get_session(conf)
         session.add_all(categories)
+        if on_ids:
+            session.flush()
+            on_ids()
+        _vault_changed(session)
+        session.commit()
+
+
+def category_bulk_create(mappings, session=None, conf=None):
+    # Primary keys are written back into the mappings for later reference
+    if mappings:
+        session = session or get_session(conf)
+        session.bulk_insert_mappings(models.Category, mappings,
+                                     return_defaults=True)
+        _vault_changed(session)
         session.commit()
 
 
@@ -77,18 +364,40 @@ def category_update(categories, session=None, conf=None):
     session = session or get_session(conf)
     for category in categories:
         session.merge(category)
+    _vault_changed(session)
     session.commit()
 
 
 def category_getall(filter_ids=None, session=None, conf=None):
     session = session or get_session(conf)
+    query = _BAKERY(lambda s: s.query(models.Category).order_by(
+        models.Category.id))
     if filter_ids:
-        query = session.query(models.Category).order_by(
-            models.Category.id).filter(
-            models.Category.id.in_(filter_ids))
-    else:
-        query = session.query(models.Category).order_by(models.Category.id)
-    return query.all()
+        # The SQL depends on the number of ids, so it is not cached
+        query = query.spoil()
+        query += lambda q: q.filter(models.Category.id.in_(filter_ids))
+    return query(session).all()
+
+
+def category_max_id(session=None, conf=None):
+    session = session or get_session(conf)
+    return session.query(func.max(models.Category.id)).scalar() or 0
+
+
+def category_get_outdated(key_version, limit, session=None, conf=None):
+    session = session or get_session(conf)
+    query = session.query(
+        models.Category.id, models.Category.name).order_by(
+        models.Category.id).filter(
+        models.Category.key_version < key_version).limit(limit)
+    return [tuple(row) for row in query.all()]
+
+
+def category_bulk_update(mappings, session=None, conf=None):
+    session = session or get_session(conf)
+    session.bulk_update_mappings(models.Category, mappings)
+    _vault_changed(session)
+    session.commit()
 
 
 def category_delete(categories, cascade, session=None, conf=None):
@@ -96,6 +405,8 @@ def category_delete(categories, cascade, session=None, conf=None):
         session = session or get_session(conf)
         if cascade:
             for category in categories:
+                _item_token_delete([item.id for item in category.items],
+                                   session)
                 for item in category.items:
                     session.delete(item)
                 session.delete(category)
@@ -105,6 +416,7 @@ def category_delete(categories, cascade, session=None, conf=None):
                     item.category_id = None
                     session.add(item)
                 session.delete(category)
+        _vault_changed(session)
         session.commit()
 
 
@@ -115,41 +427,104 @@ def category_delete_by_id(filter_ids, cascade, session=None, conf=None):
         category_delete(categories, cascade, session, conf)
 
 
-def item_create(items, session=None, conf=None):
+def item_create(items, session=None, conf=None, on_ids=None):
+    """Insert items, see :func:`category_create` for ``on_ids``."""
     if items:
         session = session or get_session(conf)
         session.add_all(items)
+        if on_ids:
+            session.flush()
+            on_ids()
+        _vault_changed(session)
+        session.commit()
+
+
+def item_bulk_create(mappings, session=None, conf=None):
+    if mappings:
+        session = session or get_session(conf)
+        session.execute(models.Item.__table__.insert(), mappings)
+        _vault_changed(session)
         session.commit()
 
 
-def item_update(items, session=None, conf=None):
+def item_update(items, session=None, conf=None, tokens=None):
+    """Update items, and replace their blind index tokens in the same
+    transaction if given, see :func:`item_token_replace`."""
     session = session or get_session(conf)
     for item in items:
         session.merge(item)
+    if tokens:
+        _item_token_replace(tokens, session)
+    _vault_changed(session)
     session.commit()
 
 
-def item_getall(filter_ids=None, session=None, conf=None):
+def item_getall(filter_ids=None, session=None, conf=None,
+                category_ids=None, marker=None, limit=None):
+    """Return items in id order, optionally filtered and paginated.
+
+    :param category_ids: only return items of these categories, where None
+                         stands for uncategorized items
+    :param marker: only return items with an id greater than this
+    :param limit: maximum number of items to return
+    """
     session = session or get_session(conf)
+    query = _BAKERY(lambda s: s.query(
+        models.Item).order_by(
+        models.Item.id).outerjoin(
+        models.Category))
+    params = {}
+    if marker is not None:
+        query += lambda q: q.filter(models.Item.id > bindparam('marker'))
+        params['marker'] = marker
+    if filter_ids or category_ids:
+        # The SQL depends on the number of ids, so it is not cached
+        query = query.spoil()
     if filter_ids:
-        query = session.query(
-            models.Item).order_by(
-            models.Item.id).filter(
-            models.Item.id.in_(filter_ids)).outerjoin(
-            models.Category)
+        query += lambda q: q.filter(models.Item.id.in_(filter_ids))
+    if category_ids:
+        ids = [category_id for category_id in category_ids
+               if category_id is not None]
+        conditions = []
+        if ids:
+            conditions.append(models.Item.category_id.in_(ids))
+        if len(ids) < len(category_ids):
+            conditions.append(models.Item.category_id.is_(None))
+        query += lambda q: q.filter(or_(*conditions))
+    if limit is not None:
+        query += lambda q: q.limit(bindparam('limit'))
+        params['limit'] = limit
+    return query(session).params(**params).all()
+
+
+def item_max_id(session=None, conf=None):
+    session = session or get_session(conf)
+    return session.query(func.max(models.Item.id)).scalar() or 0
 
-    else:
-        query = session.query(
-            models.Item).order_by(
-            models.Item.id).outerjoin(
-            models.Category)
-    return query.all()
+
+def item_get_outdated(key_version, limit, session=None, conf=None):
+    session = session or get_session(conf)
+    columns = [getattr(models.Item, c) for c in models.ENCRYPTED_COLUMNS]
+    query = session.query(
+        models.Item.id, *columns).order_by(
+        models.Item.id).filter(
+        models.Item.key_version < key_version).limit(limit)
+    return [tuple(row) for row in query.all()]
+
+
+def item_bulk_update(mappings, session=None, conf=None):
+    session = session or get_session(conf)
+    session.bulk_update_mappings(models.Item, mappings)
+    _vault_changed(session)
+    session.commit()
 
 
 def item_delete(items, session=None, conf=None):
     session = session or get_session(conf)
+    _item_token_delete([item.id for item in items], session)
     for item in items:
         session.delete(item)
+    _vault_changed(session)
     session.commit()
 
 
@@ -158,3 +533,229 @@ def item_delete_by_id(filter_ids, session=None, conf=None):
         session = session or get_session(conf)
         items = item_getall(filter_ids, session, conf)
         item_delete(items, session, conf)
+
+
+def _item_token_delete(item_ids, session):
+    if item_ids:
+        session.query(models.ItemToken).filter(
+            models.ItemToken.item_id.in_(item_ids)).delete(
+            synchronize_session=False)
+
+
+def _item_token_replace(tokens, session):
+    _item_token_delete(list(tokens), session)
+    session.bulk_insert_mappings(
+        models.ItemToken, [{'item_id': item_id, 'token': token}
+                           for item_id, item_tokens in tokens.items()
+                           for token in item_tokens])
+
+
+def item_token_replace(tokens, session=None, conf=None):
+    """Replace the blind index tokens of items.
+
+    :param tokens: dict of item id to an iterable of tokens
+    """
+    if tokens:
+        session = session or get_session(conf)
+        _item_token_replace(tokens, session)
+        session.commit()
+
+
+def item_token_delete_all(session=None, conf=None):
+    session = session or get_session(conf)
+    session.query(models.ItemToken).delete(synchronize_session=False)
+    session.commit()
+
+
+def item_search(exact_tokens, all_tokens, session=None, conf=None):
+    """Return the ids of items having any of exact_tokens or all of
+    all_tokens."""
+    session = session or get_session(conf)
+    ids = set(row[0] for row in session.query(
+        models.ItemToken.item_id).filter(
+        models.ItemToken.token.in_(exact_tokens)).distinct())
+    if all_tokens:
+        all_tokens = set(all_tokens)
+        query = session.query(
+            models.ItemToken.item_id).filter(
+            models.ItemToken.token.in_(all_tokens)).group_by(
+            models.ItemToken.item_id).having(
+            func.count(models.ItemToken.token.distinct()) == len(all_tokens))
+        ids.update(row[0] for row in query)
+    return sorted(ids)
+
+
+def item_get_unindexed(marker, session=None, conf=None):
+    """Return the items without the given blind index marker token."""
+    session = session or get_session(conf)
+    indexed = session.query(models.ItemToken.item_id).filter(
+        models.ItemToken.token == marker)
+    query = session.query(
+        models.Item).order_by(
+        models.Item.id).filter(
+        ~models.Item.id.in_(indexed)).outerjoin(
+        models.Category)
+    return query.all()
+
+
+def vault_is_empty(session=None, conf=None):
+    session = session or get_session(conf)
+    return (session.query(models.Item.id).first() is None and
+            session.query(models.Category.id).first() is None)
+
+
+def vault_sample(session=None, conf=None):
+    """Return the first category and item of the vault, either may be None.
+    """
+    session = session or get_session(conf)
+    return (session.query(models.Category).order_by(
+                models.Category.id).first(),
+            session.query(models.Item).order_by(models.Item.id).first())
+
+
+def data_key_create(data_key, session=None, conf=None):
+    if data_key:
+        session = session or get_session(conf)
+        session.add(data_key)
+        _vault_changed(session)
+        session.commit()
+
+
+def data_key_update(data_key, session=None, conf=None):
+    if data_key:
+        session = session or get_session(conf)
+        session.merge(data_key)
+        _vault_changed(session)
+        session.commit()
+
+
+def data_key_get_by_user_id(user_id, session=None, conf=None):
+    if user_id:
+        session = session or get_session(conf)
+        query = session.query(models.DataKey).filter(
+            models.DataKey.user_id == user_id)
+        return query.one_or_none()
+    return None
+
+
+def data_key_getall(session=None, conf=None):
+    session = session or get_session(conf)
+    return session.query(models.DataKey).order_by(models.DataKey.id).all()
+
+
+def data_key_delete(data_key, session=None, conf=None):
+    if data_key:
+        session = session or get_session(conf)
+        session.delete(data_key)
+        _vault_changed(session)
+        session.commit()
+
+
+def data_key_count(session=None, conf=None):
+    session = session or get_session(conf)
+    return session.query(models.DataKey).count()
+
+
+def rekey_job_create(job, session=None, conf=None):
+    if job:
+        session = session or get_session(conf)
+        session.add(job)
+        session.commit()
+
+
+def rekey_job_update(job, session=None, conf=None):
+    if job:
+        session = session or get_session(conf)
+        session.merge(job)
+        session.commit()
+
+
+def rekey_job_get_latest(session=None, conf=None):
+    session = session or get_session(conf)
+    query = session.query(models.RekeyJob).order_by(
+        models.RekeyJob.id.desc())
+    return query.first()
+
+
+def key_version_get(session=None, conf=None):
+    """Return the key version that new and updated rows are written with."""
+    job = rekey_job_get_latest(session, conf)
+    return job.to_version if job else 0
+
+
+def refresh_token_create(token, session=None, conf=None):
+    if token:
+        session = session or get_session(conf)
+        session.add(token)
+        session.commit()
+
+
+def refresh_token_get_by_hash(token_hash, session=None, conf=None):
+    if token_hash:
+        session = session or get_session(conf)
+        query = session.query(models.RefreshToken).filter(
+            models.RefreshToken.token_hash == token_hash)
+        return query.one_or_none()
+    return None
+
+
+def refresh_token_use(token, session=None, conf=None):
+    """Mark a refresh token used, returning False if it already was.
+
+    The conditional update lets exactly one of several concurrent
+    requests presenting the same token succeed.
+    """
+    session = session or get_session(conf)
+    count = session.query(models.RefreshToken).filter(
+        models.RefreshToken.id == token.id,
+        models.RefreshToken.used == False).update(  # noqa: E712
+            {'used': True}, synchronize_session=False)
+    session.commit()
+    return count == 1
+
+
+def refresh_token_revoke_family(family, session=None, conf=None):
+    session = session or get_session(conf)
+    session.query(models.RefreshToken).filter(
+        models.RefreshToken.family == family).delete(
+            synchronize_session=False)
+    session.commit()
+
+
+def refresh_token_revoke_user(user_id, session=None, conf=None):
+    session = session or get_session(conf)
+    session.query(models.RefreshToken).filter(
+        models.RefreshToken.user_id == user_id).delete(
+            synchronize_session=False)
+    session.commit()
+
+
+def refresh_token_delete_expired(user_id, session=None, conf=None):
+    session = session or get_session(conf)
+    session.query(models.RefreshToken).filter(
+        models.RefreshToken.user_id == user_id,
+        models.RefreshToken.expires_at < datetime.now()).delete(
+            synchronize_session=False)
+    session.commit()
+
+
+def revoked_token_create(token, session=None, conf=None):
+    if token:
+        session = session or get_session(conf)
+        session.query(models.RevokedToken).filter(
+            models.RevokedToken.expires_at < datetime.now()).delete(
+                synchronize_session=False)
+        session.add(token)
+        try:
+            session.commit()
+        except exc.IntegrityError:
+            # Already revoked
+            session.rollback()
+
+
+def revoked_token_get_unexpired(session=None, conf=None):
+    session = session or get_session(conf)
+    query = session.query(models.RevokedToken.jti,
+                          models.RevokedToken.expires_at).filter(
+        models.RevokedToken.expires_at >= datetime.now())
+    return query.all()
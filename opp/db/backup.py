@@ -0,0 +1,246 @@
+import base64
+import datetime
+import gzip
+import hashlib
+import json
+import logging
+
+from sqlalchemy import DateTime, func, select, text
+
+from opp.db import models
+
+
+FORMAT = "opp-backup"
+VERSION = 1
+DATETIME_FORMAT = "%Y-%m-%dT%H:%M:%S.%f"
+
+
+class BackupError(Exception):
+    pass
+
+
+def _encode(value):
+    if isinstance(value, datetime.datetime):
+        return value.strftime(DATETIME_FORMAT)
+    if isinstance(value, bytes) and not isinstance(value, str):
+        # Python 3 only: bcrypt hashes and some ciphertexts are bytes
+        return {'$bytes': base64.b64encode(value).decode()}
+    return value
+
+
+def _decode(value, column):
+    if isinstance(value, dict):
+        return base64.b64decode(value['$bytes'].encode())
+    if value is not None and isinstance(column.type, DateTime):
+        return datetime.datetime.strptime(value, DATETIME_FORMAT)
+    return value
+
+
+def _primary_key(table):
+    columns = list(table.primary_key.columns)
+    if len(columns) != 1:
+        raise BackupError("Table %s must have a single column primary key" %
+                          table.name)
+    return columns[0]
+
+
+class _ChecksumWriter(object):
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.digest = hashlib.sha256()
+
+    def write(self, record):
+        line = (json.dumps(record, sort_keys=True) + "\n").encode('utf-8')
+        self.digest.update(line)
+        self.fileobj.write(line)
+
+
+def _snapshot(engine):
+    """Open a connection reading from a consistent snapshot of the DB.
+
+    PostgreSQL and MySQL serve all reads of a REPEATABLE READ transaction
+    from the snapshot taken at its first read, without blocking writers.
+    SQLite keeps a read transaction open on the database file, which only
+    lets writers commit in the meantime if the database is in WAL mode.
+    """
+    conn = engine.connect()
+    if engine.dialect.name == 'sqlite':
+        mode = conn.execute(text("PRAGMA journal_mode")).scalar()
+        if mode.lower() != 'wal':
+            logging.warning("SQLite database is in '%s' journal mode, "
+                            "writes are blocked until the backup completes. "
+                            "Enable WAL mode to back up without blocking "
+                            "writers.", mode)
+        # pysqlite does not emit BEGIN before SELECT statements
+        conn.execute(text("BEGIN"))
+        return conn, None
+    if engine.dialect.name in ('postgresql', 'mysql'):
+        conn = conn.execution_options(isolation_level="REPEATABLE READ")
+    return conn, conn.begin()
+
+
+def dump(engine, fileobj, chunk_size=1000, progress=None):
+    """Stream all tables into a compressed, checksummed archive.
+
+    Rows are read in primary key order, ``chunk_size`` rows at a time, so
+    memory usage does not depend on the size of the database.
+
+    :param engine: SQLAlchemy engine of the source database
+    :param fileobj: binary file object to write the archive to
+    :param progress: optional callable receiving (table name, row count)
+    :returns: dict of row counts per table
+    """
+    tables = models.Base.metadata.sorted_tables
+    counts = {}
+    conn, trans = _snapshot(engine)
+    try:
+        with gzip.GzipFile(fileobj=fileobj, mode='wb') as archive:
+            writer = _ChecksumWriter(archive)
+            writer.write({'format': FORMAT, 'version': VERSION,
+                          'dialect': engine.dialect.name,
+                          'created_at': _encode(datetime.datetime.utcnow()),
+                          'tables': [table.name for table in tables]})
+            for table in tables:
+                pk = _primary_key(table)
+                columns = [column.name for column in table.columns]
+                writer.write({'table': table.name, 'columns': columns})
+
+                count = 0
+                last = None
+                while True:
+                    query = select([table]).order_by(pk).limit(chunk_size)
+                    if last is not None:
+                        query = query.where(pk > last)
+                    rows = conn.execute(query).fetchall()
+                    if not rows:
+                        break
+                    writer.write({'rows': [[_encode(row[c]) for c in columns]
+                                           for row in rows]})
+                    last = rows[-1][pk.name]
+                    count += len(rows)
+                    if progress:
+                        progress(table.name, count)
+
+                writer.write({'end': table.name, 'count': count})
+                counts[table.name] = count
+
+            archive.write((json.dumps({'checksum': writer.digest.hexdigest()})
+                           + "\n").encode('utf-8'))
+    finally:
+        if trans is not None:
+            trans.rollback()
+        else:
+            conn.execute(text("ROLLBACK"))
+        conn.close()
+    return counts
+
+
+def reset_sequences(conn):
+    """Move sequences past the rows inserted with explicit primary keys.
+
+    Explicit primary keys bypass sequences. Note that several tables may
+    share one sequence.
+    """
+    if conn.dialect.name != 'postgresql':
+        return
+    maximums = {}
+    for table in models.Base.metadata.sorted_tables:
+        pk = _primary_key(table)
+        sequence = pk.default
+        if sequence is None or not getattr(sequence, 'is_sequence', False):
+            continue
+        value = conn.execute(select([func.max(pk)])).scalar() or 0
+        maximums[sequence.name] = max(maximums.get(sequence.name, 0), value)
+    for name, value in maximums.items():
+        if value:
+            conn.execute(text("SELECT setval(:name, :value)"),
+                         name=name, value=value)
+
+
+def load(engine, fileobj, progress=None):
+    """Restore an archive created by :func:`dump` into an empty database.
+
+    The schema must have been created beforehand.
+
+    All rows are inserted in a single transaction which is only committed
+    once the archive checksum has been verified, so a corrupt or truncated
+    archive leaves the target database untouched.
+
+    :returns: dict of row counts per table
+    """
+    tables = dict((table.name, table) for table in
+                  models.Base.metadata.sorted_tables)
+
+    conn = engine.connect()
+    trans = conn.begin()
+    try:
+        for table in tables.values():
+            if conn.execute(select([func.count()]).select_from(
+                    table)).scalar():
+                raise BackupError("Table %s is not empty, refusing to "
+                                  "restore" % table.name)
+
+        counts = {}
+        digest = hashlib.sha256()
+        table = columns = None
+        checksum = None
+        with gzip.GzipFile(fileobj=fileobj, mode='rb') as archive:
+            header = archive.readline()
+            digest.update(header)
+            try:
+                header = json.loads(header.decode('utf-8'))
+            except ValueError:
+                raise BackupError("Not a valid backup archive")
+            if header.get('format') != FORMAT:
+                raise BackupError("Not a valid backup archive")
+            if header.get('version') != VERSION:
+                raise BackupError("Unsupported backup version: %s" %
+                                  header.get('version'))
+
+            for line in archive:
+                record = json.loads(line.decode('utf-8'))
+                if 'checksum' in record:
+                    checksum = record['checksum']
+                    break
+                digest.update(line)
+
+                if 'table' in record:
+                    try:
+                        table = tables[record['table']]
+                    except KeyError:
+                        raise BackupError("Unknown table in archive: %s" %
+                                          record['table'])
+                    try:
+                        columns = [table.columns[name] for
+                                   name in record['columns']]
+                    except KeyError as e:
+                        raise BackupError("Unknown column in archive: %s" %
+                                          str(e))
+                    counts[table.name] = 0
+                elif 'rows' in record:
+                    mappings = [dict((column.name, _decode(value, column))
+                                     for column, value in zip(columns, row))
+                                for row in record['rows']]
+                    conn.execute(table.insert(), mappings)
+                    counts[table.name] += len(mappings)
+                    if progress:
+                        progress(table.name, counts[table.name])
+                elif 'end' in record:
+                    if record['count'] != counts.get(record['end']):
+                        raise BackupError("Row count mismatch for table %s" %
+                                          record['end'])
+
+        if checksum is None:
+            raise BackupError("Archive is truncated")
+        if checksum != digest.hexdigest():
+            raise BackupError("Archive checksum mismatch")
+
+        reset_sequences(conn)
+        trans.commit()
+    except Exception:
+        trans.rollback()
+        raise
+    finally:
+        conn.close()
+    return counts
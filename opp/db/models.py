@@ -1,7 +1,10 @@
 import base64
+import hashlib
+import hmac
+import re
 from datetime import datetime
 
-from sqlalchemy import (Column, DateTime, ForeignKey,
+from sqlalchemy import (Boolean, Column, DateTime, ForeignKey,
                         Index, Integer, Sequence, String)
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
@@ -9,6 +12,101 @@ from sqlalchemy.orm import relationship
 
 Base = declarative_base()
 
+ENCRYPTED_COLUMNS = ['name', 'url', 'account', 'username', 'password', 'blob']
+_DECRYPTED_ITEM = re.compile(r'^[A-Za-z0-9+/=]*(~[A-Za-z0-9+/=]*){5}$')
+_CONTROL_CHARS = re.compile(u'[\x00-\x08\x0b\x0c\x0e-\x1f\x7f\ufffd]')
+
+
+def _chunk6(string):
+    chunk = int(len(string) / 6)
+    chunks = []
+    for i in range(0, 5):
+        chunks.append(string[chunk * i: chunk * (i + 1)])
+    chunks.append(string[chunk * 5:])
+    return chunks
+
+
+def item_aad(item_id):
+    """Return the associated data binding item ciphertexts to their row.
+
+    The encrypted columns of an item hold a single ciphertext, so binding
+    them to the row also rules out swapping individual columns.
+    """
+    return ("items/%d" % item_id).encode()
+
+
+def category_aad(category_id):
+    return ("categories/%d/name" % category_id).encode()
+
+
+def encode_item(row):
+    """Encode a list of plain item values into the string to encrypt.
+
+    The values (name, url, account, username, password, blob) are base64
+    encoded and joined by a delimiter.
+    """
+    return "~".join(base64.b64encode(x.encode()).decode() for x in row)
+
+
+def seal_item(cipher, encoded, item_id=None):
+    """Encrypt an encoded item into a dict of item columns.
+
+    The item is encrypted as a single blob, which is then spread across
+    the six encrypted columns. It is bound to the item's row if its id is
+    given. This is the inverse of :meth:`Item.extract`.
+    """
+    if item_id is None:
+        encrypted_blob = cipher.encrypt(encoded)
+    else:
+        encrypted_blob = cipher.encrypt(encoded, item_aad(item_id))
+    return dict(zip(ENCRYPTED_COLUMNS, _chunk6(encrypted_blob.decode())))
+
+
+def encrypt_item(cipher, row, item_id=None):
+    """Encrypt a list of plain item values into a dict of item columns."""
+    return seal_item(cipher, encode_item(row), item_id)
+
+
+def decrypt_item(cipher, columns, item_id):
+    """Decrypt the encrypted item columns into their encoded form.
+
+    :param columns: list of the encrypted columns in ENCRYPTED_COLUMNS order
+    :raises ValueError: if the cipher's key is not the item's
+    """
+    decrypted = cipher.decrypt("".join(columns), item_aad(item_id))
+    if not _DECRYPTED_ITEM.match(decrypted):
+        raise ValueError("Unable to decrypt item with the given key")
+    return decrypted
+
+
+def decrypt_category(cipher, name, category_id):
+    """Decrypt an encrypted category name.
+
+    :raises ValueError: if the cipher's key is not the category's
+    """
+    decrypted = cipher.decrypt(name, category_aad(category_id))
+    # Legacy CBC ciphertexts decrypt to garbage, often truncated to
+    # nothing by unpadding, under a wrong key. Names are never empty.
+    if not decrypted or _CONTROL_CHARS.search(decrypted):
+        raise ValueError("Unable to decrypt category with the given key")
+    return decrypted
+
+
+def reencrypt_item(old_cipher, new_cipher, columns, item_id):
+    """Re-encrypt the encrypted item columns under a different key.
+
+    :returns: dict of the re-encrypted item columns
+    """
+    # Catch a wrong old key before corrupting the row
+    decrypted = decrypt_item(old_cipher, columns, item_id)
+    return seal_item(new_cipher, decrypted, item_id)
+
+
+def reencrypt_category(old_cipher, new_cipher, name, category_id):
+    """Re-encrypt an encrypted category name under a different key."""
+    decrypted = decrypt_category(old_cipher, name, category_id)
+    return new_cipher.encrypt(decrypted, category_aad(category_id))
+
 
 class User(Base):
 
@@ -22,11 +120,17 @@ class User(Base):
     updated_at = Column(DateTime, default=lambda: datetime.now(),
                         nullable=False, onupdate=lambda: datetime.now())
 
+    data_key = relationship('DataKey', uselist=False,
+                            cascade='all, delete-orphan')
+    refresh_tokens = relationship('RefreshToken',
+                                  cascade='all, delete-orphan')
+
 
 class Item(Base):
 
     __tablename__ = 'items'
-    __table_args__ = (Index('category_id_idx', 'category_id'),)
+    __table_args__ = (Index('category_id_idx', 'category_id'),
+                      Index('item_key_version_idx', 'key_version'))
 
     id = Column(Integer, Sequence('item_id_seq'), primary_key=True)
     category_id = Column(Integer, Sequence('category_id_seq'),
@@ -37,20 +141,23 @@ class Item(Base):
     username = Column(String(255), nullable=True, default=None)
     password = Column(String(255), nullable=True, default=None)
     blob = Column(String(4096), nullable=False)
+    key_version = Column(Integer, nullable=False, default=0)
     created_at = Column(DateTime, default=lambda: datetime.now(),
                         nullable=False)
     updated_at = Column(DateTime, default=lambda: datetime.now(),
                         nullable=False, onupdate=lambda: datetime.now())
 
     category = relationship('Category')
+    # Tokens are deleted explicitly in bulk, see api.item_delete
+    tokens = relationship('ItemToken', passive_deletes='all')
 
-    def extract(self, cipher):
+    def extract(self, cipher, category_cipher=None):
         # Create a list of all encrypted columns
         row = [self.name, self.url, self.account, self.username,
                self.password, self.blob]
 
         # Concatenate all the columns into one big blob and decrypt
-        row = cipher.decrypt("".join(row))
+        row = cipher.decrypt("".join(row), item_aad(self.id))
 
         # Split decrypted data by delimeter and perform base64 decode
         extracted_values = [base64.b64decode(x).decode() for
@@ -65,19 +172,33 @@ class Item(Base):
                 'password': extracted_values[4],
                 'blob': extracted_values[5]}
         if self.category:
-            item['category'] = self.category.extract(cipher)
+            item['category'] = self.category.extract(
+                category_cipher or cipher)
         else:
             item['category'] = {"id": self.category_id}
 
         return item
 
 
+class ItemToken(Base):
+    """Blind index token of an item, see opp.common.blindindex."""
+
+    __tablename__ = 'item_tokens'
+    __table_args__ = (Index('item_token_token_idx', 'token'),
+                      Index('item_token_item_id_idx', 'item_id'))
+
+    id = Column(Integer, Sequence('item_token_id_seq'), primary_key=True)
+    item_id = Column(Integer, ForeignKey('items.id'), nullable=False)
+    token = Column(String(64), nullable=False)
+
+
 class Category(Base):
 
     __tablename__ = 'categories'
 
     id = Column(Integer, Sequence('category_id_seq'), primary_key=True)
     name = Column(String(255), nullable=False)
+    key_version = Column(Integer, nullable=False, default=0)
     created_at = Column(DateTime, default=lambda: datetime.now(),
                         nullable=False)
     updated_at = Column(DateTime, default=lambda: datetime.now(),
@@ -85,7 +206,109 @@ class Category(Base):
 
     items = relationship('Item', order_by=Item.id)
 
+    def encrypt(self, cipher, name):
+        """Set the encrypted name, the category must have an id."""
+        self.name = cipher.encrypt(name, category_aad(self.id))
+
     def extract(self, cipher):
         category = {'id': self.id,
-                    'name': cipher.decrypt(self.name)}
+                    'name': cipher.decrypt(self.name,
+                                           category_aad(self.id))}
         return category
+
+
+class RekeyJob(Base):
+
+    __tablename__ = 'rekey_jobs'
+
+    id = Column(Integer, Sequence('rekey_job_id_seq'), primary_key=True)
+    from_version = Column(Integer, nullable=False)
+    to_version = Column(Integer, nullable=False)
+    status = Column(String(16), nullable=False, default="running")
+    # HMAC of the new key, to check that a resumed job uses the same one
+    verifier = Column(String(64))
+    categories_done = Column(Integer, nullable=False, default=0)
+    items_done = Column(Integer, nullable=False, default=0)
+    created_at = Column(DateTime, default=lambda: datetime.now(),
+                        nullable=False)
+    updated_at = Column(DateTime, default=lambda: datetime.now(),
+                        nullable=False, onupdate=lambda: datetime.now())
+
+
+class DataKey(Base):
+    """The vault's data encryption key, wrapped by a user's passphrase.
+
+    Items and categories are shared by all users and encrypted with one
+    data key, of which each user has their own wrapped copy. Changing a
+    user's passphrase thus only requires re-wrapping this one row.
+    """
+
+    __tablename__ = 'data_keys'
+
+    id = Column(Integer, Sequence('data_key_id_seq'), primary_key=True)
+    user_id = Column(Integer, ForeignKey('users.id'), nullable=False,
+                     unique=True)
+    wrapped_key = Column(String(255), nullable=False)
+    # Salt and parameters of the passphrase KDF, see opp.common.kdf. Keys
+    # wrapped before these were introduced use an unsalted SHA-256.
+    salt = Column(String(64), nullable=True, default=None)
+    kdf = Column(String(64), nullable=True, default=None)
+    # Identifies the wrapped key, see key_id()
+    key_id = Column(String(64), nullable=True, default=None)
+    created_at = Column(DateTime, default=lambda: datetime.now(),
+                        nullable=False)
+    updated_at = Column(DateTime, default=lambda: datetime.now(),
+                        nullable=False, onupdate=lambda: datetime.now())
+
+    @staticmethod
+    def key_id_of(key):
+        """Return an identifier of a data key, which does not reveal it."""
+        return hmac.new(key, b"opp-data-key-id", hashlib.sha256).hexdigest()
+
+    def wrap(self, cipher, key):
+        self.wrapped_key = cipher.encrypt(
+            base64.b64encode(key).decode()).decode()
+        self.key_id = self.key_id_of(key)
+
+    def unwrap(self, cipher):
+        # A wrong passphrase yields garbage which fails to decode
+        key = base64.b64decode(cipher.decrypt(self.wrapped_key).encode())
+        if len(key) != 32:
+            raise ValueError("Unable to unwrap data key")
+        return key
+
+
+class RefreshToken(Base):
+    """Single-use token which renews a user's JWT without a password.
+
+    Only the SHA-256 of the token is stored. Each use replaces the token
+    with a new one of the same family, and a used token being presented
+    again revokes the whole family, since it may have been stolen.
+    """
+
+    __tablename__ = 'refresh_tokens'
+    __table_args__ = (Index('refresh_token_family_idx', 'family'),
+                      Index('refresh_token_user_id_idx', 'user_id'))
+
+    id = Column(Integer, Sequence('refresh_token_id_seq'), primary_key=True)
+    user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
+    token_hash = Column(String(64), nullable=False, unique=True)
+    family = Column(String(64), nullable=False)
+    used = Column(Boolean, nullable=False, default=False)
+    expires_at = Column(DateTime, nullable=False)
+    created_at = Column(DateTime, default=lambda: datetime.now(),
+                        nullable=False)
+
+
+class RevokedToken(Base):
+    """JWT revoked before its expiry, e.g. by logging out.
+
+    Rows are only needed until the token expires and are deleted after.
+    """
+
+    __tablename__ = 'revoked_tokens'
+    __table_args__ = (Index('revoked_token_expires_at_idx', 'expires_at'),)
+
+    id = Column(Integer, Sequence('revoked_token_id_seq'), primary_key=True)
+    jti = Column(String(64), nullable=False, unique=True)
+    expires_at = Column(DateTime, nullable=False)
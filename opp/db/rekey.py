@@ -0,0 +1,119 @@
+import hashlib
+import hmac
+
+from opp.common import aescipher
+from opp.db import api, models
+
+
+class RekeyError(Exception):
+    pass
+
+
+def _reencrypt(args):
+    """Re-encrypt a chunk of rows, suitable for running in a worker pool.
+
+    :param args: tuple of (old phrase, new phrase, table name, rows)
+    :returns: list of update mappings
+    """
+    old_phrase, new_phrase, table, rows = args
+    old_cipher = aescipher.AEADCipher(old_phrase)
+    new_cipher = aescipher.AEADCipher(new_phrase)
+    if table == 'items':
+        mappings = [models.reencrypt_item(old_cipher, new_cipher,
+                                          list(row[1:]), row[0])
+                    for row in rows]
+    else:
+        mappings = [{'name': models.reencrypt_category(
+            old_cipher, new_cipher, row[1], row[0])} for row in rows]
+    for row, mapping in zip(rows, mappings):
+        mapping['id'] = row[0]
+    return mappings
+
+
+def _verifier(phrase):
+    key = aescipher.AEADCipher(phrase).key
+    return hmac.new(key, b"opp-rekey-verifier", hashlib.sha256).hexdigest()
+
+
+def _split(rows, chunks):
+    size = max(1, -(-len(rows) // chunks))
+    return [rows[i:i + size] for i in range(0, len(rows), size)]
+
+
+def rekey(session, old_phrase, new_phrase, batch_size=500, mapper=map,
+          workers=1, progress=None):
+    """Re-encrypt all categories and items with a new passphrase.
+
+    This only applies to vaults encrypted with passphrase-derived keys;
+    once users have data keys, see :class:`models.DataKey`, changing a
+    passphrase merely re-wraps the user's data key.
+
+    Rows are processed in batches of ``batch_size``; each batch is written
+    together with the job checkpoint in its own transaction, so the service
+    stays available and an interrupted job resumes where it stopped when
+    run again. Every row carries the version of the key it is encrypted
+    with, which lets readers pick the right passphrase mid-migration.
+
+    :param mapper: map-like callable used to spread each batch over
+                   ``workers`` chunks, e.g. ``multiprocessing.Pool.map``
+    :param progress: optional callable receiving the job after each batch
+    :returns: the completed :class:`models.RekeyJob`
+    :raises RekeyError: if the old passphrase is wrong, or if an
+                        interrupted job is resumed with a different new
+                        passphrase than it was started with
+    """
+    verifier = _verifier(new_phrase)
+    job = api.rekey_job_get_latest(session)
+    if job is not None and job.status != "complete":
+        if job.verifier is None:
+            # Started before verifiers were recorded
+            job.verifier = verifier
+            api.rekey_job_update(job, session)
+        elif not hmac.compare_digest(job.verifier, verifier):
+            raise RekeyError("New passphrase differs from the one the "
+                             "interrupted re-key was started with")
+    else:
+        if api.data_key_count(session):
+            raise RekeyError("Vault is encrypted with per-user data keys, "
+                             "change the passphrase through the API")
+        from_version = job.to_version if job else 0
+        job = models.RekeyJob(from_version=from_version,
+                              to_version=from_version + 1,
+                              status="running", verifier=verifier,
+                              categories_done=0, items_done=0)
+        api.rekey_job_create(job, session)
+
+    # Items go first since a wrong old passphrase is most reliably
+    # detected when decrypting them
+    tables = [('items', api.item_get_outdated,
+               api.item_bulk_update, 'items_done'),
+              ('categories', api.category_get_outdated,
+               api.category_bulk_update, 'categories_done')]
+    for table, get_outdated, bulk_update, counter in tables:
+        while True:
+            rows = get_outdated(job.to_version, batch_size, session=session)
+            if not rows:
+                break
+            chunks = [(old_phrase, new_phrase, table, chunk) for
+                      chunk in _split(rows, workers)]
+            try:
+                mappings = [mapping for result in mapper(_reencrypt, chunks)
+                            for mapping in result]
+            except (TypeError, ValueError):
+                session.rollback()
+                raise RekeyError("Unable to decrypt %s with the old "
+                                 "passphrase" % table)
+            for mapping in mappings:
+                mapping['key_version'] = job.to_version
+
+            # The checkpoint is committed atomically with the batch
+            setattr(job, counter, getattr(job, counter) + len(mappings))
+            bulk_update(mappings, session=session)
+            if progress:
+                progress(job)
+
+    # Index tokens are keyed on the old key, they are rebuilt on search
+    api.item_token_delete_all(session)
+    job.status = "complete"
+    api.rekey_job_update(job, session)
+    return job
@@ -1,12 +1,41 @@
-from werkzeug.serving import run_simple
-from werkzeug.wsgi import DispatcherMiddleware
+import six
 
-from opp.flask.frontend import app as frontend
-from opp.flask.backend import app as backend
+from opp.common import opp_config
 
 
-app = DispatcherMiddleware(frontend, {'/api': backend})
+def _get_conf(config):
+    if config is None or isinstance(config, six.string_types):
+        return opp_config.OppConfig(config)
+    return config
+
+
+def create_backend_app(config=None):
+    """Create the API application, to be served on its own or on /api.
+
+    :param config: :class:`opp_config.OppConfig` or path of a config file,
+                   the default locations are read if not given
+    """
+    from opp.flask import backend
+    return backend.create_app(_get_conf(config))
+
+
+def create_frontend_app(config=None):
+    """Create the login page application, see create_backend_app."""
+    from opp.flask import frontend
+    return frontend.create_app(_get_conf(config))
+
+
+def create_app(config=None):
+    """Create the combined application, with the API mounted on /api."""
+    from werkzeug.wsgi import DispatcherMiddleware
+
+    conf = _get_conf(config)
+    return DispatcherMiddleware(create_frontend_app(conf),
+                                {'/api': create_backend_app(conf)})
+
 
 if __name__ == '__main__':
-    run_simple('localhost', 5000, app, use_evalex=True,
+    from werkzeug.serving import run_simple
+
+    run_simple('localhost', 5000, create_app(), use_evalex=True,
                use_reloader=True, use_debugger=True)
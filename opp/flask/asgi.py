@@ -0,0 +1,157 @@
+"""ASGI entry point, e.g. ``uvicorn opp.flask.asgi:app``.
+
+Requires Python 3.5+. Connections, including slow uploads, are handled on
+the event loop, so idle keep-alive clients do not occupy any thread. The
+Flask application, with its request validation, crypto and blocking DB
+access, runs in a thread pool once the whole request has been received.
+CPU-heavy crypto (bcrypt, scrypt, AES) releases the GIL in its C code.
+"""
+import asyncio
+import io
+import json
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+from opp.common import opp_config
+
+
+MAX_BODY_SIZE = 4 * 1024 * 1024
+HEALTH_PATHS = ('/api/v1/health',)
+
+
+def _environ(scope, body):
+    server = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode().decode('latin1'),
+        'PATH_INFO': scope['path'].encode().decode('latin1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': "HTTP/%s" % scope.get('http_version', "1.1"),
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', "http"),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    if scope.get('client'):
+        environ['REMOTE_ADDR'] = scope['client'][0]
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin1').upper().replace('-', '_')
+        value = value.decode('latin1')
+        if name == 'CONTENT_LENGTH':
+            # The body has already been read in full
+            continue
+        if name != 'CONTENT_TYPE':
+            name = 'HTTP_' + name
+        if name in environ:
+            # HTTP/2 clients may split cookies over several headers,
+            # which must be joined like the fields of a single one
+            separator = "; " if name == 'HTTP_COOKIE' else ","
+            value = environ[name] + separator + value
+        environ[name] = value
+    return environ
+
+
+def _call_wsgi(wsgi_app, environ):
+    """Run a WSGI application to completion, buffering its response."""
+    response = {}
+    chunks = []
+
+    def start_response(status, headers, exc_info=None):
+        response['status'] = int(status.split(' ', 1)[0])
+        response['headers'] = headers
+        return chunks.append
+
+    result = wsgi_app(environ, start_response)
+    try:
+        for chunk in result:
+            chunks.append(chunk)
+    finally:
+        if hasattr(result, 'close'):
+            result.close()
+    return response['status'], response['headers'], b"".join(chunks)
+
+
+class AsgiApp(object):
+    """Serve a WSGI application over ASGI from a thread pool."""
+
+    def __init__(self, wsgi_app, threads=32, max_body_size=MAX_BODY_SIZE):
+        self.wsgi_app = wsgi_app
+        self.max_body_size = max_body_size
+        self.executor = ThreadPoolExecutor(max_workers=threads)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+        elif scope['type'] == 'http':
+            await self._http(scope, receive, send)
+        else:
+            raise ValueError("Unsupported ASGI scope type: %s" %
+                             scope['type'])
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.executor.shutdown(wait=True)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def _respond(self, send, status, headers, body):
+        await send({'type': 'http.response.start',
+                    'status': status,
+                    'headers': [(name.lower().encode('latin1'),
+                                 value.encode('latin1'))
+                                for name, value in headers]})
+        await send({'type': 'http.response.body', 'body': body})
+
+    async def _http(self, scope, receive, send):
+        # Liveness probes must not queue behind busy worker threads
+        if scope['method'] == 'GET' and scope['path'] in HEALTH_PATHS:
+            body = json.dumps({'status': "OpenPassPhrase service is "
+                                         "running"}).encode()
+            await self._respond(send, 200,
+                                [('Content-Type', "application/json"),
+                                 ('Content-Length', str(len(body)))], body)
+            return
+
+        chunks = []
+        size = 0
+        more_body = True
+        while more_body:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return
+            chunk = message.get('body', b'')
+            size += len(chunk)
+            if size > self.max_body_size:
+                await self._respond(send, 413,
+                                    [('Content-Type', "application/json")],
+                                    b'{"error": "Request body too large"}')
+                return
+            chunks.append(chunk)
+            more_body = message.get('more_body', False)
+
+        environ = _environ(scope, b"".join(chunks))
+        loop = asyncio.get_event_loop()
+        status, headers, body = await loop.run_in_executor(
+            self.executor, _call_wsgi, self.wsgi_app, environ)
+        await self._respond(send, status, headers, body)
+
+
+def create_app(wsgi_app=None, conf=None):
+    conf = conf or opp_config.OppConfig()
+    if wsgi_app is None:
+        from opp.flask import create_app as create_wsgi_app
+        wsgi_app = create_wsgi_app(conf)
+    return AsgiApp(wsgi_app, threads=int(conf['asgi_threads']))
+
+
+app = create_app()
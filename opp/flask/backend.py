@@ -1,55 +1,151 @@
-from datetime import timedelta
+import base64
+from datetime import datetime, timedelta
+import hashlib
+import importlib
 import json
 import logging
+import os
+import uuid
 
-from flask import Flask, request
+from flask import current_app, Flask, jsonify, request, Response
+import six
 
-from opp.api.v1 import categories, items, users
-from opp.common import opp_config, utils
-from opp.db import api
-from opp.flask.flask_jwt import JWT, jwt_required
+from opp.common import opp_config, ratelimit, responsecache, revocation
+from opp.flask import proxies, tokens
+from opp.flask.flask_jwt import (JWT, JWTError, current_identity,
+                                 current_token, jwt_required)
 
 
-CONF = opp_config.OppConfig()
+# The API handlers pull in SQLAlchemy and the crypto libraries, so they
+# are imported on first use rather than when the app is created
 
 
-# Logging config
-logname = CONF['log_filename'] or '/tmp/openpassphrase.log'
-logging.basicConfig(filename=logname, level=logging.DEBUG)
+def _handler(name, *args):
+    module = importlib.import_module('opp.api.v1.%s' % name)
+    return module.ResponseHandler(request, *args, conf=_conf(),
+                                  limiter=current_app.config['LOGIN_LIMITER'])
 
 
-# JWT and session configs
-CONF = opp_config.OppConfig()
-if CONF['secret_key'] == "default-insecure":
-    logging.warning("Config option 'secret_key' not specified."
-                    " Using default insecure value!")
-try:
-    exp_delta = int(CONF['exp_delta'])
-    if CONF['exp_delta'] > pow(2, 31):
-        logging.warning("Invalid value specified for 'exp_delta' "
-                        "config option. Defaulting to 300 seconds.")
-        exp_delta = 300
-except Exception:
-    logging.warning("Invalid value specified for 'exp_delta' "
-                    "config option. Defaulting to 300 seconds.")
-    exp_delta = 300
-
-# Flask app
-app = Flask(__name__)
-app.config['SECRET_KEY'] = CONF['SECRET_KEY']
-app.config['EXP_DELTA'] = timedelta(seconds=exp_delta)
-app.config['PREFERRED_URL_SCHEME'] = "https"
+def _conf():
+    return current_app.config['OPP_CONF']
 
 
 def authenticate(username, password):
-    user = api.user_get_by_username(username)
+    from opp.common import utils
+    from opp.db import api
+
+    limiter = current_app.config['LOGIN_LIMITER']
+    limiter.check(username=username, ip=request.remote_addr)
+    session = api.get_session(_conf())
+    try:
+        user = api.user_get_by_username(username, session=session)
+    finally:
+        session.close()
     if user and utils.checkpw(password, user.password):
+        # Upgrade hashes of an outdated cost while the password is known
+        rounds = utils.bcrypt_rounds(_conf())
+        if utils.needs_rehash(user.password, rounds):
+            session = api.get_session(_conf())
+            try:
+                api.user_update_password(user, utils.hashpw(password, rounds),
+                                         session=session)
+            finally:
+                session.close()
         return user
+    limiter.failed(username=username)
     return None
 
 
 def identity(payload):
-    return api.user_get_by_id(payload['identity'])
+    from opp.db import api
+
+    # Close sessions in the request's thread, see opp.flask.asgi
+    session = api.get_session(_conf(), read_only=True,
+                              user_id=payload['identity'])
+    try:
+        user = api.user_get_by_id(payload['identity'], session=session)
+    finally:
+        session.close()
+    if user is None and session.replica is not None:
+        # The user may be too new to have reached the replica yet
+        session = api.get_session(_conf())
+        try:
+            user = api.user_get_by_id(payload['identity'], session=session)
+        finally:
+            session.close()
+    return user
+
+
+def _hash_token(token):
+    return hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+
+def _issue_refresh_token(user_id, session, family=None):
+    from opp.db import api, models
+
+    token = base64.urlsafe_b64encode(os.urandom(32)).rstrip(b"=").decode()
+    expires_at = datetime.now() + current_app.config['REFRESH_EXP_DELTA']
+    api.refresh_token_delete_expired(user_id, session=session)
+    api.refresh_token_create(models.RefreshToken(
+        user_id=user_id, token_hash=_hash_token(token),
+        family=family or uuid.uuid4().hex, expires_at=expires_at),
+        session=session)
+    return token
+
+
+def auth_response(access_token, identity):
+    from opp.db import api
+
+    response = {'access_token': access_token.decode('utf-8')}
+    if current_app.config['REFRESH_EXP_DELTA']:
+        session = api.get_session(_conf())
+        try:
+            response['refresh_token'] = _issue_refresh_token(identity.id,
+                                                             session)
+        finally:
+            session.close()
+    return jsonify(response)
+
+
+def _revoked_token_loader(conf):
+    def load():
+        from opp.db import api
+
+        session = api.get_session(conf)
+        try:
+            return api.revoked_token_get_unexpired(session=session)
+        finally:
+            session.close()
+    return load
+
+
+def is_revoked(payload):
+    # Tokens issued before revocation was introduced lack an id
+    jti = payload.get('jti')
+    return jti is not None and current_app.config[
+        'JWT_REVOCATION_LIST'].is_revoked(jti)
+
+
+def _items_cache(conf):
+    try:
+        max_bytes = int(conf['items_cache_size'])
+        ttl = int(conf['items_cache_ttl'])
+    except (TypeError, ValueError):
+        logging.warning("Invalid value specified for 'items_cache_size' "
+                        "or 'items_cache_ttl' config option. Item "
+                        "responses are not cached.")
+        return None
+    if max_bytes <= 0 or ttl <= 0:
+        return None
+    return responsecache.ResponseCache(max_bytes, ttl)
+
+
+def rate_limited(error):
+    response = jsonify({'status_code': 429, 'error': "Too Many Requests",
+                        'description': str(error)})
+    response.status_code = 429
+    response.headers['Retry-After'] = str(error.retry_after)
+    return response
 
 
 def _to_json(dictionary):
@@ -67,46 +163,229 @@ def _enforce_content_type():
         return '{"error": "Invalid Content-Type"}'
 
 
-# JWT helper
-jwt = JWT(app, authenticate, identity)
-
-
-@app.route("/v1/health")
 def health_check():
     return _to_json({'status': "OpenPassPhrase service is running"})
 
 
-@app.route("/v1/users", methods=['PUT', 'POST', 'DELETE'])
+def handle_jwks():
+    keyring = current_app.config.get('JWT_KEYRING')
+    keys = keyring.jwks() if keyring else {'keys': []}
+    response = Response(_to_json(keys), mimetype="application/json")
+    response.cache_control.public = True
+    response.cache_control.max_age = 300
+    return response
+
+
+def handle_refresh():
+    """Exchange a refresh token for a new JWT and refresh token.
+
+    DELETE revokes the refresh token and all tokens it was renewed from or
+    to, e.g. on logout.
+    """
+    from opp.db import api
+
+    err = _enforce_content_type()
+    if err:
+        return err, 400
+    token = (request.get_json(silent=True) or {}).get('refresh_token')
+    if not token or not isinstance(token, six.string_types):
+        raise JWTError('Bad Request', 'Missing refresh token', 400)
+
+    session = api.get_session(_conf())
+    try:
+        row = api.refresh_token_get_by_hash(_hash_token(token),
+                                            session=session)
+        if request.method == 'DELETE':
+            if row:
+                api.refresh_token_revoke_family(row.family, session=session)
+            return _to_json({'result': "success"})
+
+        if (not current_app.config['REFRESH_EXP_DELTA'] or row is None or
+                row.expires_at < datetime.now()):
+            raise JWTError('Invalid refresh token',
+                           'Token is unknown or expired')
+        if not api.refresh_token_use(row, session=session):
+            # A used token presented again may have been stolen
+            api.refresh_token_revoke_family(row.family, session=session)
+            raise JWTError('Invalid refresh token', 'Token was already used')
+        user = api.user_get_by_id(row.user_id, session=session)
+        if user is None:
+            raise JWTError('Invalid refresh token', 'User does not exist')
+
+        access_token = current_app.extensions['jwt'].jwt_encode_callback(user)
+        refresh_token = _issue_refresh_token(user.id, session, row.family)
+    finally:
+        session.close()
+    return jsonify({'access_token': access_token.decode('utf-8'),
+                    'refresh_token': refresh_token})
+
+
+@jwt_required()
+def handle_logout():
+    """Revoke the request's JWT and optionally a refresh token."""
+    from opp.db import api, models
+
+    err = _enforce_content_type()
+    if err:
+        return err, 400
+    jti = current_token.get('jti')
+    if jti is None:
+        raise JWTError('Bad Request', 'Token can not be revoked', 400)
+
+    session = api.get_session(_conf())
+    try:
+        api.revoked_token_create(models.RevokedToken(
+            jti=jti, expires_at=datetime.fromtimestamp(current_token['exp'])),
+            session=session)
+        token = (request.get_json(silent=True) or {}).get('refresh_token')
+        if token and isinstance(token, six.string_types):
+            row = api.refresh_token_get_by_hash(_hash_token(token),
+                                                session=session)
+            if row and row.user_id == current_identity.id:
+                api.refresh_token_revoke_family(row.family, session=session)
+    finally:
+        session.close()
+    current_app.config['JWT_REVOCATION_LIST'].add(jti)
+    return _to_json({'result': "success"})
+
+
 def handle_users():
     err = _enforce_content_type()
     if err:
         return err, 400
-    handler = users.ResponseHandler(request)
+    handler = _handler('users')
     response = handler.respond(require_phrase=False)
     return _to_json(response)
 
 
-@app.route("/v1/categories",
-           methods=['GET', 'PUT', 'POST', 'DELETE'])
 @jwt_required()
 def handle_categories():
     err = _enforce_content_type()
     if err:
         return err, 400
-    handler = categories.ResponseHandler(request)
+    handler = _handler('categories', current_identity)
     # Set require_phrase to True for all methods except DELETE
     response = handler.respond(request.method != 'DELETE')
     return _to_json(response)
 
 
-@app.route("/v1/items",
-           methods=['GET', 'PUT', 'POST', 'DELETE'])
+def _get_items_cached(cache):
+    """Serve GET /v1/items from the response cache, see ITEMS_CACHE."""
+    from opp.db import api
+
+    credentials = (str(current_identity.id),
+                   request.headers.get(current_app.config['JWT_AUTH_HEADER'],
+                                       ""),
+                   request.headers.get('x-opp-phrase', ""),
+                   request.headers.get('x-opp-old-phrase', ""))
+    # Read before the items, so that writes in between invalidate them
+    generation = api.vault_generation()
+    response = cache.get(credentials, request.query_string, generation)
+    if response is None:
+        handler = _handler('items', current_identity)
+        result = handler.respond()
+        response = _to_json(result)
+        if result.get('result') == "success":
+            cache.set(credentials, request.query_string, generation,
+                      response)
+    return response
+
+
 @jwt_required()
 def handle_items():
     err = _enforce_content_type()
     if err:
         return err, 400
-    handler = items.ResponseHandler(request)
+    cache = current_app.config['ITEMS_CACHE']
+    if request.method == 'GET' and cache is not None:
+        return _get_items_cached(cache)
+    handler = _handler('items', current_identity)
     # Set require_phrase to True for all methods except DELETE
     response = handler.respond(request.method != 'DELETE')
     return _to_json(response)
+
+
+@jwt_required()
+def handle_items_search():
+    handler = _handler('search', current_identity)
+    response = handler.respond()
+    return _to_json(response)
+
+
+@jwt_required()
+def handle_items_match():
+    handler = _handler('match', current_identity)
+    response = handler.respond()
+    return _to_json(response)
+
+
+@jwt_required()
+def handle_batch():
+    err = _enforce_content_type()
+    if err:
+        return err, 400
+    handler = _handler('batch', current_identity)
+    response = handler.respond()
+    return _to_json(response)
+
+
+@jwt_required()
+def handle_rekey():
+    err = _enforce_content_type()
+    if err:
+        return err, 400
+    handler = _handler('rekey', current_identity)
+    response = handler.respond()
+    return _to_json(response)
+
+
+ROUTES = [
+    ("/v1/health", health_check, ['GET']),
+    ("/v1/jwks", handle_jwks, ['GET']),
+    ("/v1/auth/refresh", handle_refresh, ['POST', 'DELETE']),
+    ("/v1/auth/logout", handle_logout, ['POST']),
+    ("/v1/users", handle_users, ['PUT', 'POST', 'DELETE']),
+    ("/v1/categories", handle_categories, ['GET', 'PUT', 'POST', 'DELETE']),
+    ("/v1/items", handle_items, ['GET', 'PUT', 'POST', 'DELETE']),
+    ("/v1/items/search", handle_items_search, ['GET']),
+    ("/v1/items/match", handle_items_match, ['GET']),
+    ("/v1/batch", handle_batch, ['POST']),
+    ("/v1/rekey", handle_rekey, ['POST']),
+]
+
+
+def create_app(conf=None):
+    """Create the API application.
+
+    :param conf: :class:`opp_config.OppConfig`, read from the default
+                 locations if not given
+    """
+    conf = conf or opp_config.OppConfig()
+
+    # Logging config
+    logname = conf['log_filename'] or '/tmp/openpassphrase.log'
+    logging.basicConfig(filename=logname, level=logging.DEBUG)
+
+    app = Flask(__name__)
+    app.config['OPP_CONF'] = conf
+    tokens.configure(app, conf)
+    app.config['REFRESH_EXP_DELTA'] = timedelta(seconds=tokens.exp_delta(
+        conf, 'refresh_exp_delta', 2592000))
+    app.config['PREFERRED_URL_SCHEME'] = "https"
+    proxies.configure(app, conf)
+
+    app.config['LOGIN_LIMITER'] = ratelimit.login_limiter(conf)
+    app.errorhandler(ratelimit.RateLimited)(rate_limited)
+    app.config['ITEMS_CACHE'] = _items_cache(conf)
+    app.config['JWT_REVOCATION_LIST'] = revocation.RevocationList(
+        _revoked_token_loader(conf),
+        int(conf['revocation_refresh_interval']))
+
+    for rule, view_func, methods in ROUTES:
+        app.add_url_rule(rule, view_func=view_func, methods=methods)
+
+    # JWT helper
+    jwt = JWT(app, authenticate, identity)
+    jwt.auth_response_handler(auth_response)
+    jwt.token_revoked_handler(is_revoked)
+    return app
@@ -0,0 +1,9 @@
+"""WSGI entry point of the API alone, e.g. for dedicated API workers.
+
+The API is served from the root path, so a front proxy routing ``/api`` to
+it must strip the prefix or pass it as ``SCRIPT_NAME``.
+"""
+from opp.flask import create_backend_app
+
+
+application = create_backend_app()
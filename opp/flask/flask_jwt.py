@@ -10,18 +10,21 @@
     License: MIT
 """
 
+import hashlib
 import logging
+import time
+import uuid
 import warnings
 
 from collections import OrderedDict
 from datetime import datetime, timedelta
 from functools import wraps
 
-import jwt
-
 from flask import current_app, request, jsonify, _request_ctx_stack
 from werkzeug.local import LocalProxy
 
+from opp.common import storage
+
 __version__ = '0.3.2'
 
 logger = logging.getLogger(__name__)
@@ -29,6 +32,9 @@ logger = logging.getLogger(__name__)
 current_identity = LocalProxy(lambda: getattr(_request_ctx_stack.top,
                                               'current_identity', None))
 
+current_token = LocalProxy(lambda: getattr(_request_ctx_stack.top,
+                                           'current_token', None))
+
 _jwt = LocalProxy(lambda: current_app.extensions['jwt'])
 
 CONFIG_DEFAULTS = {
@@ -41,7 +47,8 @@ CONFIG_DEFAULTS = {
     'JWT_AUTH_HEADER': 'x-opp-jwt',
     'JWT_NBF_DELTA': timedelta(seconds=0),
     'JWT_VERIFY_CLAIMS': ['signature', 'exp', 'nbf', 'iat'],
-    'JWT_REQUIRED_CLAIMS': ['exp', 'iat', 'nbf']
+    'JWT_REQUIRED_CLAIMS': ['exp', 'iat', 'nbf'],
+    'JWT_VERIFY_CACHE_SIZE': 1024
 }
 
 
@@ -49,51 +56,124 @@ def _default_jwt_headers_handler(identity):
     return None
 
 
-def _default_jwt_payload_handler(identity):
+def token_payload(identity, exp_delta, nbf_delta=timedelta(seconds=0)):
+    """Return the claims of a new token for the given user id."""
     iat = datetime.utcnow()
-    exp = iat + current_app.config.get('EXP_DELTA')
-    nbf = iat + current_app.config.get('JWT_NBF_DELTA')
+    return {'exp': iat + exp_delta, 'iat': iat, 'nbf': iat + nbf_delta,
+            'identity': identity, 'jti': uuid.uuid4().hex}
+
+
+def _default_jwt_payload_handler(identity):
     identity = getattr(identity, 'id') or identity['id']
-    return {'exp': exp, 'iat': iat, 'nbf': nbf, 'identity': identity}
+    return token_payload(identity, current_app.config.get('EXP_DELTA'),
+                         current_app.config.get('JWT_NBF_DELTA'))
 
 
-def _default_jwt_encode_handler(identity):
-    secret = current_app.config['SECRET_KEY']
-    algorithm = current_app.config['JWT_ALGORITHM']
-    required_claims = current_app.config['JWT_REQUIRED_CLAIMS']
+class JWTVerifier(object):
+    """Token settings of an app, compiled once when the extension is set up.
+
+    Verified tokens are kept in a bounded LRU cache, keyed by their SHA-256
+    digest, until they expire. Repeated requests with the same token thus
+    skip signature verification and claim parsing.
+
+    If the app config has a ``JWT_KEYRING``, see :class:`jwtkeys.KeyRing`,
+    tokens are signed with its current private key and verified with the
+    public key named by their ``kid`` header instead of the secret key.
+    """
+
+    def __init__(self, config):
+        self.key = config['SECRET_KEY']
+        self.keyring = config.get('JWT_KEYRING')
+        self.algorithm = config['JWT_ALGORITHM']
+        self.algorithms = [self.algorithm]
+        self.required_claims = config['JWT_REQUIRED_CLAIMS']
+        self.leeway = config['JWT_LEEWAY']
+        if isinstance(self.leeway, timedelta):
+            self._leeway = self.leeway.total_seconds()
+        else:
+            self._leeway = self.leeway
+
+        self.options = {
+            'verify_' + claim: True
+            for claim in config['JWT_VERIFY_CLAIMS']
+        }
+        self.options.update({
+            'require_' + claim: True
+            for claim in self.required_claims
+        })
+
+        self.cache_size = config['JWT_VERIFY_CACHE_SIZE']
+        self._cache = storage.LRUCache(self.cache_size)
+
+    def _cached(self, digest):
+        now = time.time()
+        entry = self._cache.get(digest, valid=lambda entry: entry[1] > now)
+        return entry[0] if entry else None
+
+    def signing_key(self, headers=None):
+        """Return the key to sign new tokens with and their headers."""
+        if self.keyring is None:
+            return self.key, headers
+        kid, key = self.keyring.signing_key()
+        headers = dict(headers or {})
+        headers['kid'] = kid
+        return key, headers
+
+    def encode(self, payload, headers=None):
+        import jwt
+
+        key, headers = self.signing_key(headers)
+        return jwt.encode(payload, key, algorithm=self.algorithm,
+                          headers=headers)
+
+    def _verification_key(self, token):
+        import jwt
+
+        if self.keyring is None:
+            return self.key
+        kid = jwt.get_unverified_header(token).get('kid')
+        key = self.keyring.public_key(kid)
+        if key is None:
+            raise jwt.InvalidTokenError("Unknown key id")
+        return key
+
+    def decode(self, token):
+        import jwt
+
+        if not isinstance(token, bytes):
+            token = token.encode('utf-8')
+        digest = hashlib.sha256(token).digest()
+        payload = self._cached(digest)
+        if payload is not None:
+            return dict(payload)
+
+        key = self._verification_key(token)
+        payload = jwt.decode(token, key, options=self.options,
+                             algorithms=self.algorithms, leeway=self.leeway)
+        exp = payload.get('exp')
+        if self.cache_size and isinstance(exp, (int, float)):
+            self._cache.set(digest, (dict(payload), exp + self._leeway))
+        return payload
+
+    def clear(self):
+        self._cache.clear()
+
 
+def _default_jwt_encode_handler(identity):
+    verifier = _jwt.verifier
     payload = _jwt.jwt_payload_callback(identity)
-    missing_claims = list(set(required_claims) - set(payload.keys()))
+    missing_claims = list(set(verifier.required_claims) -
+                          set(payload.keys()))
 
     if missing_claims:
         raise RuntimeError('Payload is missing required claims: %s' %
                            ', '.join(missing_claims))
 
-    headers = _jwt.jwt_headers_callback(identity)
-
-    return jwt.encode(payload, secret, algorithm=algorithm, headers=headers)
+    return verifier.encode(payload, _jwt.jwt_headers_callback(identity))
 
 
 def _default_jwt_decode_handler(token):
-    secret = current_app.config['SECRET_KEY']
-    algorithm = current_app.config['JWT_ALGORITHM']
-    leeway = current_app.config['JWT_LEEWAY']
-
-    verify_claims = current_app.config['JWT_VERIFY_CLAIMS']
-    required_claims = current_app.config['JWT_REQUIRED_CLAIMS']
-
-    options = {
-        'verify_' + claim: True
-        for claim in verify_claims
-    }
-
-    options.update({
-        'require_' + claim: True
-        for claim in required_claims
-    })
-
-    return jwt.decode(token, secret, options=options,
-                      algorithms=[algorithm], leeway=leeway)
+    return _jwt.verifier.decode(token)
 
 
 def _default_request_handler():
@@ -162,17 +242,23 @@ def _jwt_required(realm):
                        'Request does not contain an access token',
                        headers={'WWW-Authenticate': 'JWT realm="%s"' % realm})
 
+    import jwt
     try:
         payload = _jwt.jwt_decode_callback(token)
     except jwt.InvalidTokenError as e:
         raise JWTError('Invalid token', str(e))
 
+    if (_jwt.token_revoked_callback is not None and
+            _jwt.token_revoked_callback(payload)):
+        raise JWTError('Invalid token', 'Token has been revoked')
+
     identity = _jwt.identity_callback(payload)
 
     if identity is None:
         raise JWTError('Invalid JWT', 'User does not exist')
 
     _request_ctx_stack.top.current_identity = identity
+    _request_ctx_stack.top.current_token = payload
 
 
 def jwt_required(realm=None):
@@ -223,6 +309,7 @@ class JWT(object):
         self.jwt_payload_callback = _default_jwt_payload_handler
         self.jwt_error_callback = _default_jwt_error_handler
         self.request_callback = _default_request_handler
+        self.token_revoked_callback = None
 
         if app is not None:
             self.init_app(app)
@@ -247,6 +334,8 @@ class JWT(object):
 
         app.errorhandler(JWTError)(self._jwt_error_callback)
 
+        self.verifier = JWTVerifier(app.config)
+
         if not hasattr(app, 'extensions'):  # pragma: no cover
             app.extensions = {}
 
@@ -333,6 +422,16 @@ class JWT(object):
         self.request_callback = callback
         return callback
 
+    def token_revoked_handler(self, callback):
+        """Specifies the revocation check function.
+        This function receives the verified JWT payload and returns
+        whether the token has been revoked.
+
+        :param callable callback: the revocation check function
+        """
+        self.token_revoked_callback = callback
+        return callback
+
     def jwt_encode_handler(self, callback):
         """Specifies the encoding handler function.
         This function receives a payload and signs it.
@@ -1,45 +1,160 @@
+import calendar
+from datetime import datetime
+import json
 import logging
+import sqlite3
+import time
+
+from flask import (current_app, escape, Flask, redirect, request, session,
+                   url_for)
+from flask.sessions import SessionInterface, SessionMixin
+from werkzeug.datastructures import CallbackDict
+
+from opp.common import opp_config, ratelimit, sessions
+from opp.flask import proxies, tokens
+from opp.flask.flask_jwt import JWTVerifier, token_payload
+
+
+# Access tokens are renewed when they expire within this many seconds
+TOKEN_RENEW_MARGIN = 30
+
+
+class ServerSession(CallbackDict, SessionMixin):
+
+    def __init__(self, initial=None, sid=None, expires=None):
+        def on_update(self):
+            self.modified = True
+        CallbackDict.__init__(self, initial, on_update)
+        self.sid = sid
+        self.expires = expires
+        self.new = expires is None
+        self.modified = False
+
+
+class ServerSessionInterface(SessionInterface):
+    """Keep session data server-side, see :mod:`opp.common.sessions`."""
+
+    def __init__(self, manager):
+        self.manager = manager
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(app.config['SESSION_COOKIE_NAME'])
+        if sid:
+            loaded = self.manager.load(sid)
+            if loaded is not None:
+                return ServerSession(loaded[0], sid, loaded[1])
+        return ServerSession(sid=self.manager.new_id())
+
+    def regenerate(self, session):
+        """Move a session to a new id, e.g. on login, so that an id known
+        before can not be used to take it over."""
+        if not session.new:
+            self.manager.delete(session.sid)
+        session.sid = self.manager.new_id()
+        session.expires = None
+        session.new = True
+        session.modified = True
+
+    def save_session(self, app, session, response):
+        name = app.config['SESSION_COOKIE_NAME']
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        if not session:
+            if not session.new:
+                self.manager.delete(session.sid)
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+        self.manager.save(session.sid, dict(session), session.expires,
+                          session.modified)
+        if session.new:
+            response.set_cookie(name, session.sid,
+                                httponly=self.get_cookie_httponly(app),
+                                secure=self.get_cookie_secure(app),
+                                domain=domain, path=path)
 
-from flask import escape, Flask, redirect, request, session, url_for
-
-from opp.common import opp_config, utils
-from opp.db import api
-
-
-CONF = opp_config.OppConfig()
 
+def authenticate(username, password):
+    from opp.common import utils
+    from opp.db import api
+
+    limiter = current_app.config['LOGIN_LIMITER']
+    limiter.check(username=username, ip=request.remote_addr)
+    conf = current_app.config['OPP_CONF']
+    db_session = api.get_session(conf)
+    try:
+        user = api.user_get_by_username(username, session=db_session)
+    finally:
+        db_session.close()
+    if user and utils.checkpw(password, user.password):
+        rounds = utils.bcrypt_rounds(conf)
+        if utils.needs_rehash(user.password, rounds):
+            db_session = api.get_session(conf)
+            try:
+                api.user_update_password(user, utils.hashpw(password, rounds),
+                                         session=db_session)
+            finally:
+                db_session.close()
+        return user
+    limiter.failed(username=username)
+    return None
 
-# Logging config
-logname = CONF['log_filename'] or '/tmp/openpassphrase.log'
-logging.basicConfig(filename=logname, level=logging.DEBUG)
 
+def _issue_token(user_id):
+    payload = token_payload(user_id, current_app.config['EXP_DELTA'],
+                            current_app.config['JWT_NBF_DELTA'])
+    exp = calendar.timegm(payload['exp'].utctimetuple())
+    token = current_app.config['JWT_VERIFIER'].encode(payload)
+    session['access_token'] = token.decode('utf-8')
+    session['token_exp'] = exp
+    session['token_jti'] = payload['jti']
 
-# Flask app
-app = Flask(__name__)
-app.config['SECRET_KEY'] = CONF['SECRET_KEY']
-app.config['PREFERRED_URL_SCHEME'] = "https"
 
+def _revoke_token():
+    from opp.db import api, models
 
-def authenticate(username, password):
-    user = api.user_get_by_username(username)
-    if user and utils.checkpw(password, user.password):
-        return user
-    return None
+    jti = session.get('token_jti')
+    if jti is None or session['token_exp'] <= time.time():
+        return
+    db_session = api.get_session(current_app.config['OPP_CONF'])
+    try:
+        api.revoked_token_create(models.RevokedToken(
+            jti=jti, expires_at=datetime.fromtimestamp(session['token_exp'])),
+            session=db_session)
+    finally:
+        db_session.close()
 
 
-@app.route('/')
 def index():
     if 'username' in session:
         return 'Logged in as %s' % escape(session['username'])
     return redirect(url_for('login'))
 
 
-@app.route('/login', methods=['GET', 'POST'])
+def token():
+    """Return an API access token for the logged-in user.
+
+    Tokens are issued from the session, so the web UI can call the API
+    without the password being checked again.
+    """
+    if 'user_id' not in session:
+        return ('{"error": "Not logged in"}', 401,
+                {'Content-Type': "application/json"})
+    if session['token_exp'] - time.time() < TOKEN_RENEW_MARGIN:
+        _issue_token(session['user_id'])
+    return (json.dumps({'access_token': session['access_token']}), 200,
+            {'Content-Type': "application/json",
+             'Cache-Control': "no-store"})
+
+
 def login():
     if request.method == 'POST':
-        user = api.user_get_by_username(request.form['username'])
-        if user and utils.checkpw(request.form['password'], user.password):
-            session['username'] = request.form['username']
+        user = authenticate(request.form['username'],
+                            request.form['password'])
+        if user:
+            current_app.session_interface.regenerate(session)
+            session['username'] = user.username
+            session['user_id'] = user.id
+            _issue_token(user.id)
             return redirect(url_for('index'))
         else:
             return redirect(url_for('login'))
@@ -54,8 +169,62 @@ def login():
     '''
 
 
-@app.route('/logout')
+def rate_limited(error):
+    return ('Too many login attempts, retry in %d seconds' %
+            error.retry_after, 429, {'Retry-After': str(error.retry_after)})
+
+
 def logout():
-    # remove the username from the session if it's there
-    session.pop('username', None)
+    # End the session, along with the API access token issued from it
+    _revoke_token()
+    session.clear()
     return redirect(url_for('index'))
+
+
+def _session_store(conf):
+    try:
+        return sessions.create_store(sessions.store_url(conf))
+    except (ValueError, OSError, sqlite3.Error) as e:
+        logging.warning("%s. Using the in-memory session store.", str(e))
+        return sessions.MemoryStore()
+
+
+def _session_lifetime(conf):
+    lifetime = tokens.exp_delta(conf, 'frontend_session_lifetime', 1800)
+    if lifetime <= 0:
+        logging.warning("Invalid value specified for "
+                        "'frontend_session_lifetime' config option. "
+                        "Defaulting to 1800 seconds.")
+        lifetime = 1800
+    return lifetime
+
+
+def create_app(conf=None):
+    """Create the login page application.
+
+    :param conf: :class:`opp_config.OppConfig`, read from the default
+                 locations if not given
+    """
+    conf = conf or opp_config.OppConfig()
+
+    # Logging config
+    logname = conf['log_filename'] or '/tmp/openpassphrase.log'
+    logging.basicConfig(filename=logname, level=logging.DEBUG)
+
+    app = Flask(__name__)
+    app.config['OPP_CONF'] = conf
+    tokens.configure(app, conf)
+    app.config['JWT_VERIFIER'] = JWTVerifier(app.config)
+    app.config['PREFERRED_URL_SCHEME'] = "https"
+    proxies.configure(app, conf)
+    app.config['LOGIN_LIMITER'] = ratelimit.login_limiter(conf)
+    app.errorhandler(ratelimit.RateLimited)(rate_limited)
+    app.session_interface = ServerSessionInterface(
+        sessions.SessionManager(_session_store(conf),
+                                _session_lifetime(conf)))
+
+    app.add_url_rule('/', view_func=index)
+    app.add_url_rule('/token', view_func=token)
+    app.add_url_rule('/login', view_func=login, methods=['GET', 'POST'])
+    app.add_url_rule('/logout', view_func=logout)
+    return app
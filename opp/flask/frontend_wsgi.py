@@ -0,0 +1,5 @@
+"""WSGI entry point of the login page alone, see opp.flask.backend_wsgi."""
+from opp.flask import create_frontend_app
+
+
+application = create_frontend_app()
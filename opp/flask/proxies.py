@@ -0,0 +1,34 @@
+"""Client addresses behind reverse proxies, shared by the API and the login
+page, so that login attempts are limited per client rather than per proxy.
+"""
+import logging
+
+try:
+    from werkzeug.middleware.proxy_fix import ProxyFix
+except ImportError:
+    # Werkzeug < 0.15
+    from werkzeug.contrib.fixers import ProxyFix
+
+
+def trusted_proxies(conf):
+    try:
+        proxies = int(conf['trusted_proxies'])
+        if proxies < 0:
+            raise ValueError(proxies)
+    except (TypeError, ValueError):
+        logging.warning("Invalid value specified for 'trusted_proxies' "
+                        "config option. Defaulting to 0.")
+        proxies = 0
+    return proxies
+
+
+def configure(app, conf):
+    """Take the remote address of a Flask app's requests from the
+    X-Forwarded-For header set by the configured number of proxies."""
+    proxies = trusted_proxies(conf)
+    if not proxies:
+        return
+    try:
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=proxies)
+    except TypeError:
+        app.wsgi_app = ProxyFix(app.wsgi_app, num_proxies=proxies)
@@ -0,0 +1,53 @@
+"""JWT settings of an OppConfig, shared by the API and the login page, so
+that tokens issued by either are accepted by the API."""
+from datetime import timedelta
+import logging
+
+from opp.common import jwtkeys
+from opp.flask.flask_jwt import CONFIG_DEFAULTS
+
+
+ALGORITHMS = ['HS256', 'HS384', 'HS512', 'RS256', 'RS384', 'RS512',
+              'PS256', 'PS384', 'PS512', 'ES256', 'ES384', 'ES512']
+
+
+def exp_delta(conf, option='exp_delta', default=300):
+    try:
+        exp_delta = int(conf[option])
+        if exp_delta > pow(2, 31):
+            logging.warning("Invalid value specified for '%s' "
+                            "config option. Defaulting to %d seconds.",
+                            option, default)
+            exp_delta = default
+    except Exception:
+        logging.warning("Invalid value specified for '%s' "
+                        "config option. Defaulting to %d seconds.",
+                        option, default)
+        exp_delta = default
+    return exp_delta
+
+
+def algorithm(conf):
+    algorithm = conf['jwt_algorithm']
+    if algorithm not in ALGORITHMS:
+        logging.warning("Invalid value specified for 'jwt_algorithm' "
+                        "config option. Defaulting to HS256.")
+        algorithm = "HS256"
+    return algorithm
+
+
+def configure(app, conf):
+    """Set the JWT options of a Flask app from an OppConfig."""
+    if conf['secret_key'] == "default-insecure":
+        logging.warning("Config option 'secret_key' not specified."
+                        " Using default insecure value!")
+
+    for k, v in CONFIG_DEFAULTS.items():
+        app.config.setdefault(k, v)
+    app.config['SECRET_KEY'] = conf['SECRET_KEY']
+    app.config['EXP_DELTA'] = timedelta(seconds=exp_delta(conf))
+    app.config['JWT_ALGORITHM'] = algorithm(conf)
+    if jwtkeys.key_type(app.config['JWT_ALGORITHM']):
+        app.config['JWT_KEYRING'] = jwtkeys.KeyRing(
+            conf['jwt_key_dir'], app.config['JWT_ALGORITHM'],
+            conf['jwt_signing_kid'])
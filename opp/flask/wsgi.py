@@ -0,0 +1,7 @@
+"""WSGI entry point of the combined application, e.g.
+``gunicorn opp.flask.wsgi:application``.
+"""
+from opp.flask import create_app
+
+
+application = create_app()
@@ -3,12 +3,16 @@ import os
 import tempfile
 import unittest
 
-from opp.flask.backend import app
+from opp.api.v1 import base_handler, search
+from opp.flask import backend
 from opp.common import utils
 
 
 class BackendApiTest(unittest.TestCase):
 
+    # Additional config options of the test class
+    config = {}
+
     @classmethod
     def setUpClass(cls):
         # Create test directory, config file and database
@@ -18,12 +22,19 @@ class BackendApiTest(unittest.TestCase):
         with open(cls.conf_filepath, 'w') as conf_file:
             conf_file.write("[DEFAULT]\ndb_connect = sqlite:///%s" %
                             cls.db_filepath)
+            for option, value in cls.config.items():
+                conf_file.write("\n%s = %s" % (option, value))
             conf_file.flush()
         os.environ['OPP_TOP_CONFIG'] = cls.conf_filepath
         utils.execute("opp-db --config_file %s init" % cls.conf_filepath)
 
+        # Cached data keys and index state belong to the previous test
+        # class' database
+        base_handler.DATA_KEYS.clear()
+        search.BACKFILLS.clear()
+
         # Create a test client and propgate exceptions to it
-        cls.client = app.test_client()
+        cls.client = backend.create_app().test_client()
         cls.client.testing = True
 
         # Create a user, authenticate and store JWT
@@ -0,0 +1,86 @@
+from opp.api.v1 import batch
+
+from . import BackendApiTest
+
+
+class TestApiBatch(BackendApiTest):
+
+    """These tests exercise the top level request/response functionality of
+    the backend API.
+    Note: All tests share the same DB, so please beware of
+    unintended interaction when adding new tests"""
+
+    def setUp(self):
+        self.hdrs = {'x-opp-phrase': "123",
+                     'x-opp-jwt': self.jwt,
+                     'Content-Type': "application/json"}
+
+    def _batch(self, ops):
+        return self._post('/v1/batch', {'payload': ops})
+
+    def test_batch(self):
+        ops = [{'endpoint': "categories", 'method': "PUT",
+                'body': {'payload': ["c1"]}},
+               {'endpoint': "items", 'method': "PUT",
+                'body': {'payload': [{'name': "i1"}, {'name': "i2"}]}},
+               {'endpoint': "items", 'method': "GET",
+                'args': {'limit': "1"}},
+               {'endpoint': "categories", 'method': "GET"}]
+        data = self._batch(ops)
+        self.assertEqual(data['result'], "success")
+        results = data['results']
+        self.assertEqual(results[0], {'result': "success"})
+        self.assertEqual(results[1], {'result': "success"})
+        # Reads see the earlier writes of the batch
+        self.assertEqual([i['name'] for i in results[2]['items']], ["i1"])
+        category_id = results[3]['categories'][0]['id']
+
+        items = self._get('/v1/items')['items']
+        self.assertEqual([i['name'] for i in items], ["i1", "i2"])
+
+        # Reorganize and clean up in one request
+        ops = [{'endpoint': "items", 'method': "POST",
+                'body': {'payload': [{'id': items[0]['id'], 'name': "i1",
+                                      'category_id': category_id}]}},
+               {'endpoint': "items", 'method': "DELETE",
+                'body': {'payload': [items[1]['id']]}},
+               {'endpoint': "categories", 'method': "DELETE",
+                'body': {'payload': {'cascade': True,
+                                     'ids': [category_id]}}}]
+        data = self._batch(ops)
+        self.assertEqual(data['result'], "success")
+        self.assertEqual(self._get('/v1/items')['items'], [])
+        self.assertEqual(self._get('/v1/categories')['categories'], [])
+
+    def test_batch_rollback(self):
+        ops = [{'endpoint': "items", 'method': "PUT",
+                'body': {'payload': [{'name': "i1"}]}},
+               {'endpoint': "items", 'method': "POST",
+                'body': {'payload': [{'name': "no id"}]}},
+               {'endpoint': "items", 'method': "PUT",
+                'body': {'payload': [{'name': "i2"}]}}]
+        data = self._batch(ops)
+        self.assertEqual(data['result'], "error")
+        self.assertEqual(data['message'],
+                         "Operation 1 failed, no changes were made!")
+        self.assertEqual(data['results'],
+                         [{'result': "success"},
+                          {'result': "error",
+                           'message': "Missing item id in list!"}])
+        self.assertEqual(self._get('/v1/items')['items'], [])
+
+    def test_batch_error_conditions(self):
+        data = self._batch([{'endpoint': "rekey", 'method': "POST"}])
+        self.assertEqual(data['message'], "Invalid operation 0!")
+        data = self._batch([{'endpoint': "items", 'method': "GET"},
+                            {'endpoint': "items", 'method': "PATCH"}])
+        self.assertEqual(data['message'], "Invalid operation 1!")
+        data = self._batch([{'endpoint': "items", 'method': "GET",
+                             'body': []}])
+        self.assertEqual(data['message'], "Invalid operation 0!")
+        data = self._batch(["items"])
+        self.assertEqual(data['message'], "Invalid operation 0!")
+        data = self._batch([{'endpoint': "items", 'method': "GET"}] *
+                           (batch.MAX_OPERATIONS + 1))
+        self.assertEqual(data['message'],
+                         "Too many operations, the maximum is 100!")
@@ -126,3 +126,61 @@ class TestApiItems(BackendApiTest):
         data = self._get(path)
         self.assertEqual(data['result'], "success")
         self.assertEqual(data['items'], [])
+
+    def test_items_filter(self):
+        self.hdrs = {'x-opp-phrase': "123",
+                     'x-opp-jwt': self.jwt,
+                     'Content-Type': "application/json"}
+        path = '/v1/items'
+
+        # Add 2 categories with 2 items each and 2 uncategorized items
+        data = self._put('/v1/categories', {'payload': ["c1", "c2"]})
+        self.assertEqual(data['result'], "success")
+        c1, c2 = [c['id'] for c in
+                  self._get('/v1/categories')['categories']]
+        data = {'payload': [{'name': "i1", 'category_id': c1},
+                            {'name': "i2", 'category_id': c2},
+                            {'name': "i3"},
+                            {'name': "i4", 'category_id': c1},
+                            {'name': "i5", 'category_id': c2},
+                            {'name': "i6"}]}
+        self.assertEqual(self._put(path, data)['result'], "success")
+
+        def names(query):
+            data = self._get(path + query)
+            self.assertEqual(data['result'], "success")
+            return [item['name'] for item in data['items']]
+
+        # Filter by category
+        self.assertEqual(names("?category_id=%d" % c1), ["i1", "i4"])
+        self.assertEqual(names("?category_id=uncategorized"), ["i3", "i6"])
+        self.assertEqual(names("?category_id=%d,uncategorized" % c2),
+                         ["i2", "i3", "i5", "i6"])
+        self.assertEqual(names("?category_id=%d&category_id=%d" % (c1, c2)),
+                         ["i1", "i2", "i4", "i5"])
+
+        # Paginate through a category view
+        data = self._get(path + "?category_id=%d,%d&limit=3" % (c1, c2))
+        self.assertEqual([i['name'] for i in data['items']],
+                         ["i1", "i2", "i4"])
+        marker = data['next_marker']
+        data = self._get(path + "?category_id=%d,%d&limit=3&marker=%d" %
+                         (c1, c2, marker))
+        self.assertEqual([i['name'] for i in data['items']], ["i5"])
+        self.assertNotIn('next_marker', data)
+
+        # Invalid filters
+        for query in ("?category_id=x", "?limit=0", "?limit=x",
+                      "?marker=-1"):
+            data = self._get(path + query)
+            self.assertEqual(data['result'], "error")
+        self.assertEqual(self._get(path + "?limit=x")['message'],
+                         "Invalid limit!")
+        self.assertEqual(self._get(path + "?category_id=1,x")['message'],
+                         "Invalid category id!")
+
+        # Clean up
+        self._delete('/v1/categories',
+                     {'payload': {'cascade': True, 'ids': [c1, c2]}})
+        ids = [item['id'] for item in self._get(path)['items']]
+        self._delete(path, {'payload': ids})
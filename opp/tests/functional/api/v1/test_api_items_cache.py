@@ -0,0 +1,62 @@
+import mock
+
+from opp.api.v1 import items
+
+from . import BackendApiTest, test_api_items
+
+
+class TestApiItemsCached(test_api_items.TestApiItems):
+
+    """Run the item tests with cached responses, which must not change."""
+    config = {'items_cache_size': 1000000}
+
+
+class TestApiItemsCache(BackendApiTest):
+
+    config = {'items_cache_size': 1000000}
+
+    def setUp(self):
+        self.hdrs = {'x-opp-phrase': "123", 'x-opp-jwt': self.jwt,
+                     'Content-Type': "application/json"}
+        self.cache = self.client.application.config['ITEMS_CACHE']
+
+    def tearDown(self):
+        self.cache.clear()
+
+    def test_cache_hit(self):
+        self._put('/v1/items', {'payload': [{"name": "cached"}]})
+        first = self._get('/v1/items')
+        with mock.patch.object(items.ResponseHandler, 'respond') as respond:
+            self.assertEqual(self._get('/v1/items'), first)
+            respond.assert_not_called()
+
+        # Responses are cached per query and credentials
+        self._get('/v1/items?limit=1')
+        self.assertEqual(len(self.cache), 2)
+        self.hdrs['x-opp-phrase'] = "wrong"
+        self.assertEqual(self._get('/v1/items')['result'], "error")
+        self.assertEqual(len(self.cache), 2)
+
+        # Plaintext is not kept in memory
+        for enc, _, _ in self.cache._entries.values():
+            self.assertNotIn(b"cached", enc)
+
+    def test_invalidation(self):
+        self._put('/v1/items', {'payload': [{"name": "inv"}]})
+        self._put('/v1/categories', {'payload': ["c_inv"]})
+        self._get('/v1/items')
+        category = self._get('/v1/categories')['categories'][-1]
+        item = [i for i in self._get('/v1/items')['items']
+                if i['name'] == "inv"][0]
+        self._post('/v1/items', {'payload': [{'id': item['id'],
+                                              'category_id': category['id']}]})
+        item = [i for i in self._get('/v1/items')['items']
+                if i['id'] == item['id']][0]
+        self.assertEqual(item['category']['name'], "c_inv")
+
+        # Category writes change the items they hold
+        self._post('/v1/categories', {'payload': [{'id': category['id'],
+                                                   'name': "c_new"}]})
+        item = [i for i in self._get('/v1/items')['items']
+                if i['id'] == item['id']][0]
+        self.assertEqual(item['category']['name'], "c_new")
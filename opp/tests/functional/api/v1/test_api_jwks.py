@@ -0,0 +1,94 @@
+from datetime import datetime, timedelta
+import json
+import os
+import shutil
+import tempfile
+import time
+
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives.asymmetric import rsa
+import jwt
+
+from opp.tests.unit.test_common import _write_key
+
+from . import BackendApiTest
+
+
+def _rsa_key():
+    return rsa.generate_private_key(65537, 2048, default_backend())
+
+
+class TestApiJwksHmac(BackendApiTest):
+
+    def test_jwks_empty(self):
+        resp = self.client.get('/v1/jwks')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(json.loads(resp.data.decode()), {'keys': []})
+        self.assertIsNone(jwt.get_unverified_header(self.jwt).get('kid'))
+
+
+class TestApiJwks(BackendApiTest):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.key_dir = tempfile.mkdtemp(prefix='opp_')
+        cls.k1 = _rsa_key()
+        path = os.path.join(cls.key_dir, "k1.pem")
+        _write_key(path, cls.k1)
+        mtime = time.time() - 10
+        os.utime(path, (mtime, mtime))
+        cls.config = {'jwt_algorithm': "RS256", 'jwt_key_dir': cls.key_dir}
+        super(TestApiJwks, cls).setUpClass()
+        cls.keyring = cls.client.application.config['JWT_KEYRING']
+
+    @classmethod
+    def tearDownClass(cls):
+        super(TestApiJwks, cls).tearDownClass()
+        shutil.rmtree(cls.key_dir, ignore_errors=True)
+
+    def _items(self, token):
+        hdrs = {'x-opp-phrase': "123", 'x-opp-jwt': token}
+        return self.client.get('/v1/items', headers=hdrs).status_code
+
+    def _auth(self):
+        headers = {"Content-Type": "application/json"}
+        data = json.dumps({'username': "u", 'password': "p"})
+        resp = self.client.post("/v1/auth", headers=headers, data=data)
+        return json.loads(resp.data.decode())['access_token']
+
+    def test_rotation(self):
+        header = jwt.get_unverified_header(self.jwt)
+        self.assertEqual(header['kid'], "k1")
+        self.assertEqual(header['alg'], "RS256")
+        self.assertEqual(self._items(self.jwt), 200)
+
+        resp = self.client.get('/v1/jwks')
+        self.assertEqual(resp.headers['Content-Type'], "application/json")
+        keys = json.loads(resp.data.decode())['keys']
+        self.assertEqual([key['kid'] for key in keys], ["k1"])
+
+        # Sign with a new key, tokens of the old one remain valid
+        _write_key(os.path.join(self.key_dir, "k2.pem"), _rsa_key())
+        os.remove(os.path.join(self.key_dir, "k1.pem"))
+        _write_key(os.path.join(self.key_dir, "k1.pub.pem"), self.k1,
+                   private=False)
+        self.keyring.refresh(force=True)
+        token = self._auth()
+        self.assertEqual(jwt.get_unverified_header(token)['kid'], "k2")
+        self.assertEqual(self._items(token), 200)
+        self.assertEqual(self._items(self.jwt), 200)
+        keys = json.loads(self.client.get('/v1/jwks').data.decode())['keys']
+        self.assertEqual([key['kid'] for key in keys], ["k1", "k2"])
+
+    def test_unknown_kid(self):
+        now = datetime.utcnow()
+        payload = {'iat': now, 'nbf': now, 'identity': 1,
+                   'exp': now + timedelta(seconds=60)}
+        token = jwt.encode(payload, self.k1, algorithm="RS256",
+                           headers={'kid': "k0"}).decode()
+        self.assertEqual(self._items(token), 401)
+
+        # The signing secret must not be accepted in place of the key
+        token = jwt.encode(payload, "default-insecure", algorithm="HS256",
+                           headers={'kid': "k1"}).decode()
+        self.assertEqual(self._items(token), 401)
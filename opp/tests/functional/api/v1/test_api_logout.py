@@ -0,0 +1,53 @@
+import json
+
+import jwt
+
+from opp.flask import backend
+
+from . import BackendApiTest
+
+
+class TestApiLogout(BackendApiTest):
+
+    # Let other app instances see revocations immediately
+    config = {'revocation_refresh_interval': 0}
+
+    def _login(self):
+        self.hdrs = {"Content-Type": "application/json"}
+        return self._post('/v1/auth', {'username': "u", 'password': "p"})
+
+    def _items_status(self, access_token, client=None):
+        hdrs = {'x-opp-phrase': "123", 'x-opp-jwt': access_token}
+        client = client or self.client
+        return client.get('/v1/items', headers=hdrs).status_code
+
+    def test_logout(self):
+        tokens = self._login()
+        other = self._login()
+        self.assertIsNotNone(
+            jwt.decode(tokens['access_token'], verify=False).get('jti'))
+
+        # Another worker process, which has verified the token before
+        worker = backend.create_app().test_client()
+        self.assertEqual(self._items_status(tokens['access_token'], worker),
+                         200)
+
+        self.hdrs = {'x-opp-jwt': tokens['access_token'],
+                     'Content-Type': "application/json"}
+        data = self._post('/v1/auth/logout',
+                          {'refresh_token': tokens['refresh_token']})
+        self.assertEqual(data['result'], "success")
+
+        resp = self.client.get('/v1/items', headers=self.hdrs)
+        self.assertEqual(resp.status_code, 401)
+        self.assertEqual(json.loads(resp.data.decode())['description'],
+                         "Token has been revoked")
+        self.assertEqual(self._items_status(tokens['access_token'], worker),
+                         401)
+        self._post('/v1/auth/logout', code=401)
+
+        # The refresh token is revoked, other logins are not affected
+        self.hdrs = {"Content-Type": "application/json"}
+        self._post('/v1/auth/refresh',
+                   {'refresh_token': tokens['refresh_token']}, 401)
+        self.assertEqual(self._items_status(other['access_token']), 200)
@@ -0,0 +1,88 @@
+import os
+import tempfile
+
+from . import BackendApiTest
+
+
+SUFFIXES = ["com", "uk", "co.uk", "io", "github.io"]
+
+
+class MatchApiTestMixin(object):
+
+    @classmethod
+    def setUpClass(cls):
+        # Use a small suffix list so the tests do not depend on the host's
+        fd, cls.psl_filepath = tempfile.mkstemp(prefix='opp_psl_')
+        with os.fdopen(fd, 'w') as psl_file:
+            psl_file.write("\n".join(SUFFIXES))
+        cls.config = dict(cls.config, public_suffix_list=cls.psl_filepath)
+        super(MatchApiTestMixin, cls).setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super(MatchApiTestMixin, cls).tearDownClass()
+        os.remove(cls.psl_filepath)
+
+    def setUp(self):
+        self.hdrs = {'x-opp-phrase': "123",
+                     'x-opp-jwt': self.jwt,
+                     'Content-Type': "application/json"}
+        data = {'payload': [
+            {'name': "Google", 'url': "https://google.com"},
+            {'name': "Gmail", 'url': "https://mail.google.com/inbox"},
+            {'name': "BBC", 'url': "https://www.bbc.co.uk"},
+            {'name': "Other BBC", 'url': "https://other.co.uk"},
+            {'name': "Evil", 'url': "https://google.com.evil.io"},
+            {'name': "Pages", 'url': "https://victim.github.io"}]}
+        self.assertEqual(self._put('/v1/items', data)['result'], "success")
+
+    def tearDown(self):
+        ids = [item['id'] for item in self._get('/v1/items')['items']]
+        self._delete('/v1/items', {'payload': ids})
+
+    def _match(self, origin):
+        data = self._get('/v1/items/match?origin=%s' % origin)
+        self.assertEqual(data['result'], "success")
+        return [item['name'] for item in data['items']]
+
+    def test_match(self):
+        self.assertEqual(self._match("https://mail.google.com"),
+                         ["Gmail", "Google"])
+        self.assertEqual(self._match("https://accounts.google.com:443"),
+                         ["Google", "Gmail"])
+        self.assertEqual(self._match("https://news.bbc.co.uk"), ["BBC"])
+        self.assertEqual(self._match("https://example.com"), [])
+        self.assertEqual(self._match("https://victim.github.io"), ["Pages"])
+        self.assertEqual(self._match("https://evil.github.io"), [])
+
+    def test_match_invalid_origin(self):
+        data = self._get('/v1/items/match')
+        self.assertEqual(data['message'], "Missing or invalid origin!")
+        data = self._get('/v1/items/match?origin=https://')
+        self.assertEqual(data['message'], "Missing or invalid origin!")
+
+
+class TestApiMatchIndex(MatchApiTestMixin, BackendApiTest):
+
+    config = {'search_index': "true"}
+
+
+class TestApiMatchNoIndex(MatchApiTestMixin, BackendApiTest):
+    pass
+
+
+class TestApiMatchNoSuffixes(BackendApiTest):
+
+    config = {'search_index': "true",
+              'public_suffix_list': "/nonexistent/public_suffix_list.dat"}
+
+    def test_match_exact_host(self):
+        self.hdrs = {'x-opp-phrase': "123",
+                     'x-opp-jwt': self.jwt,
+                     'Content-Type': "application/json"}
+        data = {'payload': [
+            {'name': "Google", 'url': "https://google.com"},
+            {'name': "Gmail", 'url': "https://mail.google.com/inbox"}]}
+        self.assertEqual(self._put('/v1/items', data)['result'], "success")
+        data = self._get('/v1/items/match?origin=https://mail.google.com')
+        self.assertEqual([item['name'] for item in data['items']], ["Gmail"])
@@ -0,0 +1,72 @@
+import json
+import mock
+
+from . import BackendApiTest
+
+
+class TestApiRateLimit(BackendApiTest):
+
+    config = {'login_rate_limit_username': "3/60"}
+
+    def setUp(self):
+        self.hdrs = {"Content-Type": "application/json"}
+
+    def _auth(self, username, password="bad"):
+        data = json.dumps({'username': username, 'password': password})
+        return self.client.post('/v1/auth', headers=self.hdrs, data=data)
+
+    def test_auth(self):
+        self._put('/v1/users', {'username': "rl", 'password': "p"})
+        # Successful logins do not count against the user
+        for _ in range(4):
+            self.assertEqual(self._auth("rl", "p").status_code, 200)
+        self.assertEqual(self._auth("rl").status_code, 401)
+        self.assertEqual(self._auth("rl").status_code, 401)
+        self.assertEqual(self._auth("rl").status_code, 401)
+
+        # Throttled before the password hash is checked
+        with mock.patch('opp.common.utils.checkpw') as checkpw:
+            resp = self._auth("rl", "p")
+            checkpw.assert_not_called()
+        self.assertEqual(resp.status_code, 429)
+        self.assertIn(int(resp.headers['Retry-After']), range(1, 21))
+        data = json.loads(resp.data.decode())
+        self.assertEqual(data['error'], "Too Many Requests")
+
+        # Password changes count against the same limit
+        self._post('/v1/users', {'username': "rl", 'current_password': "p",
+                                 'new_password': "p2"}, 429)
+        self._delete('/v1/users', {'username': "rl", 'password': "p"}, 429)
+
+        # Other users are not affected
+        self.assertEqual(self._auth("u", "p").status_code, 200)
+
+    def test_batch(self):
+        op = {'endpoint': "users", 'method': "POST",
+              'body': {'username': "rlb", 'current_password': "x",
+                       'new_password': "y"}}
+        self.hdrs = {'x-opp-phrase': "123", 'x-opp-jwt': self.jwt,
+                     'Content-Type': "application/json"}
+        for _ in range(3):
+            data = self._post('/v1/batch', {'payload': [op]})
+            self.assertEqual(data['results'][0]['message'],
+                             "User doesn't exist!")
+        self._post('/v1/batch', {'payload': [op]}, 429)
+
+
+class TestApiRateLimitProxy(BackendApiTest):
+
+    config = {'login_rate_limit_ip': "2/60", 'trusted_proxies': "1"}
+
+    def _auth(self, client_ip):
+        headers = {"Content-Type": "application/json",
+                   "X-Forwarded-For": client_ip}
+        data = json.dumps({'username': "u", 'password': "p"})
+        return self.client.post('/v1/auth', headers=headers, data=data)
+
+    def test_forwarded_for(self):
+        # Attempts are counted per client, not per proxy
+        self.assertEqual(self._auth("10.0.0.1").status_code, 200)
+        self.assertEqual(self._auth("10.0.0.1").status_code, 200)
+        self.assertEqual(self._auth("10.0.0.1").status_code, 429)
+        self.assertEqual(self._auth("10.0.0.2").status_code, 200)
@@ -0,0 +1,102 @@
+from datetime import datetime, timedelta
+import json
+import mock
+
+from opp.db import api
+
+from . import BackendApiTest
+
+
+class RefreshApiTest(BackendApiTest):
+
+    def setUp(self):
+        self.hdrs = {"Content-Type": "application/json"}
+        self._put('/v1/users', {'username': "r", 'password': "p"})
+
+    def tearDown(self):
+        self.hdrs = {"Content-Type": "application/json"}
+        self._delete('/v1/users', {'username': "r", 'password': "p"})
+
+    def _login(self, password="p"):
+        return self._post('/v1/auth', {'username': "r",
+                                       'password': password})
+
+    def _refresh(self, token, code=200):
+        return self._post('/v1/auth/refresh', {'refresh_token': token}, code)
+
+    def _items_status(self, access_token):
+        hdrs = {'x-opp-phrase': "123", 'x-opp-jwt': access_token}
+        return self.client.get('/v1/items', headers=hdrs).status_code
+
+
+class TestApiRefresh(RefreshApiTest):
+
+    def test_rotation(self):
+        tokens = self._login()
+        with mock.patch('opp.common.utils.checkpw') as checkpw:
+            renewed = self._refresh(tokens['refresh_token'])
+            checkpw.assert_not_called()
+        self.assertNotEqual(renewed['refresh_token'],
+                            tokens['refresh_token'])
+        self.assertEqual(self._items_status(renewed['access_token']), 200)
+
+        # Tokens are stored hashed
+        self.assertIsNone(api.refresh_token_get_by_hash(
+            renewed['refresh_token']))
+
+        renewed = self._refresh(renewed['refresh_token'])
+        self.assertIn('access_token', renewed)
+
+    def test_reuse_revokes_family(self):
+        tokens = self._login()
+        other = self._login()
+        renewed = self._refresh(tokens['refresh_token'])
+        data = self._refresh(tokens['refresh_token'], 401)
+        self.assertEqual(data['error'], "Invalid refresh token")
+        self._refresh(renewed['refresh_token'], 401)
+
+        # Other logins are not affected
+        self._refresh(other['refresh_token'])
+
+    def test_revoke(self):
+        tokens = self._login()
+        renewed = self._refresh(tokens['refresh_token'])
+        self.assertEqual(self._delete('/v1/auth/refresh', {
+            'refresh_token': tokens['refresh_token']})['result'], "success")
+        self._refresh(renewed['refresh_token'], 401)
+
+    def test_password_change_revokes(self):
+        tokens = self._login()
+        self._post('/v1/users', {'username': "r", 'current_password': "p",
+                                 'new_password': "p2"})
+        self._refresh(tokens['refresh_token'], 401)
+        self._post('/v1/users', {'username': "r", 'current_password': "p2",
+                                 'new_password': "p"})
+
+    def test_expired(self):
+        token = self._login()['refresh_token']
+        session = api.get_session()
+        row = session.query(api.models.RefreshToken).order_by(
+            api.models.RefreshToken.id.desc()).first()
+        row.expires_at = datetime.now() - timedelta(seconds=1)
+        session.commit()
+        session.close()
+        self._refresh(token, 401)
+
+    def test_invalid_requests(self):
+        self._refresh("bogus", 401)
+        self._post('/v1/auth/refresh', {}, 400)
+        self._post('/v1/auth/refresh', {'refresh_token': 1}, 400)
+        resp = self.client.post('/v1/auth/refresh',
+                                data=json.dumps({'refresh_token': "x"}))
+        self.assertEqual(resp.status_code, 400)
+
+
+class TestApiRefreshDisabled(RefreshApiTest):
+
+    config = {'refresh_exp_delta': 0}
+
+    def test_disabled(self):
+        tokens = self._login()
+        self.assertIn('access_token', tokens)
+        self.assertNotIn('refresh_token', tokens)
@@ -0,0 +1,42 @@
+import json
+
+from opp.common import utils
+from opp.db import api
+
+from . import BackendApiTest
+
+
+class TestApiRehash(BackendApiTest):
+
+    config = {'bcrypt_rounds': "5"}
+
+    def setUp(self):
+        self.hdrs = {"Content-Type": "application/json"}
+
+    def _auth(self, password):
+        data = json.dumps({'username': "rh", 'password': password})
+        return self.client.post('/v1/auth', headers=self.hdrs, data=data)
+
+    def _rounds(self):
+        return utils.hash_rounds(api.user_get_by_username("rh").password)
+
+    def test_rehash_on_login(self):
+        self._put('/v1/users', {'username': "rh", 'password': "p"})
+        self.assertEqual(self._rounds(), 5)
+
+        # Hashes of another cost are upgraded on the next login only
+        user = api.user_get_by_username("rh")
+        api.user_update_password(user, utils.hashpw("p", 4))
+        self.assertEqual(self._rounds(), 4)
+        self.assertEqual(self._auth("bad").status_code, 401)
+        self.assertEqual(self._rounds(), 4)
+        self.assertEqual(self._auth("p").status_code, 200)
+        self.assertEqual(self._rounds(), 5)
+        self.assertEqual(self._auth("p").status_code, 200)
+
+    def test_concurrent_change(self):
+        self._put('/v1/users', {'username': "rh2", 'password': "p"})
+        user = api.user_get_by_username("rh2")
+        self.assertTrue(api.user_update_password(user, utils.hashpw("q", 4)))
+        # The stale hash no longer matches, so the change is kept
+        self.assertFalse(api.user_update_password(user, utils.hashpw("p", 5)))
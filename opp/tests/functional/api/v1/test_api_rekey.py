@@ -0,0 +1,265 @@
+from opp.api.v1 import base_handler
+from opp.common import aescipher, kdf
+from opp.db import api, models, rekey
+
+from . import BackendApiTest
+
+
+class Interrupted(Exception):
+    pass
+
+
+class RekeyApiTest(BackendApiTest):
+
+    def _headers(self, phrase, old_phrase=None):
+        self.hdrs = {'x-opp-phrase': phrase,
+                     'x-opp-jwt': self.jwt,
+                     'Content-Type': "application/json"}
+        if old_phrase:
+            self.hdrs['x-opp-old-phrase'] = old_phrase
+
+    def _check_vault(self, phrase, old_phrase=None):
+        self._headers(phrase, old_phrase)
+        data = self._get('/v1/items')
+        self.assertEqual(data['result'], "success")
+        names = sorted(item['name'] for item in data['items'])
+        self.assertEqual(names, ["i1", "i2", "i3"])
+        self.assertEqual(data['items'][0]['category']['name'], "c1")
+
+    def _login(self, username):
+        self.hdrs = {'Content-Type': "application/json"}
+        payload = {'username': username, 'password': "p"}
+        self._put('/v1/users', payload)
+        self.jwt = self._post('/v1/auth', payload)['access_token']
+
+    def _seed(self, phrase):
+        """Write a vault as it was before per-user data keys existed."""
+        cipher = aescipher.AESCipher(phrase)
+        session = api.get_session()
+        category = models.Category(name=cipher.encrypt("c1"))
+        api.category_create([category], session=session)
+        items = [models.Item(category_id=category.id if name == "i1" else
+                             None, **models.encrypt_item(
+                                 cipher, [name, "", "", "", "", ""]))
+                 for name in ["i1", "i2", "i3"]]
+        api.item_create(items, session=session)
+        session.close()
+
+
+class TestApiRekey(RekeyApiTest):
+
+    """These tests exercise the top level request/response functionality of
+    the backend API.
+    Note: All tests share the same DB, so please beware of
+    unintended interaction when adding new tests"""
+
+    def test_rekey(self):
+        self._headers("123")
+        data = self._put('/v1/categories', {'payload': ["c1"]})
+        self.assertEqual(data['result'], "success")
+        category_id = self._get('/v1/categories')['categories'][0]['id']
+        data = {'payload': [{'name': "i1", 'category_id': category_id},
+                            {'name': "i2"}, {'name': "i3"}]}
+        data = self._put('/v1/items', data)
+        self.assertEqual(data['result'], "success")
+
+        # Change the passphrase, only the data key is re-wrapped
+        data = self._post('/v1/rekey', {'payload': {'new_phrase': "456"}})
+        self.assertEqual(data, {'result': "success"})
+        self.assertEqual(api.key_version_get(), 0)
+        self._check_vault("456")
+
+        # The old passphrase no longer unwraps the data key
+        self._headers("123")
+        data = self._get('/v1/items')
+        self.assertEqual(data, {'result': "error",
+                                'message': "Invalid passphrase!"})
+        data = self._post('/v1/rekey', {'payload': {'new_phrase': "789"}})
+        self.assertEqual(data, {'result': "error",
+                                'message': "Invalid passphrase!"})
+
+        # Bulk re-encryption is refused for data key encrypted vaults
+        session = api.get_session()
+        with self.assertRaises(rekey.RekeyError):
+            rekey.rekey(session, "456", "123")
+        session.close()
+
+        # Clean up
+        self._headers("456")
+        ids = [item['id'] for item in self._get('/v1/items')['items']]
+        self._delete('/v1/items', {'payload': ids})
+        self._delete('/v1/categories',
+                     {'payload': {'cascade': True, 'ids': [category_id]}})
+
+    def test_kdf_upgrade(self):
+        self._headers("123")
+        self.assertEqual(self._get('/v1/items')['result'], "success")
+
+        # Wrap the data key as before KDF parameters were recorded
+        session = api.get_session()
+        data_key = api.data_key_get_by_user_id(1, session=session)
+        self.assertEqual(data_key.kdf, kdf.default_params())
+        self.assertTrue(data_key.salt)
+        cipher = aescipher.AESCipher("123")
+        data_key.wrap(cipher, data_key.unwrap(aescipher.AEADCipher(
+            kdf.derive_key("123", data_key.salt, data_key.kdf), raw=True)))
+        data_key.salt = data_key.kdf = None
+        api.data_key_update(data_key, session=session)
+        base_handler.DATA_KEYS.clear()
+
+        self.assertEqual(self._get('/v1/items')['result'], "success")
+        session.expire_all()
+        data_key = api.data_key_get_by_user_id(1, session=session)
+        self.assertEqual(data_key.kdf, kdf.default_params())
+        session.close()
+
+    def test_rekey_error_conditions(self):
+        self._headers("123")
+        data = self._post('/v1/rekey', {'payload': {'nophrase': "456"}})
+        self.assertEqual(data['message'], "Missing new passphrase!")
+        data = self._post('/v1/rekey', {'payload': {'new_phrase': ""}})
+        self.assertEqual(data['message'], "Empty new passphrase!")
+
+
+class TestApiLegacyRekey(RekeyApiTest):
+
+    """Re-keying a vault written before per-user data keys existed."""
+
+    def test_legacy_rekey(self):
+        self._seed("456")
+
+        # Interrupt a re-key to a new phrase after one batch
+        def interrupt(job):
+            raise Interrupted()
+
+        session = api.get_session()
+        with self.assertRaises(Interrupted):
+            rekey.rekey(session, "456", "123", batch_size=1,
+                        progress=interrupt)
+
+        # New and old phrases are both needed mid-migration
+        self._headers("123")
+        data = self._get('/v1/items')
+        self.assertEqual(data['result'], "error")
+        self.assertEqual(data['message'],
+                         "Re-key in progress, old passphrase missing!")
+        self._check_vault("123", "456")
+        data = self._post('/v1/rekey', {'payload': {'new_phrase': "789"}})
+        self.assertEqual(data['message'],
+                         "Re-key in progress, finish it with opp-db rekey!")
+        self.assertEqual(api.data_key_count(session), 0)
+
+        # Resume the re-key, then the data key adopts the new phrase key
+        job = rekey.rekey(session, "456", "123")
+        self.assertEqual(job.status, "complete")
+        self._check_vault("123")
+        self.assertEqual(api.data_key_count(session), 1)
+        session.close()
+
+        # From now on, passphrase changes are O(1)
+        data = self._post('/v1/rekey', {'payload': {'new_phrase': "789"}})
+        self.assertEqual(data, {'result': "success"})
+        self._check_vault("789")
+
+
+class TestApiSharedVault(RekeyApiTest):
+
+    """The vault is shared by all users, each with their own wrapped copy
+    of its data key."""
+
+    def test_shared_vault(self):
+        self._headers("123")
+        self._put('/v1/categories', {'payload': ["c1"]})
+        category_id = self._get('/v1/categories')['categories'][0]['id']
+        data = {'payload': [{'name': "i1", 'category_id': category_id},
+                            {'name': "i2"}, {'name': "i3"}]}
+        self.assertEqual(self._put('/v1/items', data)['result'], "success")
+        jwt = self.jwt
+
+        # Another user knowing the passphrase reads the same rows
+        self._login("u2")
+        self._check_vault("123")
+        data = self._post('/v1/rekey', {'payload': {'new_phrase': "456"}})
+        self.assertEqual(data, {'result': "success"})
+        self._check_vault("456")
+
+        # Others keep using their own passphrase
+        self.jwt = jwt
+        self._check_vault("123")
+
+        # A user without any matching wrapped key is refused
+        self._login("u3")
+        self._headers("789")
+        data = self._get('/v1/items')
+        self.assertEqual(data, {'result': "error",
+                                'message': "Invalid passphrase!"})
+        self._check_vault("456")
+
+    def test_rewrapped_elsewhere(self):
+        self._headers("123")
+        self.assertEqual(self._get('/v1/items')['result'], "success")
+
+        # Re-wrap the data key as another process would, without touching
+        # the key cache of this one
+        session = api.get_session()
+        data_key = api.data_key_get_by_user_id(1, session=session)
+        key = data_key.unwrap(aescipher.AEADCipher(
+            kdf.derive_key("123", data_key.salt, data_key.kdf), raw=True))
+        data_key.salt = kdf.generate_salt()
+        data_key.wrap(aescipher.AEADCipher(
+            kdf.derive_key("abc", data_key.salt, data_key.kdf), raw=True),
+            key)
+        api.data_key_update(data_key, session=session)
+        session.close()
+
+        data = self._get('/v1/items')
+        self.assertEqual(data, {'result': "error",
+                                'message': "Invalid passphrase!"})
+        self._headers("abc")
+        self.assertEqual(self._get('/v1/items')['result'], "success")
+
+        # Clean up
+        data = self._post('/v1/rekey', {'payload': {'new_phrase': "123"}})
+        self.assertEqual(data, {'result': "success"})
+
+
+class TestApiLegacyEnrol(RekeyApiTest):
+
+    """Enrolling into a vault written before per-user data keys existed."""
+
+    def test_wrong_phrase_first(self):
+        self._seed("123")
+
+        # A mistyped passphrase must not become the vault's data key
+        self._headers("456")
+        data = self._get('/v1/items')
+        self.assertEqual(data, {'result': "error",
+                                'message': "Invalid passphrase!"})
+        session = api.get_session()
+        self.assertEqual(api.data_key_count(session), 0)
+        session.close()
+
+        self._check_vault("123")
+        self._login("u2")
+        self._check_vault("123")
+
+
+class TestApiEnrolRateLimit(RekeyApiTest):
+
+    """Enrolling tries every wrapped copy of the data key, so failed
+    attempts count against the login rate limits."""
+
+    config = {'login_rate_limit_username': "2/3600"}
+
+    def test_enrol_rate_limit(self):
+        self._headers("123")
+        self.assertEqual(self._get('/v1/items')['result'], "success")
+
+        self._login("u2")
+        for _ in range(2):
+            self._headers("456")
+            data = self._get('/v1/items')
+            self.assertEqual(data, {'result': "error",
+                                    'message': "Invalid passphrase!"})
+        self._headers("123")
+        self._get('/v1/items', 429)
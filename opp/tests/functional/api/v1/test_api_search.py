@@ -0,0 +1,96 @@
+import mock
+import time
+
+from opp.api.v1 import search
+from opp.db import api
+
+from . import BackendApiTest
+
+
+class SearchApiTestMixin(object):
+
+    def setUp(self):
+        self.hdrs = {'x-opp-phrase': "123",
+                     'x-opp-jwt': self.jwt,
+                     'Content-Type': "application/json"}
+        data = {'payload': [
+            {'name': "GitHub", 'url': "https://github.com/login"},
+            {'name': "Work mail", 'url': "https://www.mail.example.com"},
+            {'name': "Bank", 'url': "bank.example.org", 'password': "hub"}]}
+        self.assertEqual(self._put('/v1/items', data)['result'], "success")
+
+    def tearDown(self):
+        ids = [item['id'] for item in self._get('/v1/items')['items']]
+        self._delete('/v1/items', {'payload': ids})
+
+    def _search(self, query):
+        data = self._get('/v1/items/search?q=%s' % query)
+        self.assertEqual(data['result'], "success")
+        return sorted(item['name'] for item in data['items'])
+
+    def _check_search(self):
+        self.assertEqual(self._search("github.com"), ["GitHub"])
+        self.assertEqual(self._search("https://github.com/"), ["GitHub"])
+        self.assertEqual(self._search("HUB"), ["GitHub"])
+        self.assertEqual(self._search("example"), ["Bank", "Work mail"])
+        self.assertEqual(self._search("mail.example.com"), ["Work mail"])
+        self.assertEqual(self._search("bank"), ["Bank"])
+        self.assertEqual(self._search("gitlab"), [])
+        # Queries shorter than a trigram are matched as substrings too
+        self.assertEqual(self._search("hu"), ["GitHub"])
+        self.assertEqual(self._search("e"), ["Bank", "Work mail"])
+
+    def test_search_missing_query(self):
+        data = self._get('/v1/items/search')
+        self.assertEqual(data['message'], "Missing search query!")
+        data = self._get('/v1/items/search?q=%20')
+        self.assertEqual(data['message'], "Missing search query!")
+
+
+class TestApiSearchIndex(SearchApiTestMixin, BackendApiTest):
+
+    config = {'search_index': "true"}
+
+    def test_search(self):
+        self._check_search()
+
+    def test_search_updated(self):
+        item_id = self._get('/v1/items')['items'][0]['id']
+        data = {'payload': [{'id': item_id, 'name': "GitLab",
+                             'url': "https://gitlab.com"}]}
+        self.assertEqual(self._post('/v1/items', data)['result'], "success")
+        self.assertEqual(self._search("github"), [])
+        self.assertEqual(self._search("gitlab"), ["GitLab"])
+
+    def test_search_rebuilt(self):
+        # Tokens are rebuilt once per index key, e.g. after a legacy re-key
+        api.item_token_delete_all()
+        search.BACKFILLS.clear()
+        self._check_search()
+
+    def test_search_backfill_once(self):
+        self._check_search()
+        with mock.patch.object(api, 'item_get_unindexed') as unindexed:
+            self._check_search()
+        self.assertFalse(unindexed.called)
+
+    def test_search_backfill_interval(self):
+        # Items written without tokens, e.g. by opp-db seed, are indexed
+        # once the interval has passed
+        self._check_search()
+        api.item_token_delete_all()
+        self.assertEqual(self._search("github"), [])
+        later = time.time() + search.BACKFILL_INTERVAL
+        with mock.patch('time.time', return_value=later):
+            self._check_search()
+
+
+class TestApiSearchNoIndex(SearchApiTestMixin, BackendApiTest):
+
+    def test_search(self):
+        self._check_search()
+        session = api.get_session()
+        self.assertEqual(api.item_search(["x"], ["y"], session=session), [])
+        self.assertEqual(len(api.item_get_unindexed("x", session=session)),
+                         3)
+        session.close()
@@ -0,0 +1,73 @@
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+from opp.common import opp_config, utils
+from opp.db import api
+from opp.flask import create_backend_app, create_frontend_app
+
+
+class TestAppFactory(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.test_dir = tempfile.mkdtemp(prefix='opp_')
+        cls.conf_filepath = os.path.join(cls.test_dir, 'opp.cfg')
+        with open(cls.conf_filepath, 'w') as conf_file:
+            conf_file.write("[DEFAULT]\ndb_connect = sqlite:///%s" %
+                            os.path.join(cls.test_dir, 'test.sqlite'))
+        utils.execute("opp-db --config_file %s init" % cls.conf_filepath)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.test_dir, ignore_errors=True)
+
+    def _imported(self, factory):
+        code = ("import json, sys\n"
+                "from opp.flask import %s\n"
+                "%s(%r)\n"
+                "print(json.dumps([m for m in ('opp.flask.backend', "
+                "'opp.flask.frontend') if m in sys.modules]))" %
+                (factory, factory, self.conf_filepath))
+        out = subprocess.check_output([sys.executable, '-c', code])
+        return json.loads(out.decode())
+
+    def test_tiers_are_independent(self):
+        self.assertEqual(['opp.flask.backend'],
+                         self._imported('create_backend_app'))
+        self.assertEqual(['opp.flask.frontend'],
+                         self._imported('create_frontend_app'))
+
+    def test_backend_uses_given_config(self):
+        # The environment must not override the config of the app
+        environ = os.environ.get('OPP_TOP_CONFIG')
+        os.environ['OPP_TOP_CONFIG'] = os.path.join(self.test_dir, 'none')
+        try:
+            client = create_backend_app(self.conf_filepath).test_client()
+            headers = {"Content-Type": "application/json"}
+            data = json.dumps({'username': "factory", 'password': "p"})
+            resp = client.put("/v1/users", headers=headers, data=data)
+            self.assertEqual(resp.status_code, 200)
+            resp = client.post("/v1/auth", headers=headers, data=data)
+            self.assertEqual(resp.status_code, 200)
+        finally:
+            if environ is None:
+                del os.environ['OPP_TOP_CONFIG']
+            else:
+                os.environ['OPP_TOP_CONFIG'] = environ
+
+        conf = opp_config.OppConfig(self.conf_filepath)
+        self.assertIsNotNone(api.user_get_by_username("factory", conf=conf))
+
+    def test_frontend(self):
+        client = create_frontend_app(self.conf_filepath).test_client()
+        resp = client.get("/")
+        self.assertEqual(resp.status_code, 302)
+        self.assertIn("/login", resp.headers['Location'])
+        resp = client.post("/login", data={'username': "nobody",
+                                           'password': "p"})
+        self.assertIn("/login", resp.headers['Location'])
@@ -0,0 +1,127 @@
+import asyncio
+import importlib
+import json
+import os
+import sys
+import tempfile
+import unittest
+
+from opp.common import utils
+
+
+@unittest.skipIf(sys.version_info < (3, 5), "ASGI requires Python 3.5+")
+class TestAsgi(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.test_dir = tempfile.mkdtemp(prefix='opp_')
+        cls.conf_filepath = os.path.join(cls.test_dir, 'opp.cfg')
+        with open(cls.conf_filepath, 'w') as conf_file:
+            conf_file.write("[DEFAULT]\ndb_connect = sqlite:///%s" %
+                            os.path.join(cls.test_dir, 'test.sqlite'))
+        os.environ['OPP_TOP_CONFIG'] = cls.conf_filepath
+        utils.execute("opp-db --config_file %s init" % cls.conf_filepath)
+        asgi = importlib.import_module('opp.flask.asgi')
+        cls.app = asgi.create_app()
+        cls.max_body_size = asgi.MAX_BODY_SIZE
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self.loop.close()
+
+    def _done(self, result):
+        future = self.loop.create_future()
+        future.set_result(result)
+        return future
+
+    def _call(self, method, path, body=None, headers=None, query=b""):
+        body = json.dumps(body).encode() if body is not None else b""
+        headers = dict(headers or {})
+        headers.setdefault('Content-Type', "application/json")
+        scope = {'type': 'http', 'method': method, 'path': path,
+                 'query_string': query, 'http_version': "1.1",
+                 'headers': [(k.lower().encode(), v.encode())
+                             for k, v in headers.items()]}
+
+        # Deliver the body in two chunks, like a slow client would
+        messages = [{'type': 'http.request', 'body': body[:5],
+                     'more_body': True},
+                    {'type': 'http.request', 'body': body[5:],
+                     'more_body': False}]
+        sent = []
+
+        def receive():
+            return self._done(messages.pop(0))
+
+        def send(message):
+            sent.append(message)
+            return self._done(None)
+
+        self.loop.run_until_complete(self.app(scope, receive, send))
+        self.assertEqual(sent[0]['type'], 'http.response.start')
+        self.assertEqual(sent[1]['type'], 'http.response.body')
+        return sent[0]['status'], sent[1]['body']
+
+    def test_health(self):
+        status, body = self._call('GET', '/api/v1/health')
+        self.assertEqual(status, 200)
+        self.assertEqual(json.loads(body.decode()),
+                         {'status': "OpenPassPhrase service is running"})
+
+    def test_api(self):
+        user = {'username': "u", 'password': "p"}
+        status, body = self._call('PUT', '/api/v1/users', user)
+        self.assertEqual(status, 200)
+        self.assertEqual(json.loads(body.decode())['result'], "success")
+        status, body = self._call('POST', '/api/v1/auth', user)
+        self.assertEqual(status, 200)
+        headers = {'x-opp-jwt': json.loads(body.decode())['access_token'],
+                   'x-opp-phrase': "123"}
+
+        status, body = self._call('PUT', '/api/v1/items',
+                                  {'payload': [{'name': "i1"}]}, headers)
+        self.assertEqual(json.loads(body.decode())['result'], "success")
+        status, body = self._call('GET', '/api/v1/items', headers=headers,
+                                  query=b"limit=5")
+        items = json.loads(body.decode())['items']
+        self.assertEqual([item['name'] for item in items], ["i1"])
+
+        status, body = self._call('GET', '/api/v1/items')
+        self.assertEqual(status, 401)
+
+    def test_repeated_headers(self):
+        asgi = importlib.import_module('opp.flask.asgi')
+        scope = {'method': "GET", 'path': "/",
+                 'headers': [(b"cookie", b"a=1"), (b"cookie", b"b=2"),
+                             (b"accept", b"text/html"),
+                             (b"accept", b"*/*")]}
+        environ = asgi._environ(scope, b"")
+        self.assertEqual(environ['HTTP_COOKIE'], "a=1; b=2")
+        self.assertEqual(environ['HTTP_ACCEPT'], "text/html,*/*")
+
+    def test_body_too_large(self):
+        status, body = self._call('PUT', '/api/v1/users',
+                                  "x" * self.max_body_size)
+        self.assertEqual(status, 413)
+
+    def test_lifespan(self):
+        messages = [{'type': 'lifespan.startup'}]
+        sent = []
+
+        def receive():
+            return self._done(messages.pop(0))
+
+        def send(message):
+            sent.append(message)
+            return self._done(None)
+
+        asgi = importlib.import_module('opp.flask.asgi')
+        app = asgi.AsgiApp(None)
+        messages.append({'type': 'lifespan.shutdown'})
+        self.loop.run_until_complete(app({'type': 'lifespan'}, receive,
+                                         send))
+        self.assertEqual([m['type'] for m in sent],
+                         ['lifespan.startup.complete',
+                          'lifespan.shutdown.complete'])
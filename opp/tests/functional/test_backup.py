@@ -0,0 +1,72 @@
+import gzip
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+from opp.common import utils
+
+
+class TestBackupRestore(unittest.TestCase):
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp(prefix='opp_')
+        self.conf_filepath = os.path.join(self.test_dir, 'opp.cfg')
+        self.db_filepath = os.path.join(self.test_dir, 'test.sqlite')
+        self.restore_filepath = os.path.join(self.test_dir, 'restore.sqlite')
+        self.archive = os.path.join(self.test_dir, 'backup.gz')
+        with open(self.conf_filepath, 'w') as conf_file:
+            conf_file.write("[DEFAULT]\ndb_connect = sqlite:///%s" %
+                            self.db_filepath)
+        self._opp_db("init")
+        self._opp_db("seed --users 2 --items 25 --categories 3 "
+                     "--phrase 123 --workers 1 --seed 1")
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def _opp_db(self, args):
+        return utils.execute("opp-db --config_file %s %s" %
+                             (self.conf_filepath, args))
+
+    def _rows(self, db_filepath, table):
+        conn = sqlite3.connect(db_filepath)
+        try:
+            return conn.execute("SELECT * FROM %s ORDER BY id" %
+                                table).fetchall()
+        finally:
+            conn.close()
+
+    def test_backup_restore(self):
+        self._opp_db("backup --chunk_size 7 %s" % self.archive)
+        self._opp_db("restore --db_connect sqlite:///%s %s" %
+                     (self.restore_filepath, self.archive))
+
+        for table in ['users', 'categories', 'items']:
+            rows = self._rows(self.db_filepath, table)
+            self.assertTrue(rows)
+            self.assertEqual(rows, self._rows(self.restore_filepath, table))
+
+    def test_restore_non_empty(self):
+        self._opp_db("backup %s" % self.archive)
+        with self.assertRaises(RuntimeError):
+            self._opp_db("restore %s" % self.archive)
+
+    def test_restore_corrupt(self):
+        self._opp_db("backup %s" % self.archive)
+        with gzip.open(self.archive, 'rb') as f:
+            lines = f.readlines()
+        # Tamper with the primary keys of the last chunk of rows, leaving
+        # the trailer intact
+        index = max(i for i, line in enumerate(lines)
+                    if line.startswith(b'{"rows": [['))
+        lines[index] = lines[index].replace(b'"rows": [[', b'"rows": [[9')
+        with gzip.open(self.archive, 'wb') as f:
+            f.writelines(lines)
+
+        with self.assertRaises(RuntimeError) as cm:
+            self._opp_db("restore --db_connect sqlite:///%s %s" %
+                         (self.restore_filepath, self.archive))
+        self.assertIn("checksum mismatch", str(cm.exception))
+        self.assertEqual(self._rows(self.restore_filepath, 'items'), [])
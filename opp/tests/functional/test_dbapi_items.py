@@ -2,6 +2,7 @@ import os
 import tempfile
 import unittest
 
+from opp.api.v1 import batch
 from opp.db import api, models
 from opp.common import opp_config, utils
 
@@ -127,3 +128,25 @@ class TestDbApiItems(unittest.TestCase):
         api.item_delete(items, session=self.session)
         items = api.item_getall(session=self.session)
         self.assertEqual(len(items), 0)
+
+    def test_vault_generation(self):
+        generation = api.vault_generation()
+        items = [models.Item(blob="blob6")]
+        api.item_create(items, session=self.session)
+        self.assertEqual(api.vault_generation(), generation + 1)
+
+        # Commits of a batch are flushes, the generation changes with the
+        # batch's own commit
+        generation = api.vault_generation()
+        api.item_delete(items, session=batch._BatchSession(self.session))
+        self.assertEqual(api.vault_generation(), generation)
+        self.session.rollback()
+        self.assertEqual(api.vault_generation(), generation)
+        self.assertEqual(len(api.item_getall(session=self.session)), 1)
+
+        api.item_delete(api.item_getall(session=self.session),
+                        session=batch._BatchSession(self.session))
+        self.assertEqual(api.vault_generation(), generation)
+        self.session.commit()
+        self.assertEqual(api.vault_generation(), generation + 1)
+        self.assertEqual(api.item_getall(session=self.session), [])
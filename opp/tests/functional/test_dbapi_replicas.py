@@ -0,0 +1,102 @@
+import mock
+import os
+import shutil
+import tempfile
+import unittest
+
+from opp.db import api, models
+from opp.common import opp_config, utils, writemarks
+
+
+class TestDbApiReplicas(unittest.TestCase):
+
+    """The replica is a copy of the primary taken before the tests, so
+    reads served by it do not see rows written to the primary since."""
+    @classmethod
+    def setUpClass(cls):
+        cls.test_dir = tempfile.mkdtemp(prefix='opp_')
+        cls.conf_filepath = os.path.join(cls.test_dir, 'opp.cfg')
+        cls.db_filepath = os.path.join(cls.test_dir, 'test.sqlite')
+        cls.replica_filepath = os.path.join(cls.test_dir, 'replica.sqlite')
+        cls.marks_url = "sqlite:///%s" % os.path.join(cls.test_dir,
+                                                      'marks.sqlite')
+        with open(cls.conf_filepath, 'w') as conf_file:
+            conf_file.write("[DEFAULT]\ndb_connect = sqlite:///%s\n"
+                            "db_connect_replicas = sqlite:///%s\n"
+                            "db_replica_write_window = 60\n"
+                            "db_replica_write_store = %s" %
+                            (cls.db_filepath, cls.replica_filepath,
+                             cls.marks_url))
+        utils.execute("opp-db --config_file %s init" % cls.conf_filepath)
+        shutil.copy(cls.db_filepath, cls.replica_filepath)
+        cls.conf = opp_config.OppConfig(cls.conf_filepath)
+        api.item_create([models.Item(blob="primary")],
+                        session=api.get_session(cls.conf))
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.test_dir, ignore_errors=True)
+
+    def _count_items(self, **kwargs):
+        session = api.get_session(self.conf, **kwargs)
+        try:
+            return len(api.item_getall(session=session))
+        finally:
+            session.close()
+
+    def test_routing(self):
+        self.assertEqual(self._count_items(), 1)
+        self.assertEqual(self._count_items(read_only=True), 0)
+
+        # Writes of read-only sessions go to the primary, as do their
+        # subsequent reads
+        session = api.get_session(self.conf, read_only=True, user_id=1001)
+        try:
+            self.assertEqual(len(api.item_getall(session=session)), 0)
+            api.item_create([models.Item(blob="written")], session=session)
+            self.assertEqual(len(api.item_getall(session=session)), 2)
+        finally:
+            session.close()
+
+        # The user reads from the primary until the window has passed
+        self.assertEqual(self._count_items(read_only=True, user_id=1001), 2)
+        self.assertEqual(self._count_items(read_only=True, user_id=1002), 0)
+        # Other processes see the write too
+        marks = writemarks.create_store(self.marks_url, 60)
+        written = marks.get(1001)
+        self.assertGreater(written, 0)
+        with mock.patch('time.time', return_value=written + 60):
+            self.assertEqual(self._count_items(read_only=True,
+                                               user_id=1001), 0)
+
+    def test_user_create(self):
+        # A new user is read from the primary by their first requests
+        user = models.User(username="new", password="p")
+        api.user_create(user, session=api.get_session(self.conf))
+        session = api.get_session(self.conf, read_only=True, user_id=user.id)
+        try:
+            self.assertIsNotNone(api.user_get_by_id(user.id,
+                                                    session=session))
+        finally:
+            session.close()
+
+    def test_replica_set(self):
+        good = "sqlite:///%s" % self.replica_filepath
+        bad = "sqlite:///%s" % os.path.join(self.test_dir, "none", "db")
+        replicas = api.ReplicaSet([good, bad, good])
+        picked = [str(replicas.pick().url) for _ in range(4)]
+        self.assertEqual(picked, [good, good, good, good])
+        self.assertEqual(replicas._healthy, [True, False, True])
+
+        # Failed replicas are checked again after the interval
+        replicas = api.ReplicaSet([bad], check_interval=30)
+        with mock.patch('time.time', return_value=1000):
+            self.assertIsNone(replicas.pick())
+        with mock.patch.object(replicas.engines[0], 'connect') as connect:
+            with mock.patch('time.time', return_value=1029):
+                self.assertIsNone(replicas.pick())
+            connect.assert_not_called()
+            with mock.patch('time.time', return_value=1030):
+                self.assertIsNotNone(replicas.pick())
+            connect.assert_called_once_with()
+        replicas.dispose()
@@ -69,3 +69,18 @@ class TestDbApiUsers(unittest.TestCase):
         api.user_delete_by_username(user.username, session=self.session)
         user = api.user_get_by_id(user.id, session=self.session)
         self.assertIsNone(user)
+
+    def test_users_baked_queries(self):
+        # Cached queries must use the values of each call
+        api.user_create(models.User(username="b1", password="p"),
+                        session=self.session)
+        api.user_create(models.User(username="b2", password="p"),
+                        session=self.session)
+        user1 = api.user_get_by_username("b1", session=self.session)
+        user2 = api.user_get_by_username("b2", session=self.session)
+        self.assertEqual(user2.username, "b2")
+        self.assertEqual(api.user_get_by_id(user1.id, self.session), user1)
+        self.assertEqual(api.user_get_by_id(user2.id, self.session), user2)
+        self.assertIsNone(api.user_get_by_username("b3", self.session))
+        api.user_delete(user1, session=self.session)
+        api.user_delete(user2, session=self.session)
@@ -2,7 +2,8 @@ import os
 import tempfile
 import unittest
 
-from opp.common import utils
+from opp.common import aescipher, opp_config, utils
+from opp.db import api
 
 
 class TestDbManager(unittest.TestCase):
@@ -39,3 +40,32 @@ class TestDbManager(unittest.TestCase):
 
         for table in ['categories', 'items']:
             self._assert_table_exists(table)
+
+    def test_seed(self):
+        self._init_db()
+        utils.execute("opp-db --config_file %s seed --users 3 --items 7 "
+                      "--categories 2 --phrase 123 --batch_size 5 "
+                      "--workers 2 --seed 1" % self.conf_filepath)
+
+        session = api.get_session(opp_config.OppConfig(self.conf_filepath))
+        cipher = aescipher.AEADCipher("123")
+        self.assertIsNotNone(api.user_get_by_username("user2", session))
+        categories = api.category_getall(session=session)
+        self.assertEqual(len(categories), 2)
+        items = api.item_getall(session=session)
+        self.assertEqual(len(items), 21)
+        for item in items:
+            extracted = item.extract(cipher)
+            self.assertTrue(extracted['name'])
+            self.assertTrue(extracted['password'])
+        # Rows are bound to their ids, so can not be swapped
+        items[0].id, items[1].id = items[1].id, items[0].id
+        self.assertRaises(ValueError, items[0].extract, cipher)
+        session.close()
+
+    def test_bench_hash(self):
+        self._init_db()
+        code, out, err = utils.execute(
+            "opp-db --config_file %s bench-hash --target_ms 1" %
+            self.conf_filepath)
+        self.assertEqual(out.decode().strip(), "bcrypt_rounds = 4")
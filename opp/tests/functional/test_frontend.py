@@ -0,0 +1,93 @@
+import json
+import mock
+import os
+import shutil
+import tempfile
+import unittest
+
+from opp.common import opp_config, utils
+from opp.flask import create_backend_app, create_frontend_app
+
+
+class TestFrontend(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.test_dir = tempfile.mkdtemp(prefix='opp_')
+        cls.conf_filepath = os.path.join(cls.test_dir, 'opp.cfg')
+        with open(cls.conf_filepath, 'w') as conf_file:
+            conf_file.write("[DEFAULT]\ndb_connect = sqlite:///%s\n"
+                            "frontend_session_store = sqlite:///%s\n"
+                            "revocation_refresh_interval = 0" %
+                            (os.path.join(cls.test_dir, 'test.sqlite'),
+                             os.path.join(cls.test_dir, 'sessions.sqlite')))
+        utils.execute("opp-db --config_file %s init" % cls.conf_filepath)
+        cls.conf = opp_config.OppConfig(cls.conf_filepath)
+        cls.backend = create_backend_app(cls.conf).test_client()
+        data = json.dumps({'username': "web", 'password': "p"})
+        cls.backend.put("/v1/users", data=data,
+                        headers={"Content-Type": "application/json"})
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.test_dir, ignore_errors=True)
+
+    def setUp(self):
+        self.client = create_frontend_app(self.conf).test_client()
+
+    def _login(self, password="p"):
+        return self.client.post("/login", data={'username': "web",
+                                                'password': password})
+
+    def _token(self, code=200):
+        resp = self.client.get("/token")
+        self.assertEqual(resp.status_code, code)
+        return json.loads(resp.data.decode()).get('access_token')
+
+    def _items(self, token):
+        hdrs = {'x-opp-phrase': "123", 'x-opp-jwt': token}
+        return self.backend.get("/v1/items", headers=hdrs).status_code
+
+    def test_login(self):
+        self.assertIn("/login", self._login("bad").headers['Location'])
+        self._token(401)
+
+        resp = self._login()
+        self.assertTrue(resp.headers['Location'].endswith("/"))
+        cookie = resp.headers['Set-Cookie']
+        self.assertIn("HttpOnly", cookie)
+
+        # Pages are served from the session, without the database
+        with mock.patch('opp.db.api.get_session') as get_session:
+            resp = self.client.get("/")
+            token = self._token()
+            get_session.assert_not_called()
+        self.assertEqual(resp.data.decode(), "Logged in as web")
+        self.assertEqual(self._items(token), 200)
+
+        # Sessions survive the process, only their id is in the cookie
+        client = create_frontend_app(self.conf).test_client()
+        sid = cookie.split(';')[0].split('=', 1)[1]
+        client.set_cookie('localhost', 'session', sid)
+        self.assertEqual(client.get("/").status_code, 200)
+
+        # Logging out revokes the access token
+        self.client.get("/logout")
+        self.assertEqual(self.client.get("/").status_code, 302)
+        self._token(401)
+        self.assertEqual(self._items(token), 401)
+        self.assertEqual(client.get("/").status_code, 200)
+
+    def test_new_session_id_on_login(self):
+        self._login()
+        sid = self.client.cookie_jar._cookies['localhost.local']['/'][
+            'session'].value
+        self._login()
+        self.assertNotEqual(self.client.cookie_jar._cookies[
+            'localhost.local']['/']['session'].value, sid)
+
+    @mock.patch('opp.flask.frontend.TOKEN_RENEW_MARGIN', 3600)
+    def test_token_renewal(self):
+        self._login()
+        first = self._token()
+        self.assertNotEqual(self._token(), first)
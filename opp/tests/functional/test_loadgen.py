@@ -0,0 +1,45 @@
+import json
+import os
+import tempfile
+import unittest
+
+from opp.common import utils
+
+
+class TestLoadgen(unittest.TestCase):
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp(prefix='opp_')
+        self.report_filepath = os.path.join(self.test_dir, 'report.json')
+
+    def tearDown(self):
+        os.remove(self.report_filepath)
+        os.rmdir(self.test_dir)
+
+    def test_inprocess_run(self):
+        utils.execute("opp-loadgen --users 2 --items 3 --concurrency 2 "
+                      "--requests 10 --output %s" % self.report_filepath)
+        with open(self.report_filepath) as f:
+            report = json.load(f)
+
+        self.assertEqual(report['config']['mode'], "inprocess")
+        self.assertEqual(report['total']['errors'], 0)
+        # The warm-up login and listing of each worker are not recorded
+        self.assertEqual(report['total']['count'], 2 * 10)
+        for stats in report['endpoints'].values():
+            if stats['count']:
+                self.assertIsNotNone(stats['p99_ms'])
+
+    def test_query_bench(self):
+        utils.execute("opp-loadgen --users 1 --items 3 --concurrency 1 "
+                      "--requests 1 --query_bench 20 --output %s" %
+                      self.report_filepath)
+        with open(self.report_filepath) as f:
+            report = json.load(f)
+
+        self.assertEqual(sorted(report['queries']),
+                         ['category_getall', 'item_getall',
+                          'user_get_by_id', 'user_get_by_username'])
+        for timings in report['queries'].values():
+            self.assertGreater(timings['baked_us'], 0)
+            self.assertGreater(timings['unbaked_us'], 0)
@@ -0,0 +1,79 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from opp.common import aescipher, opp_config, utils
+from opp.db import api, models
+from opp.db import rekey as opp_rekey
+
+
+class TestRekey(unittest.TestCase):
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp(prefix='opp_')
+        self.conf_filepath = os.path.join(self.test_dir, 'opp.cfg')
+        self.db_filepath = os.path.join(self.test_dir, 'test.sqlite')
+        with open(self.conf_filepath, 'w') as conf_file:
+            conf_file.write("[DEFAULT]\ndb_connect = sqlite:///%s" %
+                            self.db_filepath)
+        self._opp_db("init")
+        self._opp_db("seed --users 1 --items 30 --categories 3 "
+                     "--phrase 123 --workers 1 --seed 1")
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def _opp_db(self, args):
+        return utils.execute("opp-db --config_file %s %s" %
+                             (self.conf_filepath, args))
+
+    def test_rekey(self):
+        self._opp_db("rekey --old_phrase 123 --new_phrase 456 "
+                     "--batch_size 7 --workers 2")
+
+        session = api.get_session(opp_config.OppConfig(self.conf_filepath))
+        cipher = aescipher.AEADCipher("456")
+        self.assertEqual(api.key_version_get(session), 1)
+        items = api.item_getall(session=session)
+        self.assertEqual(len(items), 30)
+        for item in items:
+            self.assertEqual(item.key_version, 1)
+            self.assertTrue(item.extract(cipher)['name'])
+        for category in api.category_getall(session=session):
+            self.assertEqual(category.key_version, 1)
+            self.assertTrue(category.extract(cipher)['name'])
+        session.close()
+
+    def test_rekey_wrong_phrase(self):
+        with self.assertRaises(RuntimeError) as cm:
+            self._opp_db("rekey --old_phrase 789 --new_phrase 456")
+        self.assertIn("Unable to decrypt items", str(cm.exception))
+
+    def test_rekey_resume(self):
+        session = api.get_session(opp_config.OppConfig(self.conf_filepath))
+
+        def interrupt(job):
+            raise KeyboardInterrupt()
+
+        with self.assertRaises(KeyboardInterrupt):
+            opp_rekey.rekey(session, "123", "456", batch_size=7,
+                            progress=interrupt)
+        session.rollback()
+        with self.assertRaises(opp_rekey.RekeyError):
+            opp_rekey.rekey(session, "123", "789", batch_size=7)
+        job = opp_rekey.rekey(session, "123", "456", batch_size=7)
+        self.assertEqual(job.status, "complete")
+        self.assertEqual(job.items_done, 30)
+        session.close()
+
+    def test_reencrypt_category_wrong_phrase(self):
+        # Legacy "Banking" ciphertext of a fixed IV, which decrypts to
+        # nothing rather than failing under the wrong key
+        name = b"pI2F6qfbWEdYzA7wvn31r1mDBVlYk6CqLsh2oGSHkmg="
+        new_cipher = aescipher.AEADCipher("456")
+        self.assertTrue(models.reencrypt_category(
+            aescipher.AEADCipher("123"), new_cipher, name, 1))
+        with self.assertRaises(ValueError):
+            models.reencrypt_category(aescipher.AEADCipher("789"),
+                                      new_cipher, name, 1)
@@ -0,0 +1,105 @@
+import json
+import os
+import shutil
+import signal
+import subprocess
+import tempfile
+import time
+import unittest
+
+from six.moves import http_client
+
+from opp.common import utils
+from opp.tools import loadgen
+
+try:
+    import gunicorn  # noqa
+except ImportError:
+    gunicorn = None
+
+
+@unittest.skipIf(gunicorn is None, "gunicorn is not installed")
+class TestServer(unittest.TestCase):
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp(prefix='opp_')
+        self.conf_filepath = os.path.join(self.test_dir, 'opp.cfg')
+        with open(self.conf_filepath, 'w') as conf_file:
+            conf_file.write("[DEFAULT]\ndb_connect = sqlite:///%s" %
+                            os.path.join(self.test_dir, 'test.sqlite'))
+        utils.execute("opp-db --config_file %s init" % self.conf_filepath)
+        self.port = loadgen._free_port()
+        self.server = subprocess.Popen(
+            ["opp-server", "--config_file", self.conf_filepath,
+             "--bind", "127.0.0.1:%d" % self.port, "--workers", "2",
+             "--threads", "2"],
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        loadgen._wait_for_port(self.port)
+
+    def tearDown(self):
+        if self.server.poll() is None:
+            self.server.kill()
+        self.server.wait()
+        self.server.stdout.close()
+        shutil.rmtree(self.test_dir)
+
+    def _request(self, method, path, payload=None):
+        conn = http_client.HTTPConnection('127.0.0.1', self.port, timeout=30)
+        conn.request(method, path, body=json.dumps(payload),
+                     headers={'Content-Type': "application/json"})
+        resp = conn.getresponse()
+        data = json.loads(resp.read().decode())
+        conn.close()
+        return resp.status, data
+
+    def _check_serving(self):
+        user = {'username': "u", 'password': "p"}
+        self._request('PUT', '/api/v1/users', user)
+        # Hit several workers, each using its own DB connections
+        for _ in range(6):
+            status, data = self._request('POST', '/api/v1/auth', user)
+            self.assertEqual(status, 200)
+            self.assertIn('access_token', data)
+
+    def test_server(self):
+        self._check_serving()
+
+        # Gracefully replace the workers
+        self.server.send_signal(signal.SIGHUP)
+        time.sleep(1)
+        self._check_serving()
+
+        self.server.send_signal(signal.SIGTERM)
+        self.assertEqual(self.server.wait(), 0)
+
+
+@unittest.skipIf(gunicorn is None, "gunicorn is not installed")
+class TestServerStores(unittest.TestCase):
+    """Stores kept in memory are refused with several workers."""
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp(prefix='opp_')
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def _check_refused(self, config, option):
+        conf_filepath = os.path.join(self.test_dir, 'opp.cfg')
+        with open(conf_filepath, 'w') as conf_file:
+            conf_file.write("[DEFAULT]\n" + config)
+        proc = subprocess.Popen(
+            ["opp-server", "--config_file", conf_filepath, "--workers", "2"],
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        output = proc.communicate()[0].decode()
+        self.assertNotEqual(proc.returncode, 0)
+        self.assertIn(option, output)
+
+    def test_memory_sessions_refused(self):
+        self._check_refused("frontend_session_store = memory",
+                            "frontend_session_store")
+
+    def test_memory_write_marks_refused(self):
+        self._check_refused("db_connect = sqlite:///%s/opp.db\n"
+                            "db_connect_replicas = sqlite:///%s/r.db" %
+                            (self.test_dir, self.test_dir),
+                            "db_replica_write_store")
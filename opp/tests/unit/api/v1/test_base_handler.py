@@ -129,6 +129,31 @@ class TestBaseResponseHandler(unittest.TestCase):
         expected = {'result': "error", 'message': "Method not supported!"}
         self.assertEqual(response, expected)
 
+    @mock.patch('flask.request')
+    @mock.patch('opp.db.api.key_version_get')
+    def test_row_cipher(self, key_version_get, request):
+        key_version_get.return_value = 2
+        request.headers = {'x-opp-old-phrase': "456"}
+        handler = bh.BaseResponseHandler(request)
+        handler.session = None
+        handler._init_ciphers("123")
+        self.assertIs(handler._row_cipher(mock.Mock(key_version=2)),
+                      handler.cipher)
+        self.assertIs(handler._row_cipher(mock.Mock(key_version=1)),
+                      handler.old_cipher)
+        self.assertIs(handler._row_cipher(None), handler.cipher)
+
+    @mock.patch('flask.request')
+    @mock.patch('opp.db.api.key_version_get')
+    def test_row_cipher_missing_old_phrase(self, key_version_get, request):
+        key_version_get.return_value = 2
+        request.headers = {}
+        handler = bh.BaseResponseHandler(request)
+        handler.session = None
+        handler._init_ciphers("123")
+        with self.assertRaises(bh.OldPassphraseRequired):
+            handler._row_cipher(mock.Mock(key_version=1))
+
 
 class TestErrorResponseHandler(unittest.TestCase):
 
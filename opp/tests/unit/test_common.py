@@ -1,17 +1,61 @@
 from six.moves import configparser
+import hashlib
+import mock
 import os
+import shutil
+import tempfile
+import time
 import unittest
 
-from opp.common import aescipher, opp_config
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ec, rsa
+
+from opp.common import (aescipher, blindindex, jwtkeys, kdf, keycache,
+                        opp_config, ratelimit, responsecache, revocation,
+                        sessions, storage, utils, writemarks)
 
 
 class TestUtils(unittest.TestCase):
 
     def test_checkpw(self):
-        pass
+        hashed = utils.hashpw("secret", 4)
+        self.assertTrue(utils.checkpw("secret", hashed))
+        self.assertFalse(utils.checkpw("wrong", hashed))
 
     def test_hashpw(self):
-        pass
+        self.assertEqual(utils.hash_rounds(utils.hashpw("secret", 5)), 5)
+        self.assertEqual(utils.hash_rounds(utils.hashpw("secret")),
+                         utils.DEFAULT_ROUNDS)
+        self.assertEqual(utils.hash_rounds("$2b$10$abc"), 10)
+        self.assertIsNone(utils.hash_rounds("plain"))
+        self.assertTrue(utils.needs_rehash(b"$2b$10$abc", 12))
+        self.assertFalse(utils.needs_rehash(b"$2b$12$abc", 12))
+
+    def test_bcrypt_rounds(self):
+        conf = {'bcrypt_rounds': "10"}
+        self.assertEqual(utils.bcrypt_rounds(conf), 10)
+        for value in ("3", "32", "x", None):
+            conf['bcrypt_rounds'] = value
+            self.assertEqual(utils.bcrypt_rounds(conf), utils.DEFAULT_ROUNDS)
+
+    @mock.patch('opp.common.utils.checkpw')
+    @mock.patch('opp.common.utils.hashpw')
+    @mock.patch('opp.common.utils.time')
+    def test_calibrate_rounds(self, time, hashpw, checkpw):
+        # Each cost doubles the time, starting at 1 ms for cost 4
+        clock = []
+        for ms in (1, 2, 4, 8, 16, 32, 64, 128):
+            clock += [0, ms / 1000.0]
+        time.time.side_effect = clock
+        rounds, timings = utils.calibrate_rounds(100)
+        self.assertEqual(rounds, 10)
+        self.assertEqual([cost for cost, _ in timings],
+                         [4, 5, 6, 7, 8, 9, 10])
+
+        # The lowest cost is the floor
+        time.time.side_effect = [0, 1]
+        self.assertEqual(utils.calibrate_rounds(1)[0], utils.MIN_ROUNDS)
 
 
 class TestAESCipher(unittest.TestCase):
@@ -22,6 +66,655 @@ class TestAESCipher(unittest.TestCase):
         decrypted = cipher.decrypt(encrypted)
         self.assertEqual(decrypted, "My Secret Message")
 
+    def test_encrypt_decrypt_raw_key(self):
+        key = aescipher.generate_key()
+        self.assertEqual(len(key), 32)
+        cipher = aescipher.AESCipher(key, raw=True)
+        encrypted = cipher.encrypt("My Secret Message")
+        decrypted = aescipher.AESCipher(key, raw=True).decrypt(encrypted)
+        self.assertEqual(decrypted, "My Secret Message")
+
+
+class TestAEADCipher(unittest.TestCase):
+
+    def test_encrypt_decrypt(self):
+        for prefix in aescipher.AEAD_ALGORITHMS:
+            cipher = aescipher.AEADCipher("secret passphrase", prefix=prefix)
+            encrypted = cipher.encrypt("My Secret Message")
+            self.assertTrue(encrypted.startswith(prefix))
+            self.assertTrue(aescipher.is_aead(encrypted))
+            decrypted = aescipher.AEADCipher("secret passphrase").decrypt(
+                encrypted.decode())
+            self.assertEqual(decrypted, "My Secret Message")
+
+    def test_associated_data(self):
+        cipher = aescipher.AEADCipher(aescipher.generate_key(), raw=True)
+        encrypted = cipher.encrypt("My Secret Message", b"items/1")
+        self.assertTrue(encrypted.startswith(b"g2:"))
+        self.assertEqual(cipher.decrypt(encrypted, b"items/1"),
+                         "My Secret Message")
+        # Bound ciphertexts can not be moved to another row
+        self.assertRaises(ValueError, cipher.decrypt, encrypted, b"items/2")
+        self.assertRaises(ValueError, cipher.decrypt, encrypted)
+        # Unbound ones are still readable
+        encrypted = cipher.encrypt("My Secret Message")
+        self.assertEqual(cipher.decrypt(encrypted, b"items/1"),
+                         "My Secret Message")
+
+    def test_decrypt_legacy(self):
+        encrypted = aescipher.AESCipher("phrase").encrypt("My Secret Message")
+        self.assertFalse(aescipher.is_aead(encrypted))
+        decrypted = aescipher.AEADCipher("phrase").decrypt(encrypted)
+        self.assertEqual(decrypted, "My Secret Message")
+
+    def test_tampered(self):
+        cipher = aescipher.AEADCipher("phrase")
+        encrypted = bytearray(cipher.encrypt("My Secret Message"))
+        encrypted[-2] = ord('A') if encrypted[-2] != ord('A') else ord('B')
+        self.assertRaises(ValueError, cipher.decrypt, bytes(encrypted))
+        self.assertRaises(ValueError, aescipher.AEADCipher("other").decrypt,
+                          cipher.encrypt("My Secret Message"))
+
+    def test_invalid_type(self):
+        cipher = aescipher.AEADCipher("phrase")
+        self.assertRaises(TypeError, cipher.encrypt, 123)
+        self.assertRaises(TypeError, cipher.encrypt, None, b"items/1")
+
+
+class TestBlindIndex(unittest.TestCase):
+
+    def test_host(self):
+        self.assertEqual(blindindex.host("https://www.GitHub.com:443/x"),
+                         "github.com")
+        self.assertEqual(blindindex.host("github.com/login"), "github.com")
+        self.assertEqual(blindindex.host("https://u:p@a.b.com"), "a.b.com")
+        self.assertEqual(blindindex.host(""), "")
+
+    def test_item_tokens(self):
+        key = blindindex.index_key(b"k" * 32)
+        tokens = blindindex.item_tokens(key, "Git", "https://hub.io")
+        self.assertIn(blindindex.marker(key), tokens)
+        exact, grams = blindindex.query_tokens(key, "hub.io")
+        self.assertTrue(set(exact) <= tokens)
+        self.assertTrue(set(grams) <= tokens)
+        exact, grams = blindindex.query_tokens(key, "gi")
+        self.assertFalse(set(exact) <= tokens)
+        self.assertEqual(grams, [])
+
+        # Tokens depend on the key
+        other = blindindex.item_tokens(blindindex.index_key(b"o" * 32),
+                                       "Git", "https://hub.io")
+        self.assertFalse(tokens & other)
+
+    SUFFIXES = blindindex.PublicSuffixList(
+        ["// comment", "", "com", "uk", "co.uk", "io", "github.io",
+         "*.ck", "!www.ck"])
+
+    def test_registrable_domain(self):
+        suffixes = self.SUFFIXES
+        self.assertEqual(blindindex.registrable_domain("a.b.example.com",
+                                                       suffixes),
+                         "example.com")
+        self.assertEqual(blindindex.registrable_domain("www.bbc.co.uk",
+                                                       suffixes),
+                         "bbc.co.uk")
+        self.assertEqual(blindindex.registrable_domain("evil.github.io",
+                                                       suffixes),
+                         "evil.github.io")
+        self.assertEqual(blindindex.registrable_domain("a.b.ck", suffixes),
+                         "a.b.ck")
+        self.assertEqual(blindindex.registrable_domain("a.www.ck", suffixes),
+                         "www.ck")
+        self.assertIsNone(blindindex.registrable_domain("github.io",
+                                                        suffixes))
+        self.assertIsNone(blindindex.registrable_domain("localhost",
+                                                        suffixes))
+        self.assertIsNone(blindindex.registrable_domain("10.0.0.1",
+                                                        suffixes))
+        self.assertIsNone(blindindex.registrable_domain("mail.x.com", None))
+
+    def test_origin(self):
+        key = blindindex.index_key(b"k" * 32)
+        suffixes = self.SUFFIXES
+        tokens = blindindex.item_tokens(key, "", "https://mail.x.com/a",
+                                        suffixes)
+        self.assertEqual(len(set(blindindex.origin_tokens(
+            key, "https://a.x.com", suffixes)) & tokens), 1)
+        self.assertEqual(len(set(blindindex.origin_tokens(
+            key, "https://mail.x.com", suffixes)) & tokens), 2)
+        self.assertEqual(blindindex.origin_tokens(key, "https://"), [])
+        self.assertEqual(blindindex.origin_rank("http://mail.x.com",
+                                                "mail.x.com", suffixes), 0)
+        self.assertEqual(blindindex.origin_rank("http://x.com",
+                                                "mail.x.com", suffixes), 1)
+        self.assertIsNone(blindindex.origin_rank("http://x.com.evil.io",
+                                                 "x.com", suffixes))
+
+        # Tenants of a private suffix do not match each other
+        tokens = blindindex.item_tokens(key, "", "https://victim.github.io",
+                                        suffixes)
+        self.assertFalse(set(blindindex.origin_tokens(
+            key, "https://evil.github.io", suffixes)) & tokens)
+        self.assertIsNone(blindindex.origin_rank("https://evil.github.io",
+                                                 "victim.github.io",
+                                                 suffixes))
+
+        # Without a suffix list only the exact host matches
+        tokens = blindindex.item_tokens(key, "", "https://mail.x.com/a")
+        self.assertEqual(len(set(blindindex.origin_tokens(
+            key, "https://a.x.com")) & tokens), 0)
+        self.assertEqual(len(set(blindindex.origin_tokens(
+            key, "https://mail.x.com")) & tokens), 1)
+        self.assertIsNone(blindindex.origin_rank("http://x.com",
+                                                 "mail.x.com"))
+        self.assertEqual(blindindex.origin_rank("http://mail.x.com",
+                                                "mail.x.com"), 0)
+
+    def test_matches(self):
+        self.assertTrue(blindindex.matches("HUB", "GitHub", ""))
+        self.assertTrue(blindindex.matches("http://x.com", "", "x.com/a"))
+        self.assertFalse(blindindex.matches("login", "", "x.com/login"))
+        self.assertFalse(blindindex.matches(" ", "GitHub", ""))
+
+
+class TestKdf(unittest.TestCase):
+
+    def test_pbkdf2(self):
+        salt = kdf.generate_salt()
+        key = kdf.derive_key("phrase", salt, "pbkdf2$1000")
+        self.assertEqual(len(key), 32)
+        self.assertEqual(key, kdf.derive_key("phrase", salt, "pbkdf2$1000"))
+        self.assertNotEqual(key, kdf.derive_key("phrase", salt,
+                                                "pbkdf2$1001"))
+        self.assertNotEqual(key, kdf.derive_key("other", salt,
+                                                "pbkdf2$1000"))
+        self.assertNotEqual(key, kdf.derive_key("phrase",
+                                                kdf.generate_salt(),
+                                                "pbkdf2$1000"))
+
+    @unittest.skipUnless(hasattr(hashlib, 'scrypt'), "scrypt unavailable")
+    def test_scrypt(self):
+        salt = kdf.generate_salt()
+        key = kdf.derive_key("phrase", salt, "scrypt$1024$8$1")
+        self.assertEqual(len(key), 32)
+        self.assertEqual(key, kdf.derive_key("phrase", salt,
+                                             "scrypt$1024$8$1"))
+
+    def test_unknown(self):
+        self.assertRaises(ValueError, kdf.derive_key, "phrase",
+                          kdf.generate_salt(), "md5$1")
+
+    def test_default_params(self):
+        conf = {'kdf_scrypt_n': "1024", 'kdf_pbkdf2_iterations': "1000"}
+        if hasattr(hashlib, 'scrypt'):
+            self.assertEqual(kdf.default_params(conf), "scrypt$1024$8$1")
+        else:
+            self.assertEqual(kdf.default_params(conf), "pbkdf2$1000")
+
+
+class TestKeyCache(unittest.TestCase):
+
+    def test_get_set(self):
+        cache = keycache.KeyCache()
+        cache.set(1, "phrase", b"key")
+        self.assertEqual(cache.get(1, "phrase"), b"key")
+        self.assertIsNone(cache.get(1, "other"))
+        self.assertIsNone(cache.get(2, "phrase"))
+
+    def test_lru_eviction(self):
+        cache = keycache.KeyCache(max_size=2)
+        cache.set(1, "p", b"k1")
+        cache.set(2, "p", b"k2")
+        cache.get(1, "p")
+        cache.set(3, "p", b"k3")
+        self.assertEqual(cache.get(1, "p"), b"k1")
+        self.assertIsNone(cache.get(2, "p"))
+        self.assertEqual(cache.get(3, "p"), b"k3")
+
+    @mock.patch('time.time')
+    def test_expiry(self, time):
+        cache = keycache.KeyCache(ttl=10)
+        time.return_value = 100
+        cache.set(1, "p", b"k1")
+        time.return_value = 109
+        self.assertEqual(cache.get(1, "p"), b"k1")
+        time.return_value = 111
+        self.assertIsNone(cache.get(1, "p"))
+
+    def test_invalidate(self):
+        cache = keycache.KeyCache()
+        cache.set(1, "p1", b"k1")
+        cache.set(1, "p2", b"k1")
+        cache.set(2, "p1", b"k2")
+        cache.invalidate(1)
+        self.assertIsNone(cache.get(1, "p1"))
+        self.assertIsNone(cache.get(1, "p2"))
+        self.assertEqual(cache.get(2, "p1"), b"k2")
+
+    def test_tag(self):
+        cache = keycache.KeyCache()
+        cache.set(1, "p", b"k1", "w1")
+        self.assertEqual(cache.get(1, "p", "w1"), b"k1")
+        # A changed tag, e.g. a re-wrapped key, discards the entry
+        self.assertIsNone(cache.get(1, "p", "w2"))
+        self.assertIsNone(cache.get(1, "p", "w1"))
+
+
+class TestRateLimit(unittest.TestCase):
+
+    def test_parse_rule(self):
+        self.assertEqual(ratelimit.parse_rule("10/60"), (10, 60))
+        self.assertEqual(ratelimit.parse_rule("5"), (5, 60))
+        self.assertIsNone(ratelimit.parse_rule("0"))
+        for rule in ("x/60", "5/0", "-1/60"):
+            self.assertRaises(ValueError, ratelimit.parse_rule, rule)
+
+    def _check_store(self, store):
+        # A burst of 3, then one token per 10 seconds
+        for now in (100, 100, 100):
+            self.assertEqual(store.take("k", 3, 0.1, now), 0)
+        self.assertAlmostEqual(store.take("k", 3, 0.1, 101), 9)
+        self.assertEqual(store.take("other", 3, 0.1, 101), 0)
+        self.assertEqual(store.take("k", 3, 0.1, 111), 0)
+        self.assertGreater(store.take("k", 3, 0.1, 111), 0)
+
+    def test_memory_store(self):
+        self._check_store(ratelimit.MemoryStore())
+        store = ratelimit.MemoryStore(max_keys=1)
+        store.take("a", 1, 1, 100)
+        store.take("b", 1, 1, 100)
+        self.assertEqual(store.take("a", 1, 1, 100), 0)
+
+    def test_sqlite_store(self):
+        test_dir = tempfile.mkdtemp(prefix='opp_')
+        try:
+            url = "sqlite:///%s" % os.path.join(test_dir, "buckets.db")
+            store = ratelimit.create_store(url)
+            self._check_store(store)
+            # Buckets are shared by all stores using the file
+            self.assertGreater(ratelimit.create_store(url).take(
+                "k", 3, 0.1, 111), 0)
+        finally:
+            shutil.rmtree(test_dir, ignore_errors=True)
+
+    def test_limiter(self):
+        limiter = ratelimit.RateLimiter(ratelimit.MemoryStore(),
+                                        {'username': (2, 60),
+                                         'ip': (3, 60)})
+        # Only failures count against the username
+        for i in range(3):
+            limiter.check(username="a", ip="2.2.2.%d" % i)
+        limiter.failed(username="a", ip="1.1.1.1")
+        limiter.failed(username="a", ip="1.1.1.1")
+        with self.assertRaises(ratelimit.RateLimited) as cm:
+            limiter.check(username="a", ip="3.3.3.3")
+        self.assertEqual(cm.exception.retry_after, 30)
+        # Every attempt counts against the IP
+        limiter.check(username="b", ip="1.1.1.1")
+        limiter.check(username="b", ip="1.1.1.1")
+        limiter.check(username="b", ip="1.1.1.1")
+        self.assertRaises(ratelimit.RateLimited, limiter.check,
+                          username="b", ip="1.1.1.1")
+        limiter.check(username="b", ip="2.2.2.2")
+        limiter.check(username="b", ip=None)
+
+    def test_peek(self):
+        store = ratelimit.MemoryStore()
+        for _ in range(3):
+            self.assertEqual(store.take("k", 1, 0.1, 100, cost=0), 0)
+        self.assertEqual(store.take("k", 1, 0.1, 100), 0)
+        self.assertGreater(store.take("k", 1, 0.1, 100, cost=0), 0)
+
+    def test_login_limiter_config(self):
+        conf = {'login_rate_limit_username': "bad",
+                'login_rate_limit_ip': "0",
+                'login_rate_limit_store': "redis://localhost"}
+        limiter = ratelimit.login_limiter(conf)
+        self.assertEqual(limiter.rules, {})
+        self.assertIsInstance(limiter.store, ratelimit.MemoryStore)
+
+
+class TestStorage(unittest.TestCase):
+
+    def test_lru_cache(self):
+        cache = storage.LRUCache(2)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        self.assertEqual(cache.get("a"), 1)
+        # The least recently used entry is dropped
+        cache.set("c", 3)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.keys(), ["a", "c"])
+        # Entries failing the check are dropped
+        self.assertIsNone(cache.get("a", valid=lambda value: value > 1))
+        self.assertNotIn("a", cache)
+        cache.discard(lambda key, value: key == "c")
+        self.assertEqual(len(cache), 0)
+
+    def test_lru_cache_size(self):
+        cache = storage.LRUCache(10, size_of=len)
+        cache.set("a", "xxxx")
+        cache.set("b", "xxxx")
+        cache.set("a", "xxxxx")
+        self.assertEqual(cache.size, 9)
+        cache.set("c", "xxx")
+        self.assertEqual(cache.keys(), ["a", "c"])
+        self.assertEqual(cache.size, 8)
+        cache.clear()
+        self.assertEqual(cache.size, 0)
+
+    def test_sqlite_file(self):
+        test_dir = tempfile.mkdtemp(prefix='opp_')
+        try:
+            db = storage.SqliteFile(os.path.join(test_dir, "s.db"),
+                                    ["CREATE TABLE t (x INTEGER)"])
+            # No connection is left open to be inherited by forks
+            self.assertIsNone(getattr(db._local, 'conn', None))
+            conn = db.connection()
+            self.assertIs(db.connection(), conn)
+            conn.execute("SELECT x FROM t")
+            with mock.patch('os.getpid', return_value=os.getpid() + 1):
+                self.assertIsNot(db.connection(), conn)
+        finally:
+            shutil.rmtree(test_dir, ignore_errors=True)
+
+
+class TestWriteMarks(unittest.TestCase):
+
+    def _check_store(self, store):
+        self.assertEqual(store.get(1), 0)
+        store.set(1, 100)
+        store.set(2, 105)
+        self.assertEqual(store.get(1), 100)
+        # Marks older than the window are purged
+        store.set(3, 110)
+        self.assertEqual(store.get(1), 0)
+        self.assertEqual(store.get(2), 105)
+
+    def test_stores(self):
+        self._check_store(writemarks.create_store("memory", 10))
+        test_dir = tempfile.mkdtemp(prefix='opp_')
+        try:
+            url = "sqlite:///%s" % os.path.join(test_dir, "marks.db")
+            self._check_store(writemarks.create_store(url, 10))
+            # Marks are shared by all stores using the file
+            self.assertEqual(writemarks.create_store(url, 10).get(2), 105)
+        finally:
+            shutil.rmtree(test_dir, ignore_errors=True)
+        self.assertRaises(ValueError, writemarks.create_store, "redis://x",
+                          10)
+
+
+class TestSessions(unittest.TestCase):
+
+    def _check_store(self, store):
+        self.assertIsNone(store.get("k"))
+        store.set("k", '{"a": 1}', 100)
+        store.set("old", '{}', 10)
+        self.assertEqual(tuple(store.get("k")), ('{"a": 1}', 100))
+        store.purge(50)
+        self.assertIsNone(store.get("old"))
+        store.delete("k")
+        self.assertIsNone(store.get("k"))
+        store.delete("k")
+
+    def test_stores(self):
+        self._check_store(sessions.create_store("memory"))
+        test_dir = tempfile.mkdtemp(prefix='opp_')
+        try:
+            self._check_store(sessions.create_store(
+                "sqlite:///%s" % os.path.join(test_dir, "sessions.db")))
+            self._check_store(sessions.create_store(
+                "file://%s" % os.path.join(test_dir, "sessions")))
+        finally:
+            shutil.rmtree(test_dir, ignore_errors=True)
+        self.assertRaises(ValueError, sessions.create_store, "redis://x")
+
+    def test_store_url(self):
+        def url(store, db_connect):
+            return sessions.store_url({'frontend_session_store': store,
+                                       'db_connect': db_connect})
+
+        self.assertEqual(url("memory", "sqlite:////v/opp.db"), "memory")
+        self.assertEqual(url("", "sqlite:////v/opp.db?timeout=5"),
+                         "sqlite:////v/opp_sessions.sqlite")
+        self.assertEqual(url("", "sqlite:///:memory:"), "memory")
+        self.assertEqual(url("", "mysql://u@h/opp"), "memory")
+        self.assertEqual(url("", None), "memory")
+
+    @mock.patch('time.time')
+    def test_sliding_expiry(self, time):
+        store = mock.Mock(wraps=sessions.MemoryStore())
+        manager = sessions.SessionManager(store, lifetime=600, cache_ttl=5,
+                                          touch_interval=60)
+        sid = manager.new_id()
+        time.return_value = 1000
+        self.assertIsNone(manager.load(sid))
+        manager.save(sid, {'u': 1})
+        self.assertNotIn(sid, str(store.set.call_args))
+        self.assertEqual(manager.load(sid), ({'u': 1}, 1600))
+
+        # Unmodified sessions are only written once their expiry moves by
+        # the touch interval
+        time.return_value = 1030
+        manager.save(sid, {'u': 1}, 1600, modified=False)
+        self.assertEqual(store.set.call_count, 1)
+        time.return_value = 1060
+        manager.save(sid, {'u': 1}, 1600, modified=False)
+        self.assertEqual(store.set.call_count, 2)
+
+        # Expired without requests
+        time.return_value = 1661
+        self.assertIsNone(manager.load(sid))
+
+    @mock.patch('time.time')
+    def test_cache(self, time):
+        store = mock.Mock(wraps=sessions.MemoryStore())
+        manager = sessions.SessionManager(store, cache_size=1, cache_ttl=5)
+        time.return_value = 1000
+        manager.save("a", {'u': 1})
+        manager.load("a")
+        manager.load("a")
+        store.get.assert_not_called()
+
+        # Ended by another process, noticed once the entry is stale
+        other = sessions.SessionManager(store)
+        other.delete("a")
+        self.assertIsNotNone(manager.load("a"))
+        time.return_value = 1005
+        self.assertIsNone(manager.load("a"))
+
+        # Least recently used entries are evicted
+        manager.save("b", {'u': 2})
+        manager.save("c", {'u': 3})
+        store.get.reset_mock()
+        manager.load("b")
+        self.assertEqual(store.get.call_count, 1)
+
+
+class TestResponseCache(unittest.TestCase):
+
+    def test_get_set(self):
+        cache = responsecache.ResponseCache(10000)
+        creds = ("1", "jwt", "phrase", "")
+        self.assertIsNone(cache.get(creds, b"", 0))
+        cache.set(creds, b"", 0, '{"items": []}')
+        self.assertEqual(cache.get(creds, b"", 0), '{"items": []}')
+        self.assertIsNone(cache.get(creds, b"limit=1", 0))
+        self.assertIsNone(cache.get(("1", "jwt", "other", ""), b"", 0))
+        self.assertIsNone(cache.get(("1", "jwt2", "phrase", ""), b"", 0))
+
+        # Stale generations are discarded
+        self.assertIsNone(cache.get(creds, b"", 1))
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.size, 0)
+
+    @mock.patch('time.time')
+    def test_expiry(self, time):
+        cache = responsecache.ResponseCache(10000, ttl=10)
+        time.return_value = 100
+        cache.set(("1",), b"", 0, "r")
+        time.return_value = 110
+        self.assertEqual(cache.get(("1",), b"", 0), "r")
+        time.return_value = 111
+        self.assertIsNone(cache.get(("1",), b"", 0))
+
+    def test_lru_eviction(self):
+        entry = len(aescipher.AEADCipher(b"k" * 32, raw=True).encrypt(
+            "x" * 100)) + responsecache.ResponseCache.ENTRY_OVERHEAD
+        cache = responsecache.ResponseCache(entry * 2)
+        cache.set(("a",), b"", 0, "a" * 100)
+        cache.set(("b",), b"", 0, "b" * 100)
+        cache.get(("a",), b"", 0)
+        cache.set(("c",), b"", 0, "c" * 100)
+        self.assertEqual(cache.size, entry * 2)
+        self.assertIsNone(cache.get(("b",), b"", 0))
+        self.assertIsNotNone(cache.get(("a",), b"", 0))
+
+        # Responses larger than the cache are not cached
+        cache.set(("d",), b"", 0, "d" * 1000)
+        self.assertIsNone(cache.get(("d",), b"", 0))
+        self.assertEqual(len(cache), 2)
+
+
+class TestRevocationList(unittest.TestCase):
+
+    @mock.patch('time.time')
+    def test_refresh(self, time):
+        rows = [("a", None)]
+        loader = mock.Mock(side_effect=lambda: list(rows))
+        revoked = revocation.RevocationList(loader, refresh_interval=5)
+        time.return_value = 100
+        self.assertTrue(revoked.is_revoked("a"))
+        self.assertFalse(revoked.is_revoked("b"))
+
+        rows.append(("b", None))
+        time.return_value = 104
+        self.assertFalse(revoked.is_revoked("b"))
+        time.return_value = 105
+        self.assertTrue(revoked.is_revoked("b"))
+        self.assertEqual(loader.call_count, 2)
+
+        revoked.add("c")
+        self.assertTrue(revoked.is_revoked("c"))
+        self.assertEqual(len(revoked), 3)
+
+    def test_loader_error(self):
+        loader = mock.Mock(side_effect=[[("a", None)], RuntimeError()])
+        revoked = revocation.RevocationList(loader, refresh_interval=0)
+        self.assertTrue(revoked.is_revoked("a"))
+        self.assertTrue(revoked.is_revoked("a"))
+        self.assertEqual(loader.call_count, 2)
+
+
+def _write_key(path, key, private=True):
+    if private:
+        data = key.private_bytes(serialization.Encoding.PEM,
+                                 serialization.PrivateFormat.PKCS8,
+                                 serialization.NoEncryption())
+    else:
+        data = key.public_key().public_bytes(
+            serialization.Encoding.PEM,
+            serialization.PublicFormat.SubjectPublicKeyInfo)
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+class TestKeyRing(unittest.TestCase):
+
+    def setUp(self):
+        self.key_dir = tempfile.mkdtemp(prefix='opp_')
+        self.keys = [rsa.generate_private_key(65537, 2048, default_backend())
+                     for _ in range(3)]
+
+    def tearDown(self):
+        shutil.rmtree(self.key_dir, ignore_errors=True)
+
+    def _write(self, kid, key, private=True, mtime=None):
+        name = kid + (".pem" if private else ".pub.pem")
+        path = os.path.join(self.key_dir, name)
+        _write_key(path, key, private)
+        if mtime:
+            os.utime(path, (mtime, mtime))
+        return path
+
+    def test_signing_key(self):
+        now = time.time()
+        self._write("k1", self.keys[0], mtime=now - 20)
+        self._write("k2", self.keys[1], mtime=now - 10)
+        self._write("k0", self.keys[2], private=False)
+        ring = jwtkeys.KeyRing(self.key_dir, "RS256")
+        self.assertEqual(ring.signing_key(), ("k2", mock.ANY))
+
+        ring = jwtkeys.KeyRing(self.key_dir, "RS256", signing_kid="k1")
+        self.assertEqual(ring.signing_key()[0], "k1")
+        for kid, key in [("k0", self.keys[2]), ("k1", self.keys[0])]:
+            self.assertEqual(ring.public_key(kid).public_numbers(),
+                             key.public_key().public_numbers())
+        self.assertIsNone(ring.public_key("k3"))
+
+    def test_errors(self):
+        self.assertRaises(jwtkeys.KeyRingError, jwtkeys.KeyRing,
+                          self.key_dir, "HS256")
+        self.assertRaises(jwtkeys.KeyRingError, jwtkeys.KeyRing,
+                          os.path.join(self.key_dir, "none"), "RS256")
+        self._write("k0", self.keys[0], private=False)
+        self.assertRaises(jwtkeys.KeyRingError, jwtkeys.KeyRing,
+                          self.key_dir, "RS256")
+        self._write("k1", self.keys[1])
+        self.assertRaises(jwtkeys.KeyRingError, jwtkeys.KeyRing,
+                          self.key_dir, "RS256", signing_kid="k2")
+        self.assertRaises(jwtkeys.KeyRingError, jwtkeys.KeyRing,
+                          self.key_dir, "ES256")
+
+    @mock.patch('opp.common.jwtkeys._load', wraps=jwtkeys._load)
+    def test_refresh(self, load):
+        self._write("k1", self.keys[0], mtime=time.time() - 10)
+        ring = jwtkeys.KeyRing(self.key_dir, "RS256", refresh_interval=0)
+        self._write("k2", self.keys[1])
+        self.assertEqual(ring.signing_key()[0], "k2")
+        self.assertEqual(load.call_count, 2)
+
+        # Broken files are ignored until fixed
+        with open(os.path.join(self.key_dir, "k3.pem"), 'w') as f:
+            f.write("garbage")
+        self.assertEqual(ring.signing_key()[0], "k2")
+        os.remove(os.path.join(self.key_dir, "k1.pem"))
+        os.remove(os.path.join(self.key_dir, "k3.pem"))
+        self.assertIsNone(ring.public_key("k1"))
+        self.assertIsNotNone(ring.public_key("k2"))
+
+    def test_refresh_on_miss(self):
+        self._write("k1", self.keys[0])
+        with mock.patch('time.time', return_value=1000):
+            ring = jwtkeys.KeyRing(self.key_dir, "RS256")
+        # A key added by another process is picked up when first used,
+        # at most every miss_interval
+        self._write("k2", self.keys[1])
+        with mock.patch('time.time', return_value=1000.5):
+            self.assertIsNone(ring.public_key("k2"))
+        with mock.patch('time.time', return_value=1001):
+            self.assertIsNotNone(ring.public_key("k2"))
+            self.assertIsNone(ring.public_key("k3"))
+
+    def test_jwks(self):
+        self._write("k1", self.keys[0])
+        jwks = jwtkeys.KeyRing(self.key_dir, "RS256").jwks()
+        self.assertEqual(len(jwks['keys']), 1)
+        jwk = jwks['keys'][0]
+        self.assertEqual(jwk['kid'], "k1")
+        self.assertEqual(jwk['kty'], "RSA")
+        self.assertEqual(jwk['alg'], "RS256")
+        self.assertEqual(jwk['e'], "AQAB")
+
+        key = ec.generate_private_key(ec.SECP256R1(), default_backend())
+        os.remove(os.path.join(self.key_dir, "k1.pem"))
+        self._write("e1", key)
+        jwk = jwtkeys.KeyRing(self.key_dir, "ES256").jwks()['keys'][0]
+        self.assertEqual(jwk['crv'], "P-256")
+        self.assertEqual(len(jwk['x']), 43)
+        self.assertEqual(len(jwk['y']), 43)
+
 
 class TestConfig(unittest.TestCase):
 
@@ -0,0 +1,79 @@
+from datetime import datetime, timedelta
+import mock
+import unittest
+
+import jwt
+
+from opp.flask import flask_jwt
+
+
+class TestJWTVerifier(unittest.TestCase):
+
+    def setUp(self):
+        self.config = dict(flask_jwt.CONFIG_DEFAULTS)
+        self.config['SECRET_KEY'] = "secret"
+        self.verifier = flask_jwt.JWTVerifier(self.config)
+
+    def _token(self, key="secret", exp=300, identity=1):
+        now = datetime.utcnow()
+        payload = {'iat': now, 'nbf': now,
+                   'exp': now + timedelta(seconds=exp),
+                   'identity': identity}
+        return jwt.encode(payload, key, algorithm='HS256')
+
+    def test_options(self):
+        self.assertEqual(self.verifier.algorithms, ['HS256'])
+        self.assertTrue(self.verifier.options['verify_signature'])
+        self.assertTrue(self.verifier.options['require_exp'])
+
+    @mock.patch('jwt.decode', wraps=jwt.decode)
+    def test_cache_hit(self, decode):
+        token = self._token()
+        self.assertEqual(self.verifier.decode(token)['identity'], 1)
+        payload = self.verifier.decode(token.decode())
+        self.assertEqual(payload['identity'], 1)
+        self.assertEqual(decode.call_count, 1)
+
+        # Callers must not be able to alter cached payloads
+        payload['identity'] = 2
+        self.assertEqual(self.verifier.decode(token)['identity'], 1)
+
+    @mock.patch('jwt.decode', wraps=jwt.decode)
+    def test_cache_expiry(self, decode):
+        token = self._token()
+        exp = self.verifier.decode(token)['exp']
+        with mock.patch('time.time') as time:
+            time.return_value = exp + 11
+            self.verifier.decode(token)
+        self.assertEqual(decode.call_count, 2)
+
+    def test_invalid_tokens_not_cached(self):
+        token = self._token(key="other")
+        for _ in range(2):
+            self.assertRaises(jwt.InvalidTokenError,
+                              self.verifier.decode, token)
+        self.assertRaises(jwt.ExpiredSignatureError,
+                          self.verifier.decode, self._token(exp=-60))
+        self.assertEqual(len(self.verifier._cache), 0)
+
+    def test_lru(self):
+        self.config['JWT_VERIFY_CACHE_SIZE'] = 2
+        verifier = flask_jwt.JWTVerifier(self.config)
+        tokens = [self._token(identity=i) for i in range(3)]
+        verifier.decode(tokens[0])
+        verifier.decode(tokens[1])
+        verifier.decode(tokens[0])
+        verifier.decode(tokens[2])
+        self.assertEqual(len(verifier._cache), 2)
+        with mock.patch('jwt.decode', wraps=jwt.decode) as decode:
+            verifier.decode(tokens[0])
+            verifier.decode(tokens[2])
+            self.assertEqual(decode.call_count, 0)
+            verifier.decode(tokens[1])
+            self.assertEqual(decode.call_count, 1)
+
+    def test_cache_disabled(self):
+        self.config['JWT_VERIFY_CACHE_SIZE'] = 0
+        verifier = flask_jwt.JWTVerifier(self.config)
+        verifier.decode(self._token())
+        self.assertEqual(len(verifier._cache), 0)
@@ -0,0 +1,59 @@
+import json
+import os
+import subprocess
+import sys
+import unittest
+
+
+# Cumulative import time allowed for the app modules, in microseconds
+IMPORT_BUDGET_US = int(os.environ.get('OPP_IMPORT_BUDGET_US', 500000))
+
+# Modules only needed once requests are served
+LAZY_MODULES = ['Crypto', 'bcrypt', 'cryptography', 'jwt', 'sqlalchemy',
+                'opp.api.v1.base_handler', 'opp.db.api']
+
+
+def _run(args):
+    process = subprocess.Popen([sys.executable] + args,
+                               stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE)
+    out, err = process.communicate()
+    if process.returncode != 0:
+        raise RuntimeError(err.decode())
+    return out.decode(), err.decode()
+
+
+class TestImportTime(unittest.TestCase):
+
+    def test_create_app_is_lazy(self):
+        code = ("import json, sys\n"
+                "from opp.flask import create_app\n"
+                "create_app()\n"
+                "print(json.dumps([m for m in %r if m in sys.modules]))" %
+                LAZY_MODULES)
+        out, _ = _run(['-c', code])
+        self.assertEqual([], json.loads(out))
+
+    @unittest.skipIf(sys.version_info < (3, 7), "-X importtime requires "
+                     "Python 3.7+")
+    def test_import_time_budget(self):
+        _, err = _run(['-X', 'importtime', '-c',
+                       'import opp.flask.backend, opp.flask.frontend'])
+        # Lines look like "import time: self [us] | cumulative | name"
+        # with nested imports indented, so only top-level ones are summed
+        top_level = []
+        for line in err.splitlines():
+            if not line.startswith("import time:"):
+                continue
+            fields = line[len("import time:"):].split('|')
+            try:
+                cumulative = int(fields[1])
+            except ValueError:
+                continue
+            if not fields[2].startswith("  "):
+                top_level.append((cumulative, fields[2].strip()))
+        total = sum(cumulative for cumulative, _ in top_level)
+        slowest = sorted(top_level, reverse=True)[:5]
+        self.assertLess(total, IMPORT_BUDGET_US,
+                        "Importing the app took %dus, slowest: %s" %
+                        (total, slowest))
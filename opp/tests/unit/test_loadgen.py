@@ -0,0 +1,35 @@
+import unittest
+
+from opp.tools import loadgen
+
+
+class TestLoadgen(unittest.TestCase):
+
+    def test_parse_mix(self):
+        weights = loadgen.parse_mix("list=4, create=1,delete=0")
+        self.assertEqual(weights, {'list': 4, 'create': 1, 'delete': 0})
+
+    def test_parse_mix_invalid(self):
+        for mix in ["list", "list=x", "bogus=1", "list=-1", "list=0"]:
+            with self.assertRaises(ValueError):
+                loadgen.parse_mix(mix)
+
+    def test_percentile(self):
+        samples = list(range(1, 101))
+        self.assertIsNone(loadgen.percentile([], 50))
+        self.assertEqual(loadgen.percentile(samples, 50), 50)
+        self.assertEqual(loadgen.percentile(samples, 95), 95)
+        self.assertEqual(loadgen.percentile(samples, 99), 99)
+        self.assertEqual(loadgen.percentile([7], 99), 7)
+
+    def test_summarize(self):
+        results = [{'list': {'latencies': [0.1, 0.3], 'errors': 0}},
+                   {'list': {'latencies': [0.2], 'errors': 1},
+                    'create': {'latencies': [], 'errors': 0}}]
+        report = loadgen.summarize(results, 2.0)
+        self.assertEqual(report['total']['count'], 3)
+        self.assertEqual(report['total']['errors'], 1)
+        self.assertEqual(report['endpoints']['list']['rps'], 1.5)
+        self.assertEqual(report['endpoints']['list']['p50_ms'], 200.0)
+        self.assertEqual(report['endpoints']['list']['max_ms'], 300.0)
+        self.assertIsNone(report['endpoints']['create']['p99_ms'])
@@ -1,13 +1,26 @@
 #!/usr/bin/env python
 
+import multiprocessing
+import random
+import string
 import sys
 
 import click
 from sqlalchemy import create_engine, exc
 from sqlalchemy_utils import database_exists, create_database
 
-from opp.common import opp_config
-from opp.db import models
+from opp.common import aescipher, opp_config, utils
+from opp.db import api, models
+from opp.db import backup as opp_backup
+from opp.db import rekey as opp_rekey
+
+
+WORDS = ["bank", "mail", "cloud", "shop", "travel", "work", "home", "game",
+         "news", "music", "photo", "social", "health", "energy", "phone",
+         "credit", "savings", "insurance", "school", "library", "forum"]
+TLDS = ["com", "com", "com", "org", "net", "io", "co.uk", "de"]
+CATEGORIES = ["Banking", "Email", "Shopping", "Social", "Work", "Travel",
+              "Utilities", "Entertainment", "Health", "Education"]
 
 
 class Config:
@@ -36,26 +49,286 @@ def main(config, config_file, verbose):
     config.conf = opp_config.OppConfig(config_file)
 
 
+def _create_engine(db_connect):
+    if not db_connect:
+        sys.exit("Error: database connection string not "
+                 "found in any of the configuration files")
+    try:
+        return create_engine(db_connect)
+    except exc.NoSuchModuleError as e:
+        sys.exit("Error: %s" % str(e))
+
+
+def _create_schema(config, engine):
+    try:
+        if not database_exists(engine.url):
+            printv(config, "Creating database: 'openpassphrase'")
+            create_database(engine.url)
+    except exc.OperationalError as e:
+        sys.exit("Error: %s" % str(e))
+    printv(config, "Creating tables based on models")
+    models.Base.metadata.create_all(engine)
+
+
 @main.command()
 @pass_config
 def init(config):
-    db_connect = config.conf['db_connect']
-    if db_connect:
-        try:
-            engine = create_engine(db_connect)
-        except exc.NoSuchModuleError as e:
-            sys.exit("Error: %s" % str(e))
-        try:
-            if not database_exists(engine.url):
-                printv(config, "Creating database: 'openpassphrase'")
-                create_database(engine.url)
-        except exc.OperationalError as e:
-            sys.exit("Error: %s" % str(e))
-        printv(config, "Creating tables based on models")
-        models.Base.metadata.create_all(engine)
+    engine = _create_engine(config.conf['db_connect'])
+    _create_schema(config, engine)
+
+
+@main.command()
+@click.argument('archive', type=click.File('wb'))
+@click.option('--chunk_size', default=1000, show_default=True,
+              help='Number of rows read per query')
+@pass_config
+def backup(config, archive, chunk_size):
+    """Stream the whole database into a compressed ARCHIVE file.
+
+    The backup reads from a consistent snapshot, so it can safely run
+    while the service is online. Note that it blocks writes to SQLite
+    databases which are not in WAL mode. Secrets are stored exactly as they
+    are in the database, i.e. encrypted.
+    """
+    engine = _create_engine(config.conf['db_connect'])
+
+    def progress(table, count):
+        printv(config, "Backed up %d rows from '%s'" % (count, table))
+
+    try:
+        counts = opp_backup.dump(engine, archive, chunk_size, progress)
+    except (opp_backup.BackupError, exc.SQLAlchemyError) as e:
+        sys.exit("Error: %s" % str(e))
+    for table in sorted(counts):
+        printv(config, "%s: %d rows" % (table, counts[table]))
+
+
+@main.command()
+@click.argument('archive', type=click.File('rb'))
+@click.option('--db_connect', default=None,
+              help='Restore into this database instead of the configured '
+                   'one, e.g. to migrate from SQLite to PostgreSQL')
+@pass_config
+def restore(config, archive, db_connect):
+    """Restore a backup ARCHIVE into an empty database."""
+    engine = _create_engine(db_connect or config.conf['db_connect'])
+    _create_schema(config, engine)
+
+    def progress(table, count):
+        printv(config, "Restored %d rows into '%s'" % (count, table))
+
+    try:
+        counts = opp_backup.load(engine, archive, progress)
+    except (opp_backup.BackupError, exc.SQLAlchemyError, IOError,
+            ValueError) as e:
+        sys.exit("Error: %s" % str(e))
+    for table in sorted(counts):
+        printv(config, "%s: %d rows" % (table, counts[table]))
+
+
+_TEXT_POOLS = {}
+
+
+def _random_text(rng, min_len, max_len, alphabet=string.ascii_letters):
+    # Slicing a pre-generated pool is much faster than picking characters
+    # one by one, which would otherwise dominate the seeding time
+    pool = _TEXT_POOLS.get(alphabet)
+    if pool is None:
+        pool_rng = random.Random(len(_TEXT_POOLS))
+        pool = "".join(pool_rng.choice(alphabet) for _ in range(8192))
+        _TEXT_POOLS[alphabet] = pool
+    length = rng.randint(min_len, max_len)
+    offset = rng.randint(0, len(pool) - length)
+    return pool[offset:offset + length]
+
+
+def _random_item(rng):
+    """Generate plain item values with realistic field length spread."""
+    words = [rng.choice(WORDS) for _ in range(rng.randint(1, 3))]
+    host = "".join(words) + str(rng.randint(0, 99))
+    name = " ".join(word.capitalize() for word in words)
+    url = ""
+    if rng.random() < 0.85:
+        url = "https://%s%s.%s" % (rng.choice(["", "www.", "login."]), host,
+                                   rng.choice(TLDS))
+        if rng.random() < 0.4:
+            url += "/" + _random_text(rng, 4, 60, string.ascii_lowercase)
+    account = ""
+    if rng.random() < 0.3:
+        account = _random_text(rng, 6, 16, string.digits)
+    if rng.random() < 0.6:
+        username = "%s@%s.com" % (_random_text(rng, 3, 12), host)
     else:
+        username = _random_text(rng, 3, 16)
+    password = _random_text(rng, 8, 32, string.ascii_letters +
+                            string.digits + string.punctuation)
+    blob = ""
+    if rng.random() < 0.2:
+        # Occasional free form notes, mostly short with a long tail
+        length = min(int(rng.expovariate(1.0 / 120)) + 10, 1500)
+        blob = _random_text(rng, length, length,
+                            string.ascii_letters + " " * 8)
+    return [name, url, account, username, password, blob]
+
+
+def _init_worker():
+    # Forked workers must not share the parent's PyCrypto RNG state
+    from Crypto import Random
+    Random.atfork()
+
+
+def _seed_item_batch(args):
+    phrase, first_id, count, category_ids, seed = args
+    rng = random.Random(seed)
+    cipher = aescipher.AEADCipher(phrase)
+    mappings = []
+    for item_id in range(first_id, first_id + count):
+        columns = models.encrypt_item(cipher, _random_item(rng), item_id)
+        columns['id'] = item_id
+        columns['category_id'] = None
+        if category_ids and rng.random() < 0.8:
+            columns['category_id'] = rng.choice(category_ids)
+        mappings.append(columns)
+    return mappings
+
+
+@main.command()
+@click.option('--users', default=1, show_default=True,
+              help='Number of users to create')
+@click.option('--username_prefix', default="user", show_default=True,
+              help='Users are named <prefix>0 through <prefix>N-1')
+@click.option('--password', default="password", show_default=True,
+              help='Login password of the generated users')
+@click.option('--phrase', required=True,
+              help='Passphrase used to encrypt categories and items')
+@click.option('--categories', default=10, show_default=True,
+              help='Number of categories to create')
+@click.option('--items', default=1000, show_default=True,
+              help='Number of items to create per user')
+@click.option('--batch_size', default=1000, show_default=True,
+              help='Number of rows inserted per transaction')
+@click.option('--workers', default=multiprocessing.cpu_count(),
+              show_default=True,
+              help='Number of processes generating and encrypting items')
+@click.option('--seed', default=None, type=int,
+              help='Random seed for reproducible data sets')
+@pass_config
+def seed(config, users, username_prefix, password, phrase, categories,
+         items, batch_size, workers, seed):
+    """Populate the database with synthetic users, categories and items.
+
+    Categories and items are encrypted bound to their ids, which are
+    therefore assigned up front. There must be no other writers meanwhile.
+    """
+    if not config.conf['db_connect']:
         sys.exit("Error: database connection string not "
                  "found in any of the configuration files")
+    session = api.get_session(config.conf)
+    rng = random.Random(seed)
+
+    # Hashing is deliberately slow, so all users share a single hash
+    printv(config, "Creating %d users" % users)
+    hashed = utils.hashpw(password, utils.bcrypt_rounds(config.conf))
+    for start in range(0, users, batch_size):
+        mappings = [{'username': "%s%d" % (username_prefix, i),
+                     'password': hashed}
+                    for i in range(start, min(start + batch_size, users))]
+        api.user_bulk_create(mappings, session=session)
+
+    printv(config, "Creating %d categories" % categories)
+    cipher = aescipher.AEADCipher(phrase)
+    first_id = api.category_max_id(session=session) + 1
+    category_ids = list(range(first_id, first_id + categories))
+    mappings = [{'id': category_id, 'name': cipher.encrypt(
+        rng.choice(CATEGORIES), models.category_aad(category_id))}
+        for category_id in category_ids]
+    api.category_bulk_create(mappings, session=session)
+
+    total = users * items
+    first_id = api.item_max_id(session=session) + 1
+    batches = [(phrase, first_id + start, min(batch_size, total - start),
+                category_ids, rng.getrandbits(32))
+               for start in range(0, total, batch_size)]
+    pool = multiprocessing.Pool(max(1, workers), _init_worker)
+    try:
+        with click.progressbar(length=total,
+                               label="Creating %d items" % total) as bar:
+            for mappings in pool.imap(_seed_item_batch, batches):
+                api.item_bulk_create(mappings, session=session)
+                bar.update(len(mappings))
+        opp_backup.reset_sequences(session.connection())
+        session.commit()
+    finally:
+        pool.close()
+        pool.join()
+        session.close()
+
+
+@main.command()
+@click.option('--old_phrase', prompt=True, hide_input=True,
+              help='Passphrase the vault is currently encrypted with')
+@click.option('--new_phrase', prompt=True, hide_input=True,
+              confirmation_prompt=True,
+              help='Passphrase to re-encrypt the vault with')
+@click.option('--batch_size', default=500, show_default=True,
+              help='Number of rows re-encrypted per transaction')
+@click.option('--workers', default=multiprocessing.cpu_count(),
+              show_default=True,
+              help='Number of processes re-encrypting each batch')
+@pass_config
+def rekey(config, old_phrase, new_phrase, batch_size, workers):
+    """Re-encrypt all categories and items with a new passphrase.
+
+    The vault stays online while rows are re-encrypted in batches. If
+    interrupted, run the command again with the same passphrases to resume.
+    """
+    if not config.conf['db_connect']:
+        sys.exit("Error: database connection string not "
+                 "found in any of the configuration files")
+    session = api.get_session(config.conf)
+
+    def progress(job):
+        printv(config, "Re-encrypted %d items, %d categories" %
+               (job.items_done, job.categories_done))
+
+    pool = multiprocessing.Pool(max(1, workers), _init_worker)
+    try:
+        job = opp_rekey.rekey(session, old_phrase, new_phrase, batch_size,
+                              pool.map, workers, progress)
+        click.echo("Re-keyed %d items and %d categories to key version %d" %
+                   (job.items_done, job.categories_done, job.to_version))
+    except opp_rekey.RekeyError as e:
+        sys.exit("Error: %s" % str(e))
+    finally:
+        pool.close()
+        pool.join()
+        session.close()
+
+
+@main.command('bench-hash')
+@click.option('--target_ms', type=int, default=None,
+              help='Password verification time to aim for, by default '
+                   'the bcrypt_target_ms config option')
+@pass_config
+def bench_hash(config, target_ms):
+    """Pick the password hashing cost for this hardware.
+
+    Prints the highest bcrypt cost factor verifying a password within the
+    target time, to be set as the bcrypt_rounds config option. Stored
+    hashes of another cost are upgraded as their users log in.
+    """
+    if target_ms is None:
+        try:
+            target_ms = int(config.conf['bcrypt_target_ms'])
+        except (TypeError, ValueError):
+            sys.exit("Error: invalid value specified for "
+                     "'bcrypt_target_ms' config option")
+    if target_ms <= 0:
+        sys.exit("Error: target time must be positive")
+    rounds, timings = utils.calibrate_rounds(target_ms)
+    for cost, elapsed in timings:
+        printv(config, "Cost %d: %.1f ms" % (cost, elapsed))
+    click.echo("bcrypt_rounds = %d" % rounds)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,450 @@
+#!/usr/bin/env python
+
+import json
+import math
+import multiprocessing
+import os
+import random
+import shutil
+import socket
+import sys
+import tempfile
+import time
+
+import click
+from six.moves import http_client, shlex_quote
+
+from opp.common import utils
+
+
+DEFAULT_MIX = "auth=1,list=4,create=2,update=2,delete=1"
+OPERATIONS = ['auth', 'list', 'create', 'update', 'delete']
+
+
+def parse_mix(mix):
+    """Parse a request mix such as 'list=4,create=1' into weights."""
+    weights = {}
+    for entry in mix.split(','):
+        entry = entry.strip()
+        if not entry:
+            continue
+        try:
+            name, weight = entry.split('=')
+            name = name.strip()
+            weight = int(weight)
+        except ValueError:
+            raise ValueError("Invalid request mix entry: '%s'" % entry)
+        if name not in OPERATIONS:
+            raise ValueError("Unknown operation in request mix: '%s'" % name)
+        if weight < 0:
+            raise ValueError("Negative weight in request mix: '%s'" % entry)
+        weights[name] = weight
+    if not any(weights.values()):
+        raise ValueError("Request mix must contain at least one operation")
+    return weights
+
+
+def percentile(samples, pct):
+    """Return the nearest-rank percentile of an already sorted list."""
+    if not samples:
+        return None
+    rank = int(math.ceil(pct / 100.0 * len(samples))) - 1
+    return samples[max(0, min(rank, len(samples) - 1))]
+
+
+def summarize(results, elapsed):
+    """Merge per-worker results and compute throughput and latencies.
+
+    :param results: list of {operation: {'latencies': [...], 'errors': n}}
+    :param elapsed: wall clock duration of the run in seconds
+    """
+    merged = {}
+    for result in results:
+        for name, data in result.items():
+            entry = merged.setdefault(name, {'latencies': [], 'errors': 0})
+            entry['latencies'].extend(data['latencies'])
+            entry['errors'] += data['errors']
+
+    def _stats(latencies, errors):
+        latencies = sorted(latencies)
+        count = len(latencies)
+        stats = {'count': count,
+                 'errors': errors,
+                 'rps': round(count / elapsed, 2) if elapsed else None}
+        for pct in (50, 95, 99):
+            value = percentile(latencies, pct)
+            stats['p%d_ms' % pct] = (round(value * 1000, 3)
+                                     if value is not None else None)
+        stats['mean_ms'] = (round(sum(latencies) / count * 1000, 3)
+                            if count else None)
+        stats['max_ms'] = round(latencies[-1] * 1000, 3) if count else None
+        return stats
+
+    endpoints = {}
+    all_latencies = []
+    all_errors = 0
+    for name, data in sorted(merged.items()):
+        endpoints[name] = _stats(data['latencies'], data['errors'])
+        all_latencies.extend(data['latencies'])
+        all_errors += data['errors']
+
+    return {'elapsed_s': round(elapsed, 3),
+            'total': _stats(all_latencies, all_errors),
+            'endpoints': endpoints}
+
+
+class InProcessTransport(object):
+    """Drive the dispatched WSGI app directly without a network hop."""
+
+    def __init__(self):
+        from werkzeug.test import Client
+        from werkzeug.wrappers import BaseResponse
+
+        from opp.flask import create_app
+        self.client = Client(create_app(), BaseResponse)
+
+    def request(self, method, path, headers, body=None):
+        resp = self.client.open(path, method=method,
+                                headers=headers, data=body)
+        return resp.status_code, resp.data
+
+    def close(self):
+        pass
+
+
+class HttpTransport(object):
+    """Drive a running server over a persistent HTTP connection."""
+
+    def __init__(self, host, port):
+        self.conn = http_client.HTTPConnection(host, port, timeout=60)
+
+    def request(self, method, path, headers, body=None):
+        self.conn.request(method, path, body=body, headers=headers)
+        resp = self.conn.getresponse()
+        return resp.status, resp.read()
+
+    def close(self):
+        self.conn.close()
+
+
+class Worker(object):
+
+    def __init__(self, transport, username, password, phrase):
+        self.transport = transport
+        self.username = username
+        self.password = password
+        self.phrase = phrase
+        self.jwt = None
+        self.item_ids = []
+        self.reset()
+
+    def reset(self):
+        """Discard the results recorded so far."""
+        self.results = dict((op, {'latencies': [], 'errors': 0})
+                            for op in OPERATIONS)
+
+    def _call(self, op, method, path, payload=None, phrase=True):
+        headers = {'Content-Type': "application/json"}
+        if self.jwt:
+            headers['x-opp-jwt'] = self.jwt
+        if phrase:
+            headers['x-opp-phrase'] = self.phrase
+        body = json.dumps(payload) if payload is not None else None
+
+        start = time.time()
+        try:
+            code, data = self.transport.request(method, path, headers, body)
+        except Exception:
+            code, data = None, None
+        elapsed = time.time() - start
+
+        self.results[op]['latencies'].append(elapsed)
+        try:
+            data = json.loads(data.decode())
+        except Exception:
+            data = None
+        if code != 200 or not data or data.get('result') == "error":
+            self.results[op]['errors'] += 1
+            return None
+        return data
+
+    def auth(self):
+        payload = {'username': self.username, 'password': self.password}
+        data = self._call('auth', 'POST', '/api/v1/auth',
+                          payload, phrase=False)
+        if data:
+            self.jwt = data['access_token']
+
+    def list(self):
+        data = self._call('list', 'GET', '/api/v1/items')
+        if data:
+            self.item_ids = [item['id'] for item in data['items']]
+
+    def create(self):
+        payload = {'payload': [_random_item()]}
+        self._call('create', 'PUT', '/api/v1/items', payload)
+
+    def update(self):
+        if not self.item_ids:
+            return self.list()
+        item = _random_item()
+        item['id'] = random.choice(self.item_ids)
+        self._call('update', 'POST', '/api/v1/items', {'payload': [item]})
+
+    def delete(self):
+        if not self.item_ids:
+            return self.list()
+        item_id = self.item_ids.pop(random.randrange(len(self.item_ids)))
+        self._call('delete', 'DELETE', '/api/v1/items',
+                   {'payload': [item_id]}, phrase=False)
+
+
+def _random_string(min_len, max_len):
+    alphabet = "abcdefghijklmnopqrstuvwxyz0123456789"
+    return "".join(random.choice(alphabet) for _ in
+                   range(random.randint(min_len, max_len)))
+
+
+def _random_item():
+    host = _random_string(4, 16)
+    return {'name': host,
+            'url': "https://%s.com/login" % host,
+            'account': _random_string(0, 12),
+            'username': _random_string(4, 20),
+            'password': _random_string(12, 32),
+            'blob': _random_string(0, 200)}
+
+
+def _make_transport(url):
+    if url:
+        host, _, port = url.rpartition(':')
+        return HttpTransport(host.split('//')[-1], int(port))
+    return InProcessTransport()
+
+
+def _reinit_rng():
+    # Forked processes must not share the parent's PyCrypto RNG state
+    from Crypto import Random
+    Random.atfork()
+
+
+def _run_worker(args):
+    (conf_filepath, url, username, password, phrase,
+     weights, requests, duration, seed) = args
+    os.environ['OPP_TOP_CONFIG'] = conf_filepath
+    random.seed(seed)
+
+    _reinit_rng()
+
+    transport = _make_transport(url)
+    worker = Worker(transport, username, password, phrase)
+    # Warm up, i.e. log in and fetch item ids, without recording the calls
+    worker.auth()
+    worker.list()
+    worker.reset()
+
+    ops = [op for op in OPERATIONS for _ in range(weights.get(op, 0))]
+    start = time.time()
+    deadline = start + duration if duration else None
+    count = 0
+    while True:
+        if deadline and time.time() >= deadline:
+            break
+        if not deadline and count >= requests:
+            break
+        getattr(worker, random.choice(ops))()
+        count += 1
+
+    end = time.time()
+
+    transport.close()
+    return worker.results, start, end
+
+
+def _serve(conf_filepath, port):
+    os.environ['OPP_TOP_CONFIG'] = conf_filepath
+    _reinit_rng()
+    from werkzeug.serving import run_simple
+
+    from opp.flask import create_app
+    run_simple('127.0.0.1', port, create_app(), threaded=True)
+
+
+def _free_port():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def _wait_for_port(port, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), 1).close()
+            return
+        except socket.error:
+            time.sleep(0.1)
+    sys.exit("Error: local server did not start on port %d" % port)
+
+
+def seed_vault(conf_filepath, users, items, password, phrase):
+    """Create the database schema and populate it with users and items."""
+    utils.execute("opp-db --config_file %s init" % conf_filepath)
+    utils.execute("opp-db --config_file %s seed --users %d --items %d "
+                  "--username_prefix loadgen --password %s --phrase %s" %
+                  (conf_filepath, users, items, shlex_quote(password),
+                   shlex_quote(phrase)))
+    return ["loadgen%d" % i for i in range(users)]
+
+
+def bench_queries(conf_filepath, username, iterations):
+    """Time the hot database queries with and without baked queries.
+
+    Each query runs repeatedly in one session, so the difference is the
+    time spent building and compiling the query on each call.
+
+    :returns: dict of query name to mean microseconds per call
+    """
+    from sqlalchemy.orm import Session
+
+    from opp.common import opp_config
+    from opp.db import api
+
+    conf = opp_config.OppConfig(conf_filepath)
+    engine = api.get_engine(conf)
+    session = Session(bind=engine)
+    try:
+        user_id = api.user_get_by_username(username, session=session).id
+    finally:
+        session.close()
+    queries = {
+        'user_get_by_id': lambda s: api.user_get_by_id(user_id, session=s),
+        'user_get_by_username': lambda s: api.user_get_by_username(
+            username, session=s),
+        'item_getall': lambda s: api.item_getall(session=s, limit=50),
+        'category_getall': lambda s: api.category_getall(session=s),
+    }
+
+    results = {}
+    for name, query in sorted(queries.items()):
+        timings = {}
+        for enabled in (True, False):
+            session = Session(bind=engine, enable_baked_queries=enabled)
+            try:
+                # Warm up the query cache and the connection
+                query(session)
+                start = time.time()
+                for _ in range(iterations):
+                    query(session)
+                timings[enabled] = (time.time() - start) / iterations * 1e6
+            finally:
+                session.close()
+        results[name] = {'baked_us': round(timings[True], 1),
+                         'unbaked_us': round(timings[False], 1),
+                         'saved_us': round(timings[False] - timings[True], 1)}
+    return results
+
+
+@click.command()
+@click.option('--config_file', default=None,
+              help='Config file of an existing, seeded database. If omitted '
+                   'a temporary SQLite database is created and seeded')
+@click.option('--users', default=4, show_default=True,
+              help='Number of users to seed')
+@click.option('--items', default=100, show_default=True,
+              help='Number of items to seed per user')
+@click.option('--password', default="loadgen", show_default=True,
+              help='Password of the seeded users')
+@click.option('--phrase', default="loadgen", show_default=True,
+              help='Vault passphrase of the seeded items')
+@click.option('--concurrency', default=4, show_default=True,
+              help='Number of load generating processes')
+@click.option('--requests', default=250, show_default=True,
+              help='Requests issued by each process')
+@click.option('--duration', default=0.0,
+              help='Run for this many seconds instead of a request count')
+@click.option('--mix', default=DEFAULT_MIX, show_default=True,
+              help='Weighted request mix')
+@click.option('--mode', type=click.Choice(['inprocess', 'server']),
+              default='inprocess', show_default=True,
+              help='Call the WSGI app directly or through a local server')
+@click.option('--url', default=None,
+              help='Target an already running server, e.g. '
+                   'http://127.0.0.1:5000')
+@click.option('--query_bench', default=0,
+              help='Also time this many calls of each hot database query '
+                   'with and without baked queries')
+@click.option('--output', default=None,
+              help='Write the JSON report to this file')
+def main(config_file, users, items, password, phrase, concurrency,
+         requests, duration, mix, mode, url, query_bench, output):
+    """Drive the OpenPassPhrase stack and report throughput/latency."""
+    try:
+        weights = parse_mix(mix)
+    except ValueError as e:
+        sys.exit("Error: %s" % str(e))
+
+    test_dir = None
+    if not config_file:
+        test_dir = tempfile.mkdtemp(prefix='opp_loadgen_')
+        config_file = os.path.join(test_dir, 'opp.cfg')
+        with open(config_file, 'w') as conf_file:
+            conf_file.write("[DEFAULT]\ndb_connect = sqlite:///%s" %
+                            os.path.join(test_dir, 'loadgen.sqlite'))
+        click.echo("Seeding %d users x %d items" % (users, items), err=True)
+        usernames = seed_vault(config_file, users, items, password, phrase)
+    else:
+        usernames = ["loadgen%d" % i for i in range(users)]
+
+    queries = None
+    if query_bench > 0:
+        queries = bench_queries(config_file, usernames[0], query_bench)
+
+    server = None
+    if mode == 'server' and not url:
+        port = _free_port()
+        server = multiprocessing.Process(target=_serve,
+                                         args=(config_file, port))
+        server.daemon = True
+        server.start()
+        _wait_for_port(port)
+        url = "http://127.0.0.1:%d" % port
+
+    jobs = [(config_file, url, usernames[i % len(usernames)], password,
+             phrase, weights, requests, duration, i)
+            for i in range(concurrency)]
+    pool = multiprocessing.Pool(concurrency)
+    try:
+        runs = pool.map(_run_worker, jobs)
+    finally:
+        pool.close()
+        pool.join()
+        if server:
+            server.terminate()
+            server.join()
+        if test_dir:
+            shutil.rmtree(test_dir, ignore_errors=True)
+
+    # Time the request mixes only, not the workers' startup and warm-up
+    results = [run[0] for run in runs]
+    elapsed = max(run[2] for run in runs) - min(run[1] for run in runs)
+    report = summarize(results, elapsed)
+    report['config'] = {'users': users, 'items': items,
+                        'concurrency': concurrency, 'requests': requests,
+                        'duration': duration, 'mix': weights,
+                        'mode': 'server' if url else 'inprocess'}
+    if queries:
+        report['queries'] = queries
+    report['timestamp'] = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+
+    report = json.dumps(report, indent=2, sort_keys=True)
+    if output:
+        with open(output, 'w') as f:
+            f.write(report)
+    click.echo(report)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+
+import multiprocessing
+import os
+import sys
+
+import click
+
+from opp.common import opp_config, sessions
+
+
+def _post_fork(server, worker):
+    # Children must neither share pooled DB connections nor the PyCrypto
+    # RNG state with the master process
+    from Crypto import Random
+
+    from opp.db import api
+    api.dispose_engines()
+    Random.atfork()
+
+
+FACTORIES = {'all': 'create_app',
+             'backend': 'create_backend_app',
+             'frontend': 'create_frontend_app'}
+
+
+def _load_app(conf, app='all'):
+    """Import the application and set up everything shareable by workers."""
+    import opp.flask
+    from opp.db import api
+
+    # Creating the engine does not connect yet, so nothing is inherited
+    # by the workers but the parsed connection settings
+    api.get_engine(conf)
+    return getattr(opp.flask, FACTORIES[app])(conf)
+
+
+def make_application(options, conf, app='all'):
+    from gunicorn.app.base import BaseApplication
+
+    class Application(BaseApplication):
+
+        def load_config(self):
+            for key, value in options.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            return _load_app(conf, app)
+
+    return Application()
+
+
+@click.command()
+@click.option('--config_file', default=None,
+              help='Path to OpenPassPhrase config file')
+@click.option('--app', type=click.Choice(sorted(FACTORIES)), default='all',
+              show_default=True,
+              help='Serve the API and login page, or only one of them. '
+                   'The API alone is served from / instead of /api')
+@click.option('--bind', default="127.0.0.1:5000", show_default=True,
+              help='Address to listen on, may be repeated', multiple=True)
+@click.option('--workers', default=None, type=int,
+              help='Number of worker processes  [default: 2 x CPUs + 1]')
+@click.option('--threads', default=1, show_default=True,
+              help='Number of threads per worker process')
+@click.option('--timeout', default=30, show_default=True,
+              help='Seconds after which a silent worker is restarted')
+@click.option('--graceful_timeout', default=30, show_default=True,
+              help='Seconds workers get to finish requests on restart')
+@click.option('--max_requests', default=0, show_default=True,
+              help='Restart workers after this many requests, 0 to disable')
+@click.option('--pidfile', default=None,
+              help='Write the PID of the master process to this file')
+@click.option('--no_preload', is_flag=True,
+              help='Load the app in each worker instead of once before '
+                   'forking, e.g. to make SIGHUP reload the code')
+def main(config_file, app, bind, workers, threads, timeout, graceful_timeout,
+         max_requests, pidfile, no_preload):
+    """Run the OpenPassPhrase app under a pre-fork multi-worker server.
+
+    Send SIGHUP to the master process to gracefully replace the workers,
+    SIGTERM for a graceful shutdown and SIGTTIN/SIGTTOU to add/remove a
+    worker.
+    """
+    try:
+        import gunicorn  # noqa
+    except ImportError:
+        sys.exit("Error: opp-server requires gunicorn to be installed.")
+
+    if config_file:
+        if not os.path.isfile(config_file):
+            sys.exit("Error: config file %s not found." % config_file)
+        # Picked up by the app and any re-executed master process
+        os.environ['OPP_TOP_CONFIG'] = os.path.abspath(config_file)
+    conf = opp_config.OppConfig()
+
+    options = {
+        'bind': list(bind),
+        'workers': workers or multiprocessing.cpu_count() * 2 + 1,
+        'threads': threads,
+        'timeout': timeout,
+        'graceful_timeout': graceful_timeout,
+        'max_requests': max_requests,
+        'max_requests_jitter': max_requests // 10,
+        'preload_app': not no_preload,
+        'post_fork': _post_fork,
+        'proc_name': "opp-server",
+    }
+    if pidfile:
+        options['pidfile'] = pidfile
+    if (app != 'backend' and options['workers'] > 1 and
+            sessions.store_url(conf) == "memory"):
+        sys.exit("Error: login page sessions kept in memory are not shared "
+                 "by the %d workers. Set the frontend_session_store config "
+                 "option to a shared store." % options['workers'])
+    if (app != 'frontend' and options['workers'] > 1 and
+            conf['db_connect_replicas'] and
+            (conf['db_replica_write_store'] or "memory") == "memory"):
+        sys.exit("Error: users' last writes kept in memory are not shared "
+                 "by the %d workers, which may then read stale data from "
+                 "the replicas. Set the db_replica_write_store config "
+                 "option to a shared store." % options['workers'])
+    make_application(options, conf, app).run()
+
+
+if __name__ == '__main__':
+    main()
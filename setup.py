@@ -9,6 +9,8 @@ setup(
     entry_points={
         'console_scripts': [
             'opp-db=opp.tools.dbmgr:main',
+            'opp-loadgen=opp.tools.loadgen:main',
+            'opp-server=opp.tools.server:main',
         ],
     },
 )